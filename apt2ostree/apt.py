@@ -3,6 +3,7 @@
 import errno
 import glob
 import hashlib
+import json
 import os
 import pipes
 import platform
@@ -13,32 +14,58 @@ else:
     from urllib import unquote
 from collections import namedtuple
 
-from .ninja import Rule
-from .ostree import ostree_addfile, ostree_combine, OstreeRef
+from . import profiling
+from .deb_cache import (DEB_CACHE_ENV, DEB_CACHE_MAX_SIZE_ENV, format_config,
+                        parse_size)
+from .lockfile import Lockfile
+from .ninja import Rule, default_pool_depths
+from .ostree import (COMBINE_FANOUT, OSTREE_WORKER_ENV, ostree_addfile,
+                     ostree_assert_same, ostree_combine,
+                     ostree_combine_incremental, ostree_combine_tree,
+                     OstreeRef)
 
 
 DEB_POOL_MIRRORS = []
 
+DPKG_CONFIGURE_MODE_ENV = "APT2OSTREE_DPKG_CONFIGURE"
+DPKG_CONFIGURE_MODES = ("auto", "fast", "slow")
+
+RESOLVERS = ("aptly", "builtin")
+
 
 update_lockfile = Rule("update_lockfile", """\
-    set -ex;
-    export tmpdir="_build/tmp/update_lockfile/$$(systemd-escape $out)";
-    rm -rf $$tmpdir;
-    mkdir -p $$tmpdir;
-    export HOME=$$tmpdir;
-    $create_mirrors;
-    aptly lockfile create
-        -mirrors "$mirrors"
-        -architectures=$architecture
-        $keyring_arg -gpg-provider=internal
-        $packages >$lockfile~;
-    if cmp $lockfile~ $lockfile; then
-        rm $lockfile~;
-    else
-        mv $lockfile~ $lockfile;
-    fi;
-    rm -rf "$$tmpdir";
-""", inputs=['.FORCE'], outputs=['update-lockfile-$lockfile'])
+    $apt2ostree_python -m apt2ostree.update_lockfile
+        --tmpdir="_build/tmp/update_lockfile/$$(systemd-escape $out)" $spec
+""", inputs=['.FORCE'], outputs=['update-lockfile-$lockfile'],
+    pool="network")
+
+# Updates all the lockfiles that share apt sources in one go.  See
+# `update_lockfile.py`.
+update_lockfile_group = Rule("update_lockfile_group", """\
+    $apt2ostree_python -m apt2ostree.update_lockfile
+        --tmpdir="_build/tmp/update_lockfile/$$(systemd-escape $out)" $specs
+""", inputs=['.FORCE'], outputs=['update-lockfiles-$_args_digest'],
+    pool="network")
+
+# See `gc.py`.  In the console pool so its report is shown as it's written.
+ostree_gc = Rule("ostree_gc", """\
+    $apt2ostree_python -m apt2ostree.gc --repo=$ostree_repo
+        --keep-images=$keep_images $gc_args $ninja_file
+""", inputs=['.FORCE'], pool="console")
+
+# See `timings.py`.
+build_times = Rule("build_times", """\
+    $apt2ostree_python -m apt2ostree.timings --log=$builddir/.ninja_log
+        $ninja_file
+""", inputs=['.FORCE'], pool="console")
+
+# See `sizes.py`.  $others are the manifests of the other images so the bytes
+# shared with them can be counted.
+image_size_report = Rule("image_size_report", """\
+    $apt2ostree_python -m apt2ostree.sizes --repo=$ostree_repo
+        --manifest=$manifest --image=$branch --json=$out --text=$text $others
+""", inputs=["$ostree_repo/refs/heads/$branch", "$manifest"],
+    outputs=["_build/size-report/$report.json"])
 
 dpkg_base = Rule(
     "dpkg_base", """\
@@ -73,14 +100,15 @@ dpkg_base = Rule(
     chmod 0700 var/cache/apt/archives/partial
                var/lib/apt/lists/partial;
     cd -;
-    ostree --repo=$ostree_repo commit -b "deb/dpkg-base/$architecture"
+    $ostree --repo=$ostree_repo commit -b "deb/dpkg-base/$architecture"
         --tree=dir=$$tmpdir
         --no-bindings --orphan --timestamp=0 --owner-uid=0 --owner-gid=0;
     rm -rf "$$tmpdir";
     """, restat=True,
     output_type=OstreeRef,
     outputs=["$ostree_repo/refs/heads/deb/dpkg-base/$architecture"],
-    order_only=["$ostree_repo/config"])
+    order_only=["$ostree_repo/config"],
+    pool="ostree_write")
 
 apt_base = Rule(
     "apt_base", """\
@@ -88,71 +116,44 @@ apt_base = Rule(
     mkdir -p $$tmpdir/etc/apt/sources.list.d;
     printf "deb [arch=%s] %s %s %s\\n" $architecture $archive_url $distribution "$components"
         >$$tmpdir/etc/apt/sources.list.d/$name.list;
-    ostree --repo=$ostree_repo commit -b deb/apt_base/$_args_digest
+    $ostree --repo=$ostree_repo commit -b deb/apt_base/$_args_digest
            --tree=dir=$$tmpdir
            --no-bindings --orphan --timestamp=0 --owner-uid=0 --owner-gid=0;
     rm -rf "$$tmpdir";
     """,
     output_type=OstreeRef,
     outputs=["$ostree_repo/refs/heads/deb/apt_base/$_args_digest"],
-    order_only=["$ostree_repo/config"], restat=True)
+    order_only=["$ostree_repo/config"], restat=True,
+    pool="ostree_write")
 
 # Ninja will rebuild the target if the contents of the rule changes.  We don't
 # want to redownload a deb just because the list of mirrors has changed, so
 # instead we write _build/deb_pool_mirrors and explicitly **don't** declare a
-# dependency on it.
+# dependency on it.  The same goes for _build/mirror-health.json which is used
+# to try the fastest and most reliable mirrors first (see `mirror_health.py`)
+# and _build/deb_cache.json which configures the deb cache shared between
+# workspaces (see `deb_cache.py`).
+#
+# The deb is streamed from the fetch service (see `fetch.py`), which is shared
+# by all the download_deb edges so connections to the mirrors are kept alive
+# between debs, straight into ostree (see `deb.py`).  Nothing is written to
+# disk unless we're mirroring.
 download_deb = Rule(
     "download_deb", """\
-        download() {
-            curl -L --fail -o $$tmpdir/deb $$1 &&
-            actual_sha256="$$(sha256sum $$tmpdir/deb | cut -f1 -d ' ')" &&
-            if [ "$$actual_sha256" != "$sha256sum" ]; then
-                printf "FAIL: SHA256sum %s from %s doesn't match %s" \\
-                    "$$actual_sha256" "$$1" "$sha256sum";
-                return 1;
-            else
-                return 0;
-            fi;
-        };
-
         set -ex;
-        tmpdir=$builddir/tmp/download-deb/$aptly_pool_filename;
-        mkdir -p "$$tmpdir";
-        while read mirror; do
-            download file://$$PWD/$builddir/apt/mirror/${filename} && break;
-            download $$mirror/${filename} && break;
-            download $$mirror/$aptly_pool_filename && break;
-        done <$builddir/deb_pool_mirrors;
-        if ! [ -e $$tmpdir/deb ]; then
-            echo Failed to download ${filename};
-            exit 1;
-        fi;
-        cd $$tmpdir;
-        ar x deb;
-        cd -;
-        control=$$(find $$tmpdir -name 'control.tar.*');
-        data=$$(find $$tmpdir -name 'data.tar.*');
-        case "$$control" in
-            *.zst)
-                control=$${control%.zst};
-                zstd --decompress $$control.zst -o $$control --force;;
-        esac;
-        case "$$data" in
-            *.zst)
-                data=$${data%.zst};
-                zstd --decompress $$data.zst -o $$data --force;;
-        esac;
-        ostree --repo=$ostree_repo commit -b $ref_base/data
-               --tree=tar=$$data --no-bindings --orphan --timestamp=0
-               -s $aptly_pool_filename" data";
-        ostree --repo=$ostree_repo commit -b $ref_base/control
-               --tree=tar=$$control --no-bindings --orphan --timestamp=0
-               -s $aptly_pool_filename" control";
+        mirror_to=;
         if [ "$apt_should_mirror" = "True" ]; then
-            mkdir -p "$builddir/apt/mirror/$$(dirname $filename)";
-            mv $$tmpdir/deb "$builddir/apt/mirror/$filename";
+            mirror_to="--mirror-to=$builddir/apt/mirror/$filename";
         fi;
-        rm -rf $$tmpdir;
+        $apt2ostree_python -m apt2ostree.deb import
+            --repo=$ostree_repo --ref-base=$ref_base
+            --subject=$aptly_pool_filename --sha256=$sha256sum $$mirror_to
+            --socket=$builddir/fetch.sock
+            --mirrors=$builddir/deb_pool_mirrors
+            --mirror-health=$builddir/mirror-health.json
+            --cache-config=$builddir/deb_cache.json
+            file://$$PWD/$builddir/apt/mirror/${filename}
+            ${filename} $aptly_pool_filename;
     """,
     restat=True,
     output_type=(OstreeRef, OstreeRef),
@@ -162,28 +163,19 @@ download_deb = Rule(
     # Sometimes the same deb is available from multiple different URLs.  This
     # is fine and shouldn't cause configure to fail:
     allow_non_identical_duplicates=True,
-    description="Download $aptly_pool_filename")
+    description="Download $aptly_pool_filename",
+    pool="network")
 
 make_dpkg_info = Rule(
     "make_dpkg_info", """\
-        overwrite_if_changed () {
-            if ! cmp $$1 $$2; then
-                mv $$1 $$2;
-            fi;
-        };
         set -ex;
         tmpdir=$builddir/tmp/make_dpkg_info/$sha256sum;
         rm -rf "$$tmpdir";
         mkdir -p $$tmpdir/out/var/lib/dpkg/info;
-        ostree --repo=$ostree_repo checkout --repo=$ostree_repo -UH "$ref_base/control" "$$tmpdir/control";
-        multi_arch=$$(awk '/^Multi-Arch:/ {print $$2}' $$tmpdir/control/control);
-        if [ "$$multi_arch" = "same" ]; then
-            architecture=$$(awk '/^Architecture:/ {print $$2}' $$tmpdir/control/control);
-            suffix=":$$architecture";
-        fi;
-        ostree --repo=$ostree_repo ls -R $ref_base/data --nul-filenames-only
+        $ostree --repo=$ostree_repo checkout --repo=$ostree_repo -UH "$ref_base/control" "$$tmpdir/control";
+        $ostree --repo=$ostree_repo ls -R $ref_base/data --nul-filenames-only
         | tr '\\0' '\\n' 
-        | sed 's,^/$$,/.,' >$$tmpdir/out/var/lib/dpkg/info/$pkgname$$suffix.list;
+        | sed 's,^/$$,/.,' >$$tmpdir/out/var/lib/dpkg/info/$pkgname$multi_arch_suffix.list;
         cd "$$tmpdir";
         for x in conffiles
                  config
@@ -197,54 +189,51 @@ make_dpkg_info = Rule(
                  templates
                  triggers; do
             if [ -e "control/$$x" ]; then
-                mv "control/$$x" "out/var/lib/dpkg/info/$pkgname$$suffix.$$x";
+                mv "control/$$x" "out/var/lib/dpkg/info/$pkgname$multi_arch_suffix.$$x";
             fi;
         done;
-        ( cat control/control; echo Status: install ok unpacked; echo ) >status;
-        ( cat control/control; echo ) >available;
         cd -;
-        ostree --repo=$ostree_repo commit -b "$ref_base/info" --tree=dir=$$tmpdir/out
+        $ostree --repo=$ostree_repo commit -b "$ref_base/info" --tree=dir=$$tmpdir/out
             --no-bindings --orphan --timestamp=0 --owner-uid=0 --owner-gid=0
             --no-xattrs;
-        overwrite_if_changed $$tmpdir/status $builddir/$ref_base/status;
-        overwrite_if_changed $$tmpdir/available $builddir/$ref_base/available;
+        if ! cmp -s "$$tmpdir/control/control" $builddir/$ref_base/control; then
+            cp "$$tmpdir/control/control" $builddir/$ref_base/control;
+        fi;
         rm -rf "$$tmpdir";
     """,
     restat=True,
-    output_type=(str, str, OstreeRef),
-    outputs=[
-        '$builddir/$ref_base/status',
-        '$builddir/$ref_base/available',
-        '$ostree_repo/refs/heads/$ref_base/info'],
+    output_type=(OstreeRef, str),
+    outputs=['$ostree_repo/refs/heads/$ref_base/info',
+             '$builddir/$ref_base/control'],
     order_only=["$ostree_repo/config"],
     inputs=["$ostree_repo/refs/heads/$ref_base/control",
-            "$ostree_repo/refs/heads/$ref_base/data"])
+            "$ostree_repo/refs/heads/$ref_base/data"],
+    pool="ostree_write")
 
+# See `usrmove.py`.  Rewrites the dirtrees of the combined image rather than
+# checking it out so it's cheap enough to run once per image.
 do_usrmove = Rule(
     "do_usrmove", """\
-    set -ex;
-    if ! ostree --repo=$ostree_repo ls "$in_branch" | grep -e /bin -e /lib -e /sbin; then
-        ostree --repo=$ostree_repo commit -b $out_branch
-               --no-bindings --orphan --timestamp=0 --tree=ref=$in_branch;
-        exit 0;
-    fi;
-    mkdir -p $builddir/tmp/do_usrmove;
-    tmpdir=$builddir/tmp/do_usrmove/$$(systemd-escape $in_branch);
-    rm -rf "$$tmpdir";
-    ostree --repo=$ostree_repo checkout -UH $in_branch "$$tmpdir";
-    ostree --repo=$ostree_repo checkout -UH :$in_branch:bin "$$tmpdir/usr/bin" --union && rm -rf $$tmpdir/bin && ln -s usr/bin $$tmpdir/bin || true;
-    ostree --repo=$ostree_repo checkout -UH :$in_branch:sbin "$$tmpdir/usr/sbin" --union && rm -rf $$tmpdir/sbin && ln -s usr/sbin $$tmpdir/sbin || true;
-    ostree --repo=$ostree_repo checkout -UH :$in_branch:lib "$$tmpdir/usr/lib" --union  && rm -rf $$tmpdir/lib && ln -s usr/lib $$tmpdir/lib || true;
-
-    ostree --repo=$ostree_repo commit --devino-canonical -b $out_branch
-           --no-bindings --orphan --timestamp=0 --tree=dir=$$tmpdir
-           --owner-uid=0 --owner-gid=0;
-    """,
+        $apt2ostree_python -m apt2ostree.usrmove
+            --repo=$ostree_repo --in-branch=$in_branch --out-branch=$out_branch
+            --tmpdir=$builddir/tmp/do_usrmove/$out_branch""",
     restat=True,
     inputs=["$ostree_repo/refs/heads/$in_branch"],
     output_type=OstreeRef,
     outputs=["$ostree_repo/refs/heads/$out_branch"],
-    description="usrmove $in_branch")
+    order_only=["$ostree_repo/config"],
+    description="usrmove $in_branch",
+    pool="ostree_write")
+
+# See `dpkg_status.py`.  The lockfile stanzas in $in merged with the control
+# files of the debs, listed in $controls.
+dpkg_merge_control = Rule(
+    "dpkg_merge_control", """\
+    $apt2ostree_python -m apt2ostree.dpkg_status --controls=$controls
+        --output=$out $in
+""", restat=True,
+    outputs=["$builddir/apt/dpkg/$pkgs_digest.$meta"],
+    description="Merging control files into $meta for $pkgs_digest")
 
 deb_combine_meta = Rule(
     "deb_combine_meta", """\
@@ -252,8 +241,8 @@ deb_combine_meta = Rule(
     tmpdir=$builddir/tmp/deb_combine_$meta/$pkgs_digest;
     rm -rf "$$tmpdir";
     mkdir -p "$$tmpdir/var/lib/dpkg";
-    cat $in >$$tmpdir/var/lib/dpkg/$meta;
-    ostree --repo=$ostree_repo commit -b "deb/images/$pkgs_digest/$meta"
+    cp $in $$tmpdir/var/lib/dpkg/$meta;
+    $ostree --repo=$ostree_repo commit -b "deb/images/$pkgs_digest/$meta"
         --tree=dir=$$tmpdir --no-bindings --orphan --timestamp=0
         --owner-uid=0 --owner-gid=0 --no-xattrs;
     rm -rf "$$tmpdir";
@@ -262,20 +251,52 @@ deb_combine_meta = Rule(
     output_type=OstreeRef,
     outputs=["$ostree_repo/refs/heads/deb/images/$pkgs_digest/$meta"],
     order_only=["$ostree_repo/config"],
-    description="var/lib/dpkg/$meta for $pkgs_digest")
+    description="var/lib/dpkg/$meta for $pkgs_digest",
+    pool="ostree_write")
 
 
 # This is a really naive implementation calling `dpkg --configure -a` in a
 # container using `bwrap` and `sudo`.  A proper implementation will be
 # container-system dependent and should not require root.
+#
+# $dpkg_configure_mode chooses how the image is checked out and in again:
+#
+# slow: copy it all out as root and pipe it all back in through tar.
+# fast: hardlink checkout protected by overlayfs.  Only what dpkg changed is
+#       committed back.  See `overlay.py`.
+# auto: slow, for now.  Both are meant to give the same commit, and
+#       `ninja check-configure-<branch>` checks that, but until it has been
+#       seen to pass on real images auto won't choose the fast path.
 dpkg_configure = Rule(
     "dpkg_configure", """\
         set -ex;
         tmpdir=$builddir/tmp/dpkg_configure/$out_branch;
+        if mountpoint -q $$tmpdir/co; then
+            sudo umount $$tmpdir/co;
+        fi;
         sudo rm -rf "$$tmpdir";
         mkdir -p $$tmpdir;
         TARGET=$$tmpdir/co;
-        sudo ostree --repo=$ostree_repo checkout --force-copy $in_branch $$TARGET;
+        fast=;
+        if [ "$dpkg_configure_mode" = fast ]
+                && mkdir $$tmpdir/upper $$tmpdir/work $$TARGET
+                && ostree --repo=$ostree_repo checkout -UH --require-hardlinks
+                          $in_branch $$tmpdir/lower
+                && ostree --repo=$ostree_repo ls -R $in_branch >$$tmpdir/lower.ls
+                && sudo mount -t overlay overlay
+                        -o lowerdir=$$tmpdir/lower,upperdir=$$tmpdir/upper,workdir=$$tmpdir/work
+                        $$TARGET; then
+            fast=1;
+            trap "sudo umount $$TARGET" EXIT;
+            sudo $apt2ostree_python -m apt2ostree.overlay restore-modes
+                --lower=$$tmpdir/lower --lower-ls=$$tmpdir/lower.ls $$TARGET;
+        elif [ "$dpkg_configure_mode" = fast ]; then
+            exit 1;
+        else
+            sudo rm -rf "$$tmpdir";
+            mkdir -p $$tmpdir;
+            sudo ostree --repo=$ostree_repo checkout --force-copy $in_branch $$TARGET;
+        fi;
         sudo cp $$TARGET/usr/share/base-passwd/passwd.master $$TARGET/etc/passwd;
         sudo cp $$TARGET/usr/share/base-passwd/group.master $$TARGET/etc/group;
 
@@ -304,9 +325,28 @@ dpkg_configure = Rule(
 
         sudo rm -f $$TARGET/etc/machine-id;
 
-        sudo tar -C $$tmpdir/co -c .
-        | ostree --repo=$ostree_repo commit --branch $out_branch --no-bindings
-                 --orphan --timestamp=0 --tree=tar=/dev/stdin;
+        if [ -z "$$fast" ]; then
+            sudo tar -C $$tmpdir/co -c .
+            | ostree --repo=$ostree_repo commit --branch $out_branch --no-bindings
+                     --orphan --timestamp=0 --tree=tar=/dev/stdin;
+        elif sudo $apt2ostree_python -m apt2ostree.overlay check
+                --lower=$$tmpdir/lower $$tmpdir/upper; then
+            sudo $apt2ostree_python -m apt2ostree.overlay tar
+                --lower=$$tmpdir/lower --lower-ls=$$tmpdir/lower.ls $$tmpdir/upper
+                >$$tmpdir/upper.tar;
+            ostree --repo=$ostree_repo commit --branch $out_branch --no-bindings
+                   --orphan --timestamp=0 --tree=ref=$in_branch
+                   --tree=tar=$$tmpdir/upper.tar;
+        else
+            sudo $apt2ostree_python -m apt2ostree.overlay tar
+                --lower=$$tmpdir/lower --lower-ls=$$tmpdir/lower.ls $$TARGET
+            | ostree --repo=$ostree_repo commit --branch $out_branch --no-bindings
+                     --orphan --timestamp=0 --tree=tar=/dev/stdin;
+        fi;
+        if [ -n "$$fast" ]; then
+            sudo umount $$TARGET;
+            trap - EXIT;
+        fi;
         sudo rm -rf $$tmpdir;
     """,
     restat=True,
@@ -315,10 +355,30 @@ dpkg_configure = Rule(
     inputs=["$ostree_repo/refs/heads/$in_branch"],
     order_only=["$ostree_repo/config"],
     # pool console is used because the above involves sudo which might need
-    # to ask for a password
+    # to ask for a password.  That also means only one runs at a time, so it
+    # doesn't need to be in heavy_checkout.
     pool="console")
 
 
+dpkg_seed = Rule(
+    "dpkg_seed", """\
+        $apt2ostree_python -m apt2ostree.seed
+            --repo=$ostree_repo --in-branch=$in_branch --out-branch=$out_branch
+            --base-branch=$base_branch
+            --base-manifest=$base_manifest --manifest=$manifest
+            --status=$status --available=$available $seed_args
+            --tmpdir=$builddir/tmp/dpkg_seed/$out_branch""",
+    restat=True,
+    output_type=OstreeRef,
+    outputs=["$ostree_repo/refs/heads/$out_branch"],
+    inputs=["$ostree_repo/refs/heads/$in_branch",
+            "$ostree_repo/refs/heads/$base_branch",
+            "$base_manifest", "$manifest", "$status", "$available"],
+    order_only=["$ostree_repo/config"],
+    description="Seeding $out_branch from $base_branch",
+    pool="heavy_checkout")
+
+
 AptSource = namedtuple(
     "AptSource", "architecture distribution archive_url components keyrings")
 
@@ -371,29 +431,157 @@ def keyrings_for(distro, release):
 
 
 class Apt(object):
-    def __init__(self, ninja, deb_pool_mirrors=None, apt_should_mirror=False):
+    def __init__(self, ninja, deb_pool_mirrors=None, apt_should_mirror=False,
+                 deb_cache=None, deb_cache_max_size=None,
+                 combine_fanout=COMBINE_FANOUT, incremental=False,
+                 dpkg_configure_mode=None, ostree_worker=False,
+                 resolver="aptly", pools=None, keep_images=1):
+        """deb_cache is a directory in which to cache debs so they can be
+        shared with other workspaces.  deb_cache_max_size is in bytes or a
+        string like "20G".  They default to the environment variables
+        APT2OSTREE_DEB_CACHE and APT2OSTREE_DEB_CACHE_MAX_SIZE.
+
+        combine_fanout is the number of packages, or intermediate commits,
+        combined by each commit when building an image.  See
+        `ostree_combine_tree`.
+
+        With incremental=True images are built by modifying the previous
+        build of the same image rather than from scratch.  See
+        `incremental.py`.
+
+        dpkg_configure_mode is "auto", "fast" or "slow".  See
+        `dpkg_configure`.  It defaults to the environment variable
+        APT2OSTREE_DPKG_CONFIGURE or "auto".
+
+        With ostree_worker=True most of the ostree operations are done by
+        one long-lived process rather than an `ostree` process each.  See
+        `ostree_worker.py`.
+
+        resolver is "aptly" or "builtin".  With "builtin" lockfiles are
+        resolved by `resolver.py` rather than `aptly lockfile create` so
+        aptly isn't needed.
+
+        pools is a dict from ninja pool name to depth, overriding the depths
+        from `default_pool_depths`.  The pools limit how many downloads,
+        ostree commits and image checkouts run at once whatever `ninja -j`
+        is.
+
+        keep_images is the number of commits of each image that `ninja gc`
+        keeps so you can roll back to them.  See `gc.py`."""
         if deb_pool_mirrors is None:
             deb_pool_mirrors = DEB_POOL_MIRRORS
+        if deb_cache is None:
+            deb_cache = os.environ.get(DEB_CACHE_ENV)
+        if deb_cache_max_size is None:
+            deb_cache_max_size = os.environ.get(DEB_CACHE_MAX_SIZE_ENV)
+        if not isinstance(deb_cache_max_size, int):
+            deb_cache_max_size = parse_size(deb_cache_max_size)
+        if dpkg_configure_mode is None:
+            dpkg_configure_mode = os.environ.get(
+                DPKG_CONFIGURE_MODE_ENV, "auto")
+        if resolver not in RESOLVERS:
+            raise ValueError("resolver must be one of %s, not %r" % (
+                ", ".join(RESOLVERS), resolver))
+        if dpkg_configure_mode not in DPKG_CONFIGURE_MODES:
+            raise ValueError("dpkg_configure_mode must be one of %s, not %r" % (
+                ", ".join(DPKG_CONFIGURE_MODES), dpkg_configure_mode))
 
         self.ninja = ninja
         self.archive_urls = set()
         self.deb_pool_mirrors = deb_pool_mirrors
+        self.combine_fanout = combine_fanout
+        self.incremental = incremental
+        self.dpkg_configure_mode = dpkg_configure_mode
+        self.resolver = resolver
+        self.keep_images = keep_images
+        # [(lockfile, image)] for the size reports
+        self.images = []
         self.lockfile_rules = set()
+        # create_mirrors script -> [(lockfile, spec)]
+        self.lockfile_groups = {}
 
         ninja.variable("apt_should_mirror", str(bool(apt_should_mirror)))
+        ninja.variable("dpkg_configure_mode", dpkg_configure_mode)
+        worker_env = ""
+        if ostree_worker:
+            socket_path = "%s/ostree-worker.sock" % ninja.builddir
+            worker_env = "%s=%s " % (OSTREE_WORKER_ENV, pipes.quote(socket_path))
+            # Try again in case whatever stopped it starting has been fixed:
+            if os.path.exists(socket_path + ".unavailable"):
+                os.unlink(socket_path + ".unavailable")
+        ninja.variable("apt2ostree_python", "env PYTHONPATH=%s %s%s" % (
+            pipes.quote(os.path.relpath(_find_file(".."))), worker_env,
+            pipes.quote(sys.executable)))
+        ninja.variable("ostree", "$apt2ostree_python -m apt2ostree.ostree_worker"
+                       if ostree_worker else "ostree")
 
         self.ninja.add_generator_dep(__file__)
+        # Modules configure uses to parse the lockfiles and write the deb
+        # cache config
+        self.ninja.add_generator_dep(__file__ + '/../lockfile.py')
+        self.ninja.add_generator_dep(__file__ + '/../deb_cache.py')
+
+        depths = default_pool_depths()
+        depths.update(pools or {})
+        for name, depth in sorted(depths.items()):
+            ninja.pool(name, depth)
+
+        # Build edges for the debs used by all images.  These are written to
+        # a separate fragment, generated from the lists of debs written with
+        # each image's fragment rather than from the lockfiles themselves.
+        # Quirks applied in `fix_package` must be added here too.
+        self.debs = ninja.fragment("%s/apt/fragments/debs.ninja" %
+                                   ninja.builddir)
+
+        ninja.write_file("%s/deb_cache.json" % ninja.builddir,
+                         format_config(deb_cache, deb_cache_max_size))
 
         # Get these files added to .gitignore:
         ninja.add_target("%s/config" % ninja.global_vars['ostree_repo'])
         ninja.add_target("%s/objects" % ninja.global_vars['ostree_repo'])
 
     def write_phony_rules(self):
-        self.ninja.build("update-apt-lockfiles", "phony",
-                         inputs=list(self.lockfile_rules))
+        # Lockfiles that share apt sources are updated together so the aptly
+        # mirrors are only created once.
+        rules = []
+        for _, group in sorted(self.lockfile_groups.items()):
+            if len(group) == 1:
+                rules.append("update-lockfile-%s" % group[0][0])
+            else:
+                rules += update_lockfile_group.build(
+                    self.ninja, specs=" ".join(
+                        pipes.quote(spec) for _, spec in sorted(group)))
+        self.ninja.build("update-apt-lockfiles", "phony", inputs=rules)
+
+        for target, gc_args in [("gc", ""), ("gc-dry-run", "--dry-run")]:
+            ostree_gc.build(self.ninja, outputs=[target],
+                            keep_images=self.keep_images, gc_args=gc_args,
+                            ninja_file=self.ninja.ninjafile)
+        build_times.build(self.ninja, outputs=["build-times"],
+                          ninja_file=self.ninja.ninjafile)
+
+        manifests = [image.stage_1.manifest for _, image in self.images]
+        reports = []
+        for lockfile, image in self.images:
+            report = lockfile.replace('/', '_')
+            text = "_build/size-report/%s.txt" % report
+            reports += image_size_report.build(
+                self.ninja, branch=image.ref, report=report,
+                manifest=image.stage_1.manifest, text=text,
+                implicit_outputs=[text],
+                others=" ".join(x for x in manifests
+                                if x != image.stage_1.manifest),
+                implicit=[x for x in manifests
+                          if x != image.stage_1.manifest])
+            self.ninja.build("size-report-%s" % lockfile, "phony",
+                             inputs=reports[-1])
+        self.ninja.build("size-reports", "phony", inputs=reports)
 
     def build_image(self, lockfile, packages, apt_sources, unpack_only=False,
-                    usrmove=False, resolve_deps=True):
+                    usrmove=False, resolve_deps=True, configured_base=None):
+        """configured_base is an image returned by another call to
+        `build_image`.  If its lockfile is a subset of this one we start
+        configuring from it rather than from scratch.  See `seed.py`."""
         self.generate_lockfile(lockfile, packages, apt_sources, resolve_deps)
         stage_1 = self.image_from_lockfile(
             lockfile, apt_sources[0].architecture, usrmove)
@@ -408,7 +596,8 @@ class Apt(object):
         if unpack_only:
             out = stage_1
         else:
-            stage_2 = self.second_stage(stage_1, apt_sources[0].architecture)
+            stage_2 = self.second_stage(stage_1, apt_sources[0].architecture,
+                                        base=configured_base)
             assert "unpacked" in stage_1.ref
             complete = ostree_combine.build(
                 self.ninja,
@@ -417,15 +606,29 @@ class Apt(object):
             self.ninja.build(
                 "image-for-%s" % lockfile, "phony", inputs=complete.filename)
             out = complete
+            out.configured = stage_2
         out.stage_1 = stage_1
         out.sources_lists = sources_lists
+        self.images.append((lockfile, out))
         return out
 
-    def second_stage(self, unpacked, architecture, branch=None):
+    def second_stage(self, unpacked, architecture, branch=None, base=None):
+        """base is an image returned by `build_image` to seed this one from.
+        `ninja check-seeded-<branch>` compares the result with configuring
+        from scratch."""
         if branch is None:
             assert "unpacked" in unpacked.ref
             branch = unpacked.ref.replace("unpacked", "configured")
         order_only = []
+        in_branch = unpacked.ref
+        if base is not None:
+            in_branch = dpkg_seed.build(
+                self.ninja, in_branch=unpacked.ref, out_branch=branch + "-seed",
+                base_branch=base.configured.ref,
+                base_manifest=base.stage_1.manifest,
+                manifest=unpacked.manifest, status=unpacked.status,
+                available=unpacked.available,
+                seed_args="--usrmove" if unpacked.usrmove else "").ref
 
         def deb2qemu_arch(arch):
             d = {
@@ -466,10 +669,33 @@ class Apt(object):
 
         configured_ref = dpkg_configure.build(
             self.ninja,
-            in_branch=unpacked.ref,
+            in_branch=in_branch,
             out_branch=branch,
             order_only=order_only,
             binfmt_misc_support=binfmt_misc_support)
+        if base is not None:
+            full = dpkg_configure.build(
+                self.ninja,
+                in_branch=unpacked.ref,
+                out_branch=branch + "-full",
+                order_only=order_only,
+                binfmt_misc_support=binfmt_misc_support)
+            self.ninja.build(
+                "check-seeded-%s" % branch, "phony",
+                inputs=ostree_assert_same.build(
+                    self.ninja, a=branch, b=full.ref))
+        if self.dpkg_configure_mode == "fast":
+            slow = dpkg_configure.build(
+                self.ninja,
+                in_branch=in_branch,
+                out_branch=branch + "-slow",
+                order_only=order_only,
+                binfmt_misc_support=binfmt_misc_support,
+                dpkg_configure_mode="slow")
+            self.ninja.build(
+                "check-configure-%s" % branch, "phony",
+                inputs=ostree_assert_same.build(
+                    self.ninja, a=branch, b=slow.ref))
         return configured_ref
 
     def generate_lockfile(self, lockfile, packages, apt_sources,
@@ -485,15 +711,18 @@ class Apt(object):
         # calls for us.
         mirrors = []
         gen_mirror_cmds = []
+        sources = []
         all_keyring_args = set()
+        keyrings = set()
         s = hashlib.sha256()
         for n, src in enumerate(apt_sources):
             mirrors.append("mirror-%i" % n)
             self.archive_urls.add(src.archive_url)
             s.update(repr(apt_sources).encode('utf-8'))
-            keyring_arg = [
-                "-keyring=" + x.replace("$apt2ostreedir", this_dir_rel)
-                for x in src.keyrings]
+            src_keyrings = [x.replace("$apt2ostreedir", this_dir_rel)
+                            for x in src.keyrings]
+            keyrings.update(src_keyrings)
+            keyring_arg = ["-keyring=" + x for x in src_keyrings]
             all_keyring_args = all_keyring_args.union(keyring_arg)
             cmd = [
                 "aptly", "mirror", "create",
@@ -502,29 +731,39 @@ class Apt(object):
                 "mirror-%i" % n, src.archive_url,
                 src.distribution] + src.components.split()
             gen_mirror_cmds.append(" ".join(pipes.quote(x) for x in cmd))
+            sources.append([src.archive_url, src.distribution,
+                            src.architecture, src.components.split()])
 
         create_mirrors = "_build/apt/lockfile/create_mirrors-%s" % (
             s.hexdigest()[:7])
-        mkdir_p(os.path.dirname(create_mirrors))
-        with self.ninja.open(create_mirrors, "w") as f:
-            f.write("#!/bin/sh -ex\n")
-            for x in gen_mirror_cmds:
-                f.write(x + "\n")
-            os.fchmod(f.fileno(), 0o755)
+        self.ninja.write_file(
+            create_mirrors,
+            "#!/bin/sh -ex\n" + "".join(x + "\n" for x in gen_mirror_cmds),
+            mode=0o755)
 
         if not resolve_deps:
             all_keyring_args = all_keyring_args.union([
                 "-solver=no-deps", "-include-essential=false",
                 "-include-priority-required=false"])
 
-        out = update_lockfile.build(
-            self.ninja,
-            lockfile=lockfile,
-            packages=packages,
-            create_mirrors=create_mirrors,
-            mirrors=",".join(mirrors),
-            architecture=apt_sources[0].architecture,
-            keyring_arg=" ".join(all_keyring_args))
+        digest = hashlib.sha256(lockfile.encode('utf-8')).hexdigest()[:7]
+        spec = "_build/apt/lockfile/lockfile-%s.json" % digest
+        self.ninja.write_file(spec, json.dumps({
+                "lockfile": lockfile,
+                "packages": packages,
+                "create_mirrors": create_mirrors,
+                "mirrors": mirrors,
+                "architecture": apt_sources[0].architecture,
+                "aptly_args": sorted(all_keyring_args),
+                "keyrings": sorted(keyrings),
+                "resolver": self.resolver,
+                "sources": sources,
+                "state": "_build/apt/lockfile/lockfile-%s.state" % digest,
+            }, indent=1, sort_keys=True))
+        self.lockfile_groups.setdefault(create_mirrors, []).append(
+            (lockfile, spec))
+
+        out = update_lockfile.build(self.ninja, lockfile=lockfile, spec=spec)
         self.lockfile_rules.update(out)
         return lockfile
 
@@ -533,78 +772,165 @@ class Apt(object):
             architecture = "amd64"
         base = dpkg_base.build(self.ninja, architecture=architecture)
 
+        # Everything that depends on the contents of the lockfile is written
+        # to ninja fragments.  When the lockfile changes ninja regenerates just
+        # those rather than rerunning configure for every image.  The per-deb
+        # edges are shared between images so they go in `self.debs`.
+        digest = lockfile.replace('/', '_')
+        fragment = self.ninja.fragment(
+            "%s/apt/fragments/%s.ninja" % (self.ninja.builddir, digest))
+
         all_data = []
         all_info = []
-        all_status = []
-        all_available = []
-
-        with self.ninja.open('_build/deb_pool_mirrors', 'w') as f:
-            for x in self.deb_pool_mirrors:
-                f.write(x + "\n")
-            for x in self.archive_urls:
-                f.write(x + "\n")
-
+        all_controls = []
+        all_names = []
+        manifest = []
+        # The stanzas of var/lib/dpkg/status and available, built from the
+        # lockfile.  The fields of each deb's control file are merged in at
+        # build time by `dpkg_merge_control`:
+        status = []
+        available = []
+
+        self.ninja.write_file('_build/deb_pool_mirrors', "".join(
+            x + "\n" for x in list(self.deb_pool_mirrors) +
+            sorted(self.archive_urls)))
+
+        # The debs of the lockfile are also written to a list that the per-deb
+        # edges in `self.debs` are generated from.  That way a change to one
+        # lockfile doesn't mean parsing all of them again to regenerate
+        # `self.debs`.
+        debs_list = "%s/apt/fragments/%s.debs" % (self.ninja.builddir, digest)
+        packages = []
         try:
-            with self.ninja.open(lockfile) as f:
-                for pkg in parse_packages(f):
-                    filename = unquote(pkg['Filename'])
-                    aptly_pool_filename = "%s/%s/%s_%s" % (
-                        pkg['SHA256'][:2], pkg['SHA256'][2:4],
-                        pkg['SHA256'][4:], os.path.basename(filename))
-                    ref_base = ("deb/pool/" + aptly_pool_filename
-                                .replace('+', '_').replace('~', '_'))
-                    data, _ = download_deb.build(
-                        self.ninja, sha256sum=pkg['SHA256'], filename=filename,
-                        aptly_pool_filename=aptly_pool_filename,
-                        ref_base=ref_base)
-                    if usrmove:
-                        data = do_usrmove.build(
-                            self.ninja,
-                            in_branch=data.ref,
-                            out_branch=data.ref + '-usrmove')
-                    data = self.fix_package(
-                        pkg['Package'], pkg['Version'], data)
-                    all_data.append(data.filename)
-                    status, available, info = make_dpkg_info.build(
-                        self.ninja, sha256sum=pkg['SHA256'],
-                        pkgname=pkg['Package'], ref_base=ref_base)
-                    all_status.append(status)
-                    all_available.append(available)
-                    all_info.append(info.filename)
+            with open(lockfile, 'rb') as f:
+                if fragment.enabled:
+                    with profiling.timer(self.ninja.profiler,
+                                         "Lockfile index"):
+                        index = Lockfile(f)
+                    packages = list(profiling.iterate(
+                        self.ninja.profiler, "Lockfile entries", index))
+            fragment.add_dep(lockfile)
         except IOError as e:
             # lockfile hasn't been created yet.  Presumably it will be created
             # by running `ninja update-apt-lockfiles` soon so this isn't a fatal
-            # error.
+            # error.  The mtime of the containing directory will be updated
+            # when the file is created so we depend on that instead.
             if e.errno != errno.ENOENT:
                 raise
-
-        digest = lockfile.replace('/', '_')
-
-        rootfs = ostree_combine.build(
-            self.ninja, inputs=all_data,
-            branch="deb/images/%s/data_combined" % digest)
-        dpkg_infos = ostree_combine.build(
-            self.ninja, inputs=all_info,
-            branch="deb/images/%s/info_combined" % digest)
-
+            fragment.add_dep(os.path.dirname(lockfile) or '.')
+        if fragment.enabled:
+            debs = [DebEntry(pkg.package, pkg.version,
+                             pkg.get("Architecture", "-"), pkg.sha256,
+                             pkg.filename, multi_arch_suffix(pkg))
+                    for pkg in packages]
+        elif self.debs.enabled:
+            debs = read_debs_list(debs_list)
+        else:
+            debs = []
+        fragment.write_file(debs_list, format_debs_list(debs))
+        self.debs.add_dep(debs_list)
+
+        for n, deb in enumerate(debs):
+            filename = unquote(deb.filename)
+            aptly_pool_filename, ref_base = deb_pool_paths(deb)
+            data, _ = download_deb.build(
+                self.debs, sha256sum=deb.sha256, filename=filename,
+                aptly_pool_filename=aptly_pool_filename,
+                ref_base=ref_base)
+            data = self.fix_package(deb.package, deb.version, data)
+            all_data.append(data.filename)
+            info, control = make_dpkg_info.build(
+                self.debs, sha256sum=deb.sha256,
+                pkgname=deb.package, ref_base=ref_base,
+                multi_arch_suffix=deb.multi_arch_suffix)
+            all_info.append(info.filename)
+            all_controls.append(control)
+            all_names.append(deb.package)
+            manifest.append("%s %s %s %s %s %s\n" % (
+                deb.package, deb.version, deb.architecture, deb.sha256,
+                data.ref, info.ref))
+            if fragment.enabled:
+                control = dpkg_control(packages[n])
+                status.append(control + "Status: install ok unpacked\n\n")
+                available.append(control + "\n")
+
+        rootfs = self._combine(
+            fragment, all_data, all_names,
+            "deb/images/%s/data_combined" % digest)
+        dpkg_infos = self._combine(
+            fragment, all_info, all_names,
+            "deb/images/%s/info_combined" % digest)
+        if self.incremental:
+            checks = []
+            for combined, inputs in ((rootfs, all_data),
+                                     (dpkg_infos, all_info)):
+                scratch = self._combine_tree(
+                    fragment, inputs, all_names,
+                    combined.ref + "-from-scratch")
+                checks += ostree_assert_same.build(
+                    fragment, a=combined.ref, b=scratch.ref)
+            fragment.build("check-incremental-%s" % lockfile, "phony",
+                           inputs=checks)
+        if usrmove:
+            rootfs = do_usrmove.build(
+                fragment, in_branch=rootfs.ref,
+                out_branch=rootfs.ref + "-usrmove")
+
+        controls_filename = "%s/apt/fragments/%s.controls" % (
+            self.ninja.builddir, digest)
+        fragment.write_file(controls_filename,
+                            "".join(x + "\n" for x in all_controls))
+        meta = {}
+        for name, stanzas in (("status", status), ("available", available)):
+            filename = "%s/apt/fragments/%s.%s" % (
+                self.ninja.builddir, digest, name)
+            fragment.write_file(filename, "".join(stanzas))
+            meta[name] = dpkg_merge_control.build(
+                fragment, inputs=[filename],
+                implicit=[controls_filename] + all_controls,
+                controls=controls_filename, pkgs_digest=digest, meta=name)[0]
         dpkg_status = deb_combine_meta.build(
-            self.ninja, inputs=all_status,
+            fragment, inputs=[meta["status"]],
             pkgs_digest=digest, meta="status")
-
         dpkg_available = deb_combine_meta.build(
-            self.ninja, inputs=all_available,
+            fragment, inputs=[meta["available"]],
             pkgs_digest=digest, meta="available")
 
         image = ostree_combine.build(
-            self.ninja,
+            fragment,
             inputs=[base.filename, dpkg_infos.filename, dpkg_status.filename,
                     dpkg_available.filename, rootfs.filename],
             implicit=lockfile,
             branch="deb/images/%s/unpacked" % digest)
-        self.ninja.build("unpacked-image-for-%s" % lockfile,
-                         "phony", inputs=image.filename)
+        fragment.build("unpacked-image-for-%s" % lockfile,
+                       "phony", inputs=image.filename)
+
+        # For `second_stage` to seed one image from another.  See `seed.py`.
+        image.manifest = "%s/apt/fragments/%s.manifest" % (
+            self.ninja.builddir, digest)
+        fragment.write_file(image.manifest, "".join(manifest))
+        image.status = meta["status"]
+        image.available = meta["available"]
+        image.usrmove = usrmove
         return image
 
+    def _combine(self, fragment, inputs, names, branch):
+        if not self.incremental:
+            return self._combine_tree(fragment, inputs, names, branch)
+        inputs_file = "%s/apt/fragments/%s.inputs" % (
+            self.ninja.builddir, branch.replace('/', '_'))
+        fragment.write_file(inputs_file, "".join(
+            OstreeRef(x).ref + "\n" for x in inputs))
+        return ostree_combine_incremental.build(
+            fragment, implicit=inputs, branch=branch,
+            inputs_file=inputs_file)
+
+    def _combine_tree(self, fragment, inputs, names, branch):
+        # Intermediate commits are shared between images, like the debs:
+        return ostree_combine_tree(
+            fragment, inputs, keys=names, fanout=self.combine_fanout,
+            nodes_ninja=self.debs, branch=branch)
+
     def fix_package(self, pkgname, version, data):
         """
         Here we can apply quirks as required to get particular packages to
@@ -622,14 +948,14 @@ class Apt(object):
             #
             # See also https://salsa.debian.org/python-team/applications/pylint/commit/28d9e9231f58ef9a1debeb4ae34f4d7441c36a67
             return ostree_addfile.build(
-                self.ninja, in_branch=data.ref,
+                self.debs, in_branch=data.ref,
                 prefix="/usr/share/python/bcep",
                 in_file=_find_file("quirks/pylint/pylint.bcep"),
                 out_branch=data.ref + "-fixed")
         elif pkgname == "apt" and version == "2.0.8":
             # https://bugs.launchpad.net/ubuntu/+source/apt/+bug/1968154/comments/16
             return ostree_addfile.build(
-                self.ninja, in_branch=data.ref,
+                self.debs, in_branch=data.ref,
                 prefix="/etc/kernel/postinst.d",
                 in_file=_find_file("quirks/apt/apt-auto-removal"),
                 out_branch=data.ref + "-fixed")
@@ -637,7 +963,7 @@ class Apt(object):
             # Disable usrmerge.postinst, as we have done usrmove ourselves and
             # for some reason the usrmerge.postinst script fails to detect this.
             return ostree_addfile.build(
-                self.ninja, in_branch=data.ref,
+                self.debs, in_branch=data.ref,
                 prefix="/var/lib/dpkg/info",
                 in_file=_find_file("quirks/usrmerge/usrmerge.postinst"),
                 out_branch=data.ref + "-fixed")
@@ -645,6 +971,36 @@ class Apt(object):
             return data
 
 
+# What the per-deb edges need to know about each entry of a lockfile.  See
+# `Apt.image_from_lockfile`.
+DebEntry = namedtuple(
+    "DebEntry",
+    "package version architecture sha256 filename multi_arch_suffix")
+
+
+def format_debs_list(debs):
+    return "".join("%s %s %s %s %s %s\n" % (
+        x.package, x.version, x.architecture, x.sha256, x.filename,
+        x.multi_arch_suffix or "-") for x in debs)
+
+
+def read_debs_list(filename):
+    """Reads the list written by `format_debs_list`.  Returns a list of
+    `DebEntry`"""
+    out = []
+    try:
+        with open(filename) as f:
+            for line in f:
+                fields = line.split()
+                if fields[5] == "-":
+                    fields[5] = ""
+                out.append(DebEntry(*fields))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return out
+
+
 def parse_packages(stream):
     """Parses an apt Packages file"""
     pkg = {}
@@ -658,13 +1014,58 @@ def parse_packages(stream):
             continue
         elif line == ' .':
             pkg[label] += '\n\n'
-        elif line.startswith(" "):
+        elif line.startswith((" ", "\t")):
             pkg[label] += '\n' + line[1:].strip()
         else:
             label, data = line.split(': ', 1)
             pkg[label] = data.strip()
 
 
+# Fields that apt adds to the Packages index but that aren't in the control file
+# of the deb itself.  These don't belong in var/lib/dpkg/status.  In lower case,
+# as field names are case-insensitive.
+INDEX_ONLY_FIELDS = frozenset([
+    "filename", "size", "md5sum", "sha1", "sha256", "sha512",
+    "description-md5", "task", "tag", "supported",
+    "phased-update-percentage"])
+
+
+def dpkg_control(entry):
+    """The control file of the package described by the lockfile `Entry`,
+    recreated from its stanza.  This only has the fields that are in the
+    lockfile: `aptly lockfile create` keeps just those needed to resolve
+    dependencies.  The rest, like Description, Essential and Installed-Size,
+    are merged in from the deb's own control file by `dpkg_merge_control`."""
+    out = []
+    keep = True
+    for line in entry.raw().split("\n"):
+        if line[:1] not in (" ", "\t"):
+            keep = line.split(":", 1)[0].lower() not in INDEX_ONLY_FIELDS
+        if keep:
+            out.append(line + "\n")
+    return "".join(out)
+
+
+def deb_pool_paths(entry):
+    """Returns (aptly_pool_filename, ref_base) for the deb of a lockfile
+    entry.  The deb is imported to ostree as $ref_base/data and
+    $ref_base/control."""
+    aptly_pool_filename = "%s/%s/%s_%s" % (
+        entry.sha256[:2], entry.sha256[2:4], entry.sha256[4:],
+        os.path.basename(unquote(entry.filename)))
+    ref_base = ("deb/pool/" + aptly_pool_filename
+                .replace('+', '_').replace('~', '_'))
+    return aptly_pool_filename, ref_base
+
+
+def multi_arch_suffix(entry):
+    """dpkg names the files under var/lib/dpkg/info after the package name
+    qualified with its architecture if the package is Multi-Arch: same"""
+    if entry.get("Multi-Arch") == "same":
+        return ":" + entry["Architecture"]
+    return ""
+
+
 def mkdir_p(d):
     """Python 3.2 has an optional argument to os.makedirs called exist_ok.  To
     support older versions of python we can't use this and need to catch
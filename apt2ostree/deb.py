@@ -0,0 +1,423 @@
+#!/usr/bin/python
+
+"""
+Imports debs into ostree without writing anything but the deb itself to disk.
+
+A deb is an `ar` archive containing `control.tar.*` and `data.tar.*`.  Rather
+than `ar x` followed by decompressing each member to a temporary file we read
+the archive as a stream and pipe each member, through a decompressor if ostree
+can't handle it itself, straight into `ostree commit --tree=tar=/dev/stdin`.
+The deb is streamed from the fetch service (see `fetch.py`) so it only touches
+disk when we're mirroring or caching it (see `deb_cache.py`).
+
+The commits are made without `-b`.  The refs are only written once we've
+checked the SHA256 of the whole deb, so a bad download never ends up as a ref.
+"""
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+
+from .deb_cache import DebCache, load_config, parse_size
+from .fetch import (ChecksumError, Fetcher, FetchError, WriteError,
+                    candidate_urls, fetch_via_service, read_mirrors,
+                    stream_via_service)
+from .mirror_health import MirrorHealth
+from .ninja import write_if_changed
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+CHUNK_SIZE = 64 * 1024
+
+# libarchive, as used by `ostree commit --tree=tar=`, handles gzip and xz
+# itself.  Older versions don't know about zstd.
+DECOMPRESSORS = {
+    ".zst": ["zstd", "--decompress", "--stdout"],
+}
+
+
+class DebError(Exception):
+    pass
+
+
+class ArReader(object):
+    """Reads the members of an `ar` archive from a file object in order,
+    without seeking"""
+
+    def __init__(self, f):
+        self.f = f
+        if self._read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebError("Not an ar archive")
+
+    def __iter__(self):
+        while True:
+            header = self.f.read(AR_HEADER_SIZE)
+            if not header:
+                return
+            if len(header) < AR_HEADER_SIZE or header[58:60] != b"`\n":
+                raise DebError("Bad ar member header")
+            # GNU ar terminates names with "/"
+            name = header[0:16].decode("ascii").rstrip(" ").rstrip("/")
+            size = int(header[48:58].decode("ascii"))
+            member = ArMember(self, name, size)
+            yield member
+            member.skip()
+            if size % 2:
+                self._read(1)
+
+    def _read(self, size):
+        data = self.f.read(size)
+        if len(data) != size:
+            raise DebError("Truncated ar archive")
+        return data
+
+
+class ArMember(object):
+    def __init__(self, archive, name, size):
+        self.archive = archive
+        self.name = name
+        self.size = size
+        self.remaining = size
+
+    def read(self, size=CHUNK_SIZE):
+        size = min(size, self.remaining)
+        if size == 0:
+            return b""
+        data = self.archive.f.read(size)
+        if not data:
+            raise DebError("Truncated ar archive")
+        self.remaining -= len(data)
+        return data
+
+    def skip(self):
+        while self.read():
+            pass
+
+
+def commit_tar(repo, member, subject):
+    """Commits the tarball member to repo without updating any refs.  Returns
+    the commit checksum."""
+    cmd = ["ostree", "--repo=%s" % repo, "commit", "--tree=tar=/dev/stdin",
+           "--no-bindings", "--orphan", "--timestamp=0", "-s", subject]
+    pipeline = [cmd]
+    for ext, decompress in DECOMPRESSORS.items():
+        if member.name.endswith(ext):
+            pipeline.insert(0, decompress)
+            break
+    procs = []
+    stdin = subprocess.PIPE
+    for x in pipeline:
+        procs.append(subprocess.Popen(x, stdin=stdin, stdout=subprocess.PIPE))
+        if stdin != subprocess.PIPE:
+            stdin.close()
+        stdin = procs[-1].stdout
+
+    try:
+        while True:
+            data = member.read()
+            if not data:
+                break
+            procs[0].stdin.write(data)
+        procs[0].stdin.close()
+    except EnvironmentError:
+        # ostree or the decompressor has died.  We'll report its exit status
+        # below.
+        pass
+    checksum = procs[-1].stdout.read().decode("ascii").strip()
+    procs[-1].stdout.close()
+    for x, p in zip(pipeline, procs):
+        if p.wait() != 0:
+            raise DebError("%s failed with exit status %i" % (
+                x[0], p.returncode))
+    return checksum
+
+
+def import_deb(f, repo, subject):
+    """Commits the control and data members of the deb read from file object
+    f.  Returns a dict {"control": checksum, "data": checksum}."""
+    out = {}
+    for member in ArReader(f):
+        for kind in ("control", "data"):
+            if member.name.startswith(kind + ".tar"):
+                out[kind] = commit_tar(repo, member, "%s %s" % (subject, kind))
+    for kind in ("control", "data"):
+        if kind not in out:
+            raise DebError("deb has no %s.tar member" % kind)
+    return out
+
+
+def set_ref(repo, ref, checksum):
+    """Equivalent to `ostree refs --create`, but leaves the ref file alone if
+    it's already correct so ninja's restat works"""
+    write_if_changed("%s/refs/heads/%s" % (repo, ref), checksum + "\n")
+
+
+class _Sink(object):
+    """Where the producer thread puts the deb: into the pipe that `import_deb`
+    reads from and into any copies we're keeping"""
+    def __init__(self, pipe, copies):
+        self.pipe = pipe
+        self.copies = copies
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.sha.update(data)
+        for copy in self.copies:
+            copy.write(data)
+        self.pipe.write(data)
+
+
+class _PartFile(object):
+    """Writes to filename + ".part", renamed to filename by `commit`"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename + ".part", "wb")
+
+    def write(self, data):
+        self.f.write(data)
+
+    def commit(self):
+        self.f.close()
+        os.rename(self.filename + ".part", self.filename)
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.filename + ".part")
+
+
+def _import_stream(produce, sha256, repo, subject, copies=()):
+    """Imports the deb that produce(write) writes, in another thread.  Returns
+    the commits made by `import_deb`.  copies are committed if the deb has the
+    right SHA256 and aborted otherwise."""
+    r, w = os.pipe()
+    reader = os.fdopen(r, "rb")
+    writer = os.fdopen(w, "wb")
+    sink = _Sink(writer, copies)
+    errors = []
+
+    def run():
+        try:
+            produce(sink.write)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+        finally:
+            try:
+                writer.close()
+            except EnvironmentError:
+                pass
+
+    t = threading.Thread(target=run)
+    t.start()
+    ok = False
+    try:
+        try:
+            try:
+                commits = import_deb(reader, repo, subject)
+            finally:
+                # Make sure we see the whole deb before checking its SHA256.
+                # If the deb was broken this lets the producer tell us whether
+                # it was given the wrong data.
+                try:
+                    while reader.read(CHUNK_SIZE):
+                        pass
+                finally:
+                    reader.close()
+                    t.join()
+        except DebError:
+            # A failed download looks like a truncated deb.  The download
+            # error is more useful:
+            for e in errors:
+                if not isinstance(e, WriteError):
+                    raise e
+            raise
+        if errors:
+            raise errors[0]
+        if sink.sha.hexdigest() != sha256:
+            raise FetchError("SHA256 %s doesn't match %s" % (
+                sink.sha.hexdigest(), sha256))
+        ok = True
+    finally:
+        for copy in copies:
+            if ok:
+                copy.commit()
+            else:
+                copy.abort()
+    return commits
+
+
+def _download(urls, sha256, write, socket, mirrors, health_filename):
+    """Returns the URL the deb was downloaded from"""
+    url = socket and stream_via_service(
+        socket, urls, sha256, write, mirrors, health_filename)
+    if url:
+        return url
+    fetcher = Fetcher(health=health_filename and MirrorHealth(health_filename))
+    try:
+        return fetcher.stream(urls, sha256, write, mirrors)
+    finally:
+        fetcher.close()
+        if fetcher.health:
+            fetcher.health.save()
+
+
+def _read_file(filename, write):
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            write(data)
+
+
+def _sha256_file(filename):
+    sha = hashlib.sha256()
+    _read_file(filename, sha.update)
+    return sha.hexdigest()
+
+
+def _import_cached(cache, sha256, repo, subject):
+    """Imports the deb from cache.  Returns None if it isn't there or we can't
+    read it, in which case we'll download it instead."""
+    try:
+        cached = cache.get(sha256)
+        if not cached:
+            return None
+        try:
+            return _import_stream(
+                lambda write: _read_file(cached, write), sha256, repo, subject)
+        except (FetchError, DebError):
+            if _sha256_file(cached) == sha256:
+                raise
+            # Corrupt.  We'll download it again.
+            cache.discard(sha256)
+    except EnvironmentError:
+        # Evicted by another workspace while we were reading it, or we don't
+        # have permission
+        pass
+    return None
+
+
+def _cache_writer(cache, sha256):
+    try:
+        return cache.writer(sha256)
+    except EnvironmentError:
+        # The cache directory is full or isn't writable by us
+        return None
+
+
+def _download_file(urls, sha256, dest, socket, mirrors, health_filename):
+    if socket and fetch_via_service(
+            socket, urls, sha256, dest, mirrors, health_filename):
+        return
+    fetcher = Fetcher(health=health_filename and MirrorHealth(health_filename))
+    try:
+        fetcher.fetch(urls, sha256, dest, mirrors)
+    finally:
+        fetcher.close()
+        if fetcher.health:
+            fetcher.health.save()
+
+
+def download_and_import(urls, sha256, repo, ref_base, subject, socket=None,
+                        mirror_to=None, mirrors=(), health_filename=None,
+                        cache=None):
+    """Imports the deb into ostree, from cache (a `deb_cache.DebCache`) if
+    it's there and otherwise from urls.  The cache is only an optimisation so
+    if it doesn't work we carry on without it."""
+    commits = cache and _import_cached(cache, sha256, repo, subject)
+
+    urls = list(urls)
+    mirrored = False
+    while commits is None:
+        writer = cache and _cache_writer(cache, sha256)
+        mirrored = bool(mirror_to and not writer)
+        if writer:
+            copies = [writer]
+        elif mirror_to:
+            copies = [_PartFile(mirror_to)]
+        else:
+            copies = []
+        try:
+            commits = _import_stream(
+                lambda write: _download(urls, sha256, write, socket, mirrors,
+                                        health_filename),
+                sha256, repo, subject, copies)
+        except ChecksumError as e:
+            # Out of sync mirrors sometimes serve a rebuilt deb under the same
+            # filename.  The other mirrors may still have the one we want.
+            remaining = [x for x in urls if x != e.url]
+            if not remaining or len(remaining) == len(urls):
+                raise
+            urls = remaining
+
+    if mirror_to and not mirrored:
+        try:
+            ok = cache and cache.retrieve(sha256, mirror_to)
+        except EnvironmentError:
+            ok = False
+        if not ok:
+            # It didn't make it into the cache after all
+            _download_file(urls, sha256, mirror_to, socket, mirrors,
+                           health_filename)
+    for kind, checksum in sorted(commits.items()):
+        set_ref(repo, "%s/%s" % (ref_base, kind), checksum)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Download debs and import them into ostree")
+    subparsers = parser.add_subparsers(dest="command")
+    imp = subparsers.add_parser(
+        "import", help="Commit the control and data of a deb to "
+        "REF_BASE/control and REF_BASE/data")
+    imp.add_argument("--repo", required=True)
+    imp.add_argument("--ref-base", required=True)
+    imp.add_argument("--subject", required=True)
+    imp.add_argument("--sha256", required=True)
+    imp.add_argument("--mirrors", help="File listing mirror base URLs.  "
+                     "Relative paths are tried against each of them.")
+    imp.add_argument("--socket",
+                     help="Download via the fetch service on this socket")
+    imp.add_argument("--mirror-health",
+                     help="Rank mirrors using this cache of their health")
+    imp.add_argument("--mirror-to", help="Keep a copy of the deb here")
+    imp.add_argument("--cache-config",
+                     help="Use the deb cache configured in this file.  See "
+                     "`deb_cache.write_config`.")
+    imp.add_argument("url", nargs="+")
+
+    evict = subparsers.add_parser(
+        "evict-cache", help="Delete least recently used debs from the cache")
+    evict.add_argument("--max-size", required=True,
+                       help="In bytes, or with a suffix K, M, G or T")
+    evict.add_argument("directory")
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "evict-cache":
+        freed = DebCache(args.directory).evict(parse_size(args.max_size))
+        sys.stdout.write("Freed %i bytes\n" % freed)
+        return 0
+    elif args.command != "import":
+        parser.error("Missing command")
+
+    if args.mirror_to and not os.path.isdir(os.path.dirname(args.mirror_to)):
+        os.makedirs(os.path.dirname(args.mirror_to))
+    mirrors = read_mirrors(args.mirrors)
+    try:
+        download_and_import(
+            candidate_urls(args.url, mirrors),
+            args.sha256, args.repo, args.ref_base, args.subject,
+            socket=args.socket, mirror_to=args.mirror_to, mirrors=mirrors,
+            health_filename=args.mirror_health,
+            cache=args.cache_config and load_config(args.cache_config))
+    except (FetchError, DebError) as e:
+        sys.stderr.write("Failed to import %s: %s\n" % (args.subject, e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,274 @@
+"""
+A host-wide cache of debs, keyed by their SHA256, that can be shared between
+workspaces and repositories.
+
+With `Apt(deb_cache=...)` or the environment variable `APT2OSTREE_DEB_CACHE`
+`download_deb` looks in the cache before trying any mirror, and adds what it
+downloads.  So a deb fetched by one CI workspace is free for every other
+workspace on the same host.
+
+Entries are written to a temporary file and renamed into place once their
+SHA256 has been checked so readers never see partial debs.  The mtime of an
+entry is updated whenever it's used.  If a maximum size is configured the
+least recently used entries are deleted to stay under it.  The cache is only
+an optimisation: if it can't be read or written we download the deb instead.
+To evict by hand:
+
+    python -m apt2ostree.deb evict-cache --max-size=20G /var/cache/apt2ostree
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+DEB_CACHE_ENV = "APT2OSTREE_DEB_CACHE"
+DEB_CACHE_MAX_SIZE_ENV = "APT2OSTREE_DEB_CACHE_MAX_SIZE"
+
+# How often adding a deb checks whether we need to evict
+EVICT_INTERVAL = 60
+# Temporary files older than this were left behind by imports that were killed
+STALE_TMP_SECONDS = 24 * 60 * 60
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DebCache(object):
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+
+    def filename(self, sha256):
+        return os.path.join(self.directory, "sha256", sha256[:2], sha256)
+
+    def get(self, sha256):
+        """Returns the filename of the cached deb or None.  Counts as a use
+        for the purposes of eviction."""
+        filename = self.filename(sha256)
+        try:
+            os.utime(filename, None)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            elif e.errno not in (errno.EPERM, errno.EACCES):
+                raise
+            # Owned by another user, but we can still read it
+            if not os.path.exists(filename):
+                return None
+        return filename
+
+    def retrieve(self, sha256, dest):
+        """Puts a copy of the cached deb at dest, by hardlink, reflink or copy
+        in that order of preference.  Returns False if it isn't cached."""
+        src = self.get(sha256)
+        if src is None:
+            return False
+        tmp = dest + ".tmp"
+        _unlink(tmp)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            _clone_or_copy(src, tmp)
+        os.rename(tmp, dest)
+        return True
+
+    def discard(self, sha256):
+        """Removes a cached deb, for example if it turns out to be corrupt"""
+        _unlink(self.filename(sha256))
+
+    def writer(self, sha256):
+        """Returns a file-like object to add a deb to the cache.  Call `commit`
+        once all the data has been written."""
+        return _Writer(self, sha256)
+
+    def evict(self, max_size=None):
+        """Deletes the least recently used debs until the cache is no bigger
+        than max_size bytes, and any stale temporary files.  Returns the number
+        of bytes freed."""
+        if max_size is None:
+            max_size = self.max_size
+        with open(self._lockfile(), "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            freed = self._remove_stale_tmp()
+            if max_size is not None:
+                freed += self._evict_lru(max_size)
+            with open(os.path.join(self.directory, "last-evict"), "w"):
+                pass
+        return freed
+
+    def _evict_lru(self, max_size):
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(
+                os.path.join(self.directory, "sha256")):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, filename, st.st_size))
+                total += st.st_size
+        freed = 0
+        for _, filename, size in sorted(entries):
+            if total - freed <= max_size:
+                break
+            _unlink(filename)
+            freed += size
+        return freed
+
+    def _remove_stale_tmp(self):
+        """Removes the temporary files of imports that were killed before
+        they could commit or abort"""
+        tmpdir = os.path.join(self.directory, "tmp")
+        try:
+            names = os.listdir(tmpdir)
+        except OSError:
+            return 0
+        freed = 0
+        now = time.time()
+        for name in names:
+            filename = os.path.join(tmpdir, name)
+            try:
+                st = os.stat(filename)
+                if now - st.st_mtime > STALE_TMP_SECONDS:
+                    _unlink(filename)
+                    freed += st.st_size
+            except OSError:
+                # Another user's, or gone already
+                pass
+        return freed
+
+    def maybe_evict(self):
+        try:
+            last = os.stat(os.path.join(self.directory, "last-evict")).st_mtime
+        except OSError:
+            last = 0
+        if time.time() - last > EVICT_INTERVAL:
+            self.evict()
+
+    def _lockfile(self):
+        return os.path.join(self.directory, "lock")
+
+
+class _Writer(object):
+    """Errors writing to the cache aren't fatal: we just don't add the deb"""
+    def __init__(self, cache, sha256):
+        self.cache = cache
+        self.sha256 = sha256
+        self.sha = hashlib.sha256()
+        tmpdir = os.path.join(cache.directory, "tmp")
+        _makedirs(tmpdir)
+        fd, self.tmp = tempfile.mkstemp(dir=tmpdir, prefix=sha256[:12])
+        self.f = os.fdopen(fd, "wb")
+        self.failed = False
+
+    def write(self, data):
+        self.sha.update(data)
+        if self.failed:
+            return
+        try:
+            self.f.write(data)
+        except EnvironmentError:
+            # Cache disk full, say
+            self.failed = True
+
+    def commit(self):
+        """Adds the deb to the cache if we got the data we expected.  Returns
+        True on success."""
+        if self.failed or self.sha.hexdigest() != self.sha256:
+            self.abort()
+            return False
+        try:
+            self.f.close()
+            os.chmod(self.tmp, 0o644)
+            filename = self.cache.filename(self.sha256)
+            _makedirs(os.path.dirname(filename))
+            os.rename(self.tmp, filename)
+        except EnvironmentError:
+            self.abort()
+            return False
+        try:
+            self.cache.maybe_evict()
+        except EnvironmentError:
+            pass
+        return True
+
+    def abort(self):
+        try:
+            if not self.f.closed:
+                self.f.close()
+            _unlink(self.tmp)
+        except EnvironmentError:
+            pass
+
+
+def _clone_or_copy(src, dest):
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except (IOError, OSError):
+            pass
+        shutil.copyfileobj(s, d, CHUNK_SIZE)
+
+
+def _makedirs(d):
+    try:
+        os.makedirs(d)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def parse_size(text):
+    """Parses sizes like "20G" into bytes"""
+    if text is None or text == "":
+        return None
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_config(directory, max_size):
+    """The contents of the cache configuration file"""
+    return json.dumps({"directory": directory and os.path.abspath(directory),
+                       "max_size": max_size}, sort_keys=True) + "\n"
+
+
+def write_config(filename, directory, max_size):
+    """Writes the cache configuration where `download_deb` will read it"""
+    with open(filename, "w") as f:
+        f.write(format_config(directory, max_size))
+
+
+def load_config(filename):
+    """Returns the `DebCache` configured in filename, or None"""
+    try:
+        with open(filename) as f:
+            config = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    if not config.get("directory"):
+        return None
+    return DebCache(config["directory"], config.get("max_size"))
+
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+"""
+Writes var/lib/dpkg/status or available for an image.
+
+    python -m apt2ostree.dpkg_status --controls=LIST --output=OUT STANZAS
+
+STANZAS is written by configure from the lockfile, one stanza per package.
+Lockfiles only have the fields needed to resolve dependencies so each stanza
+is merged with the control file of the package's deb, which make_dpkg_info
+saves.  LIST gives the control file of each stanza in the same order.  The
+control file's fields come first, followed by any fields only in the stanza
+such as Status.  Field names are compared case-insensitively, as dpkg does.
+
+OUT is only rewritten if it has changed.
+"""
+
+import argparse
+import errno
+import os
+import sys
+
+
+def fields(stanza):
+    """Returns a list of (name, text) of the fields of a stanza, as bytes.
+    text includes the continuation lines and the final newline."""
+    out = []
+    for line in stanza.split(b"\n"):
+        if not line:
+            continue
+        if line[:1] in (b" ", b"\t") and out:
+            out[-1] = (out[-1][0], out[-1][1] + line + b"\n")
+        else:
+            out.append((line.split(b":", 1)[0].strip(), line + b"\n"))
+    return out
+
+
+def merge(stanza, control):
+    """The fields of control followed by those of stanza that aren't in
+    control"""
+    out = fields(control)
+    names = set(name.lower() for name, _ in out)
+    out += [x for x in fields(stanza) if x[0].lower() not in names]
+    return b"".join(text for _, text in out)
+
+
+def stanzas(text):
+    return [x for x in text.split(b"\n\n") if x.strip()]
+
+
+def write_if_changed(filename, contents):
+    try:
+        with open(filename, "rb") as f:
+            if f.read() == contents:
+                return
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    with open(filename + "~", "wb") as f:
+        f.write(contents)
+    os.rename(filename + "~", filename)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Merge lockfile stanzas with the control files of the "
+                    "debs")
+    parser.add_argument("--controls", required=True,
+                        help="File listing the control file of each stanza")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("stanzas")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.stanzas, "rb") as f:
+        entries = stanzas(f.read())
+    with open(args.controls) as f:
+        controls = f.read().split()
+    if len(entries) != len(controls):
+        sys.stderr.write("dpkg_status: %s has %i stanzas but %s lists %i "
+                         "control files\n" % (args.stanzas, len(entries),
+                                              args.controls, len(controls)))
+        return 1
+
+    out = []
+    for stanza, filename in zip(entries, controls):
+        with open(filename, "rb") as f:
+            out.append(merge(stanza, f.read()) + b"\n")
+    write_if_changed(args.output, b"".join(out))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,722 @@
+#!/usr/bin/python
+
+"""
+Downloads debs, checking their SHA256 as they're streamed to disk.
+
+Forking `curl` for each deb means a new TCP and TLS connection for every
+package and then reading the whole file again to check its SHA256.  With
+thousands of debs the connection setup dominates.  `Fetcher` instead keeps a
+pool of keep-alive connections for each host, limits the number of concurrent
+requests to each host, hashes the data while it's being written and resumes
+interrupted downloads with HTTP range requests.
+
+It can be used in-process, as a batch:
+
+    python -m apt2ostree.fetch batch manifest
+
+or from many concurrent ninja edges through a shared fetch service listening
+on a unix socket so the connection pools outlive any one edge:
+
+    python -m apt2ostree.fetch get --socket _build/fetch.sock \\
+        --sha256 <sha256> -o out.deb <url>...
+
+The service is started on demand by the first client and exits once it has
+been idle for a while.
+"""
+
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+if sys.version_info[0] >= 3:
+    import http.client as httplib
+    import socketserver
+    from urllib.parse import urljoin, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+else:
+    import httplib
+    import SocketServer as socketserver
+    from urlparse import urljoin, urlsplit
+    from urllib import getproxies, proxy_bypass
+
+from .mirror_health import MirrorHealth
+
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_IDLE_TIMEOUT = 60
+USER_AGENT = "apt2ostree"
+
+
+class FetchError(Exception):
+    pass
+
+
+class HTTPStatusError(FetchError):
+    def __init__(self, status, reason):
+        super(HTTPStatusError, self).__init__(
+            "HTTP %i %s" % (status, reason))
+        self.status = status
+
+
+class ChecksumError(FetchError):
+    """url served data with the wrong SHA256.  Other mirrors may have the
+    right data"""
+    def __init__(self, url, message):
+        super(ChecksumError, self).__init__(message)
+        self.url = url
+
+
+class WriteError(Exception):
+    """Writing the downloaded data failed"""
+
+
+class Fetcher(object):
+    """Downloads files over http, https and file URLs.  Thread-safe.
+
+    If health (a `mirror_health.MirrorHealth`) is given the URLs are tried
+    best mirror first and we record how each mirror performs.  The `mirrors`
+    passed to `fetch` and `stream` tell us which mirror each URL belongs to.
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST, timeout=60,
+                 health=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.health = health
+        self._lock = threading.Lock()
+        self._idle = {}  # host key -> [connection]
+        self._semaphores = {}  # host key -> BoundedSemaphore
+
+    def fetch(self, urls, sha256, dest, mirrors=()):
+        """Downloads the file with the given SHA256 to dest, trying each of
+        urls in turn.  Returns the URL it was downloaded from.
+
+        Data is written to dest + ".part" first.  If that already exists (say
+        a previous attempt was interrupted) we continue where it left off, even
+        if that means continuing from a different mirror: they're serving the
+        same bytes if they agree on the SHA256."""
+        part = dest + ".part"
+        errors = []
+        resume = True
+        while urls:
+            if resume:
+                sha, offset = _hash_existing(part)
+            else:
+                sha, offset = hashlib.sha256(), 0
+            with open(part, "ab" if resume else "wb") as f:
+                progress = _Progress(sha, offset, f.write)
+                url, sample = self._fetch(urls, progress, errors, mirrors)
+            if url is None:
+                break
+            if sha.hexdigest() == sha256:
+                self._record_success(sample)
+                os.rename(part, dest)
+                return url
+            errors.append("%s: SHA256 %s doesn't match %s" % (
+                url, sha.hexdigest(), sha256))
+            if not (resume and offset):
+                # Otherwise the data we resumed from may have been the bad
+                # part, so we try the same URLs again from the start.  The
+                # URLs are ranked again by `_fetch` so we just drop this one.
+                self._record_bad_data(url, mirrors)
+                urls = [x for x in urls if x != url]
+            resume = False
+        else:
+            # We don't want to resume from data we know to be bad
+            _unlink(part)
+        raise FetchError("Failed to download %s:\n    %s" % (
+            os.path.basename(dest), "\n    ".join(errors)))
+
+    def stream(self, urls, sha256, write, mirrors=()):
+        """Downloads the file with the given SHA256 passing the data to write
+        as it arrives.  If a download fails part-way through it's continued
+        from the next URL.  Returns the URL the download finished from.
+
+        Raises FetchError if the download fails, or ChecksumError if the SHA256
+        doesn't match.  Either way the caller must throw away the data it has
+        been given."""
+        errors = []
+        sha = hashlib.sha256()
+        url, sample = self._fetch(
+            urls, _Progress(sha, 0, write), errors, mirrors)
+        if url is None:
+            raise FetchError("Download failed:\n    %s" % (
+                "\n    ".join(errors)))
+        if sha.hexdigest() != sha256:
+            self._record_bad_data(url, mirrors)
+            raise ChecksumError(url, "%s: SHA256 %s doesn't match %s" % (
+                url, sha.hexdigest(), sha256))
+        self._record_success(sample)
+        return url
+
+    def _record_success(self, sample):
+        if sample:
+            self.health.record_success(*sample)
+
+    def _record_bad_data(self, url, mirrors):
+        """A mirror that serves the wrong bytes is as much use as one that
+        doesn't answer"""
+        mirror = self.health and self.health.mirror_of(url, mirrors)
+        if mirror:
+            self.health.record_failure(mirror)
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def _fetch(self, urls, progress, errors, mirrors):
+        """Tries each of urls in turn until one of them gives us the rest of the
+        file.  Returns that URL, or None if they all failed, and the arguments
+        for `MirrorHealth.record_success`.  We can't tell whether the mirror
+        did well until we've checked the SHA256."""
+        health = self.health
+        if health:
+            urls = health.rank_urls(urls, mirrors)
+        for url in urls:
+            mirror = health and health.mirror_of(url, mirrors)
+            offset = progress.offset
+            start = time.time()
+            try:
+                latency = self._fetch_one(url, progress)
+            except HTTPStatusError as e:
+                # A 404 just means the mirror doesn't have this deb, which
+                # isn't the mirror's fault
+                if mirror and e.status >= 500:
+                    health.record_failure(mirror)
+                errors.append("%s: %s" % (url, e))
+                continue
+            except (EnvironmentError, httplib.HTTPException,
+                    FetchError) as e:
+                if mirror:
+                    health.record_failure(mirror)
+                errors.append("%s: %s" % (url, e))
+                continue
+            sample = None
+            if mirror and latency is not None:
+                sample = (mirror, latency, progress.offset - offset,
+                          time.time() - start - latency)
+            return url, sample
+        return None, None
+
+    def _fetch_one(self, url, progress):
+        """Downloads url from progress.offset onwards.  Returns the time it
+        took the server to start responding, or None for file URLs."""
+        start = time.time()
+        for _ in range(MAX_REDIRECTS + 1):
+            scheme = urlsplit(url).scheme
+            if scheme == "file":
+                with open(urlsplit(url).path, "rb") as f:
+                    f.seek(progress.offset)
+                    _copy(f, progress)
+                return None
+            elif scheme not in ("http", "https"):
+                raise FetchError("Unsupported URL scheme %r" % scheme)
+
+            key = self._host_key(url)
+            with self._semaphore(key):
+                conn, resp = self._request(key, url, progress.offset)
+                latency = time.time() - start
+                try:
+                    if resp.status in (301, 302, 303, 307, 308):
+                        location = resp.getheader("Location")
+                        if not location:
+                            raise FetchError("Redirect without Location")
+                        url = urljoin(url, location)
+                    elif resp.status == 416 and progress.offset:
+                        # We already have the whole file
+                        pass
+                    elif resp.status not in (200, 206):
+                        raise HTTPStatusError(resp.status, resp.reason)
+                    else:
+                        if resp.status == 200 and progress.offset:
+                            # Server ignored our Range header.  Skip the
+                            # part we already have.
+                            _skip(resp, progress.offset)
+                        _copy(resp, progress)
+                        self._release(key, conn, resp)
+                        return latency
+                    resp.read()
+                    self._release(key, conn, resp)
+                    if resp.status == 416:
+                        return latency
+                except Exception:
+                    conn.close()
+                    raise
+        raise FetchError("Too many redirects")
+
+    def _request(self, key, url, offset):
+        """Returns (connection, response).  Retries once with a fresh
+        connection if a pooled keep-alive connection turns out to have been
+        closed by the server."""
+        scheme, host, port, proxy = key
+        u = urlsplit(url)
+        path = u.path or "/"
+        if u.query:
+            path += "?" + u.query
+        if proxy and scheme == "http":
+            path = url
+        headers = {"User-Agent": USER_AGENT}
+        if offset:
+            headers["Range"] = "bytes=%i-" % offset
+        for attempt in (0, 1):
+            conn = self._acquire(key)
+            reused = getattr(conn, "_apt2ostree_reused", False)
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn, conn.getresponse()
+            except (EnvironmentError, httplib.HTTPException):
+                conn.close()
+                if not reused or attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+    def _host_key(self, url):
+        u = urlsplit(url)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        proxy = None
+        if not proxy_bypass(u.hostname):
+            proxy = getproxies().get(u.scheme)
+        return (u.scheme, u.hostname, port, proxy)
+
+    def _semaphore(self, key):
+        with self._lock:
+            sem = self._semaphores.get(key)
+            if sem is None:
+                sem = self._semaphores[key] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return sem
+
+    def _acquire(self, key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+        scheme, host, port, proxy = key
+        cls = httplib.HTTPSConnection if scheme == "https" else \
+            httplib.HTTPConnection
+        if not proxy:
+            return cls(host, port, timeout=self.timeout)
+        p = urlsplit(proxy)
+        if scheme == "https":
+            conn = cls(p.hostname, p.port or 80, timeout=self.timeout)
+            conn.set_tunnel(host, port)
+            return conn
+        # Plain http proxies are sent the absolute URL by `_request`
+        return httplib.HTTPConnection(p.hostname, p.port or 80,
+                                      timeout=self.timeout)
+
+    def _release(self, key, conn, resp):
+        """Return conn to the pool once resp has been read completely"""
+        if resp.will_close:
+            conn.close()
+            return
+        conn._apt2ostree_reused = True  # pylint: disable=protected-access
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def fetch_many(self, jobs, threads=16, mirrors=()):
+        """jobs is a list of (urls, sha256, dest).  Downloads them all
+        concurrently.  Returns a list of error messages, empty on success."""
+        jobs = list(jobs)
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    urls, sha256, dest = jobs.pop(0)
+                try:
+                    self.fetch(urls, sha256, dest, mirrors)
+                except FetchError as e:
+                    with lock:
+                        errors.append(str(e))
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(min(threads, len(jobs)))]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return errors
+
+
+class _Progress(object):
+    """How much of a file we've got so far"""
+    def __init__(self, sha, offset, write):
+        self.sha = sha
+        self.offset = offset
+        self.write = write
+
+    def feed(self, data):
+        self.sha.update(data)
+        try:
+            self.write(data)
+        except EnvironmentError as e:
+            # Trying another mirror isn't going to help with this:
+            raise WriteError(e)
+        self.offset += len(data)
+
+
+def _copy(src, progress):
+    while True:
+        data = src.read(CHUNK_SIZE)
+        if not data:
+            break
+        progress.feed(data)
+
+
+def _skip(src, count):
+    while count:
+        data = src.read(min(count, CHUNK_SIZE))
+        if not data:
+            raise FetchError("Short read")
+        count -= len(data)
+
+
+def _hash_existing(part):
+    sha = hashlib.sha256()
+    offset = 0
+    try:
+        with open(part, "rb") as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                sha.update(data)
+                offset += len(data)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return sha, offset
+
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def candidate_urls(urls, mirrors=()):
+    """Absolute URLs are tried first, then each relative path is tried against
+    each mirror in turn"""
+    out = [x for x in urls if "://" in x]
+    for mirror in mirrors:
+        for path in urls:
+            if "://" not in path:
+                out.append("%s/%s" % (mirror.rstrip("/"), path.lstrip("/")))
+    return out
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.activity(1)
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            try:
+                mirrors = request.get("mirrors", [])
+                if request.get("stream"):
+                    # Each chunk of the file is sent prefixed by its length.
+                    # An empty chunk marks the end of the data.
+                    url = self.server.fetcher.stream(
+                        request["urls"], request["sha256"], self._send_chunk,
+                        mirrors)
+                    self._send_chunk(b"")
+                else:
+                    url = self.server.fetcher.fetch(
+                        request["urls"], request["sha256"], request["dest"],
+                        mirrors)
+                response = {"ok": True, "url": url}
+            except WriteError:
+                # The client has gone away
+                return
+            except FetchError as e:
+                if request.get("stream"):
+                    self._send_chunk(b"")
+                response = {"ok": False, "error": str(e)}
+                if isinstance(e, ChecksumError):
+                    response["bad_url"] = e.url
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+        finally:
+            self.server.activity(-1)
+            if self.server.fetcher.health:
+                self.server.fetcher.health.maybe_save()
+
+    def _send_chunk(self, data):
+        self.wfile.write(struct.pack(">I", len(data)))
+        self.wfile.write(data)
+
+
+class FetchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, fetcher, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        _unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        self.fetcher = fetcher
+        self.idle_timeout = idle_timeout
+        self._active = 0
+        self._last_activity = time.time()
+        self._activity_lock = threading.Lock()
+
+    def activity(self, delta):
+        with self._activity_lock:
+            self._active += delta
+            self._last_activity = time.time()
+
+    def serve_until_idle(self):
+        def watchdog():
+            while True:
+                time.sleep(1)
+                with self._activity_lock:
+                    if (self._active == 0 and time.time() -
+                            self._last_activity > self.idle_timeout):
+                        break
+            self.shutdown()
+        t = threading.Thread(target=watchdog)
+        t.daemon = True
+        t.start()
+        self.serve_forever()
+
+
+def serve(socket_path, max_per_host=DEFAULT_MAX_PER_HOST,
+          idle_timeout=DEFAULT_IDLE_TIMEOUT, health_filename=None):
+    # Only one server per socket.  The lock is held for our lifetime:
+    lock = open(socket_path + ".lock", "a")
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return 0
+        raise
+    fetcher = Fetcher(max_per_host, health=_health(health_filename))
+    server = FetchServer(socket_path, fetcher, idle_timeout)
+    try:
+        server.serve_until_idle()
+    finally:
+        _unlink(socket_path)
+        server.server_close()
+        fetcher.close()
+        if fetcher.health:
+            fetcher.health.save()
+        lock.close()
+    return 0
+
+
+def _connect(socket_path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+
+def _spawn_server(socket_path, health_filename=None):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))
+    cmd = [sys.executable, "-m", "apt2ostree.fetch", "serve",
+           "--socket", socket_path]
+    if health_filename:
+        cmd.append("--mirror-health=%s" % health_filename)
+    with open(os.devnull, "rb") as devnull, \
+            open(socket_path + ".log", "ab") as log:
+        subprocess.Popen(
+            cmd,
+            stdin=devnull, stdout=log, stderr=log, env=env,
+            close_fds=True, preexec_fn=os.setsid)
+
+
+def _connect_or_spawn(socket_path, health_filename):
+    s = _connect(socket_path)
+    if s is None:
+        _spawn_server(socket_path, health_filename)
+        for _ in range(50):
+            time.sleep(0.1)
+            s = _connect(socket_path)
+            if s is not None:
+                break
+    return s
+
+
+def fetch_via_service(socket_path, urls, sha256, dest, mirrors=(),
+                      health_filename=None):
+    """Asks the fetch service listening on socket_path to do the download,
+    starting it if it isn't already running.  Returns False if the service
+    couldn't be reached, so the caller can download it itself."""
+    s = _connect_or_spawn(socket_path, health_filename)
+    if s is None:
+        return False
+    try:
+        s.sendall((json.dumps({
+            "urls": urls, "sha256": sha256, "mirrors": list(mirrors),
+            "dest": os.path.abspath(dest)}) + "\n").encode("utf-8"))
+        f = s.makefile("rb")
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+    if not line:
+        # The service went away mid-request (perhaps it was idle and exiting)
+        return False
+    response = json.loads(line.decode("utf-8"))
+    if not response["ok"]:
+        raise FetchError(response["error"])
+    return True
+
+
+def stream_via_service(socket_path, urls, sha256, write, mirrors=(),
+                       health_filename=None):
+    """Like `Fetcher.stream`, but the download is done by the fetch service.
+    Returns None if the service couldn't be reached before any data was
+    written."""
+    s = _connect_or_spawn(socket_path, health_filename)
+    if s is None:
+        return None
+    try:
+        s.sendall((json.dumps({
+            "urls": urls, "sha256": sha256, "mirrors": list(mirrors),
+            "stream": True}) + "\n").encode("utf-8"))
+        f = s.makefile("rb")
+        started = False
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                if not started:
+                    return None
+                raise FetchError("Fetch service went away")
+            started = True
+            size = struct.unpack(">I", header)[0]
+            if size == 0:
+                break
+            data = f.read(size)
+            if len(data) < size:
+                raise FetchError("Fetch service went away")
+            write(data)
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+    if not line:
+        raise FetchError("Fetch service went away")
+    response = json.loads(line.decode("utf-8"))
+    if not response["ok"]:
+        if "bad_url" in response:
+            raise ChecksumError(response["bad_url"], response["error"])
+        raise FetchError(response["error"])
+    return response["url"]
+
+
+def _health(filename):
+    if not filename:
+        return None
+    return MirrorHealth(filename)
+
+
+def read_mirrors(filename):
+    if not filename:
+        return []
+    with open(filename) as f:
+        return [x.strip() for x in f if x.strip()]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Download files checking their SHA256")
+    subparsers = parser.add_subparsers(dest="command")
+
+    get = subparsers.add_parser("get", help="Download a single file")
+    get.add_argument("-o", "--output", required=True)
+    get.add_argument("--sha256", required=True)
+    get.add_argument("--mirrors", help="File listing mirror base URLs.  "
+                     "Relative paths are tried against each of them.")
+    get.add_argument("--socket",
+                     help="Download via the fetch service on this socket")
+    get.add_argument("--mirror-health",
+                     help="Rank mirrors using this cache of their health")
+    get.add_argument("url", nargs="+")
+
+    batch = subparsers.add_parser(
+        "batch", help="Download many files concurrently.  Each line of the "
+        "manifest is: sha256 output url_or_path...")
+    batch.add_argument("--mirrors")
+    batch.add_argument("--mirror-health")
+    batch.add_argument("-j", "--jobs", type=int, default=16)
+    batch.add_argument("--max-per-host", type=int,
+                       default=DEFAULT_MAX_PER_HOST)
+    batch.add_argument("manifest")
+
+    srv = subparsers.add_parser("serve", help="Run the fetch service")
+    srv.add_argument("--socket", required=True)
+    srv.add_argument("--max-per-host", type=int, default=DEFAULT_MAX_PER_HOST)
+    srv.add_argument("--idle-timeout", type=float,
+                     default=DEFAULT_IDLE_TIMEOUT)
+    srv.add_argument("--mirror-health")
+
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "serve":
+        return serve(args.socket, args.max_per_host, args.idle_timeout,
+                     args.mirror_health)
+    elif args.command == "get":
+        mirrors = read_mirrors(args.mirrors)
+        urls = candidate_urls(args.url, mirrors)
+        try:
+            if args.socket and fetch_via_service(
+                    args.socket, urls, args.sha256, args.output, mirrors,
+                    args.mirror_health):
+                return 0
+            fetcher = Fetcher(health=_health(args.mirror_health))
+            try:
+                fetcher.fetch(urls, args.sha256, args.output, mirrors)
+            finally:
+                fetcher.close()
+                if fetcher.health:
+                    fetcher.health.save()
+        except FetchError as e:
+            sys.stderr.write("%s\n" % e)
+            return 1
+        return 0
+    elif args.command == "batch":
+        mirrors = read_mirrors(args.mirrors)
+        jobs = []
+        with open(args.manifest) as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    jobs.append((candidate_urls(fields[2:], mirrors),
+                                 fields[0], fields[1]))
+        fetcher = Fetcher(args.max_per_host,
+                          health=_health(args.mirror_health))
+        try:
+            errors = fetcher.fetch_many(jobs, args.jobs, mirrors)
+        finally:
+            fetcher.close()
+            if fetcher.health:
+                fetcher.health.save()
+        for e in errors:
+            sys.stderr.write("%s\n" % e)
+        return 1 if errors else 0
+    else:
+        parser.error("Missing command")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
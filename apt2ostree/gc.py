@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+"""
+Deletes the refs in the build ostree repo that the build no longer produces
+and prunes the objects that only they used.
+
+    python -m apt2ostree.gc [--dry-run] [--keep-images=N] [--repo=REPO]
+        [build.ninja]
+
+or `ninja gc` and `ninja gc-dry-run`.
+
+Every deb ever built leaves its deb/pool/... refs behind and every old image
+its deb/images/... and deb/combined/... refs, so without this the repo grows
+without bound.  The live refs are the outputs under refs/heads of the build
+statements in the ninja file and the fragments it includes, which are the
+`Ninja.targets` of configure.  They're read from the files rather than
+recorded by configure because ninja regenerates fragments without rerunning
+all of configure.  Only refs under deb/ are deleted.
+
+The lockfile of an image is updated in place, so the previous image is gone
+once its objects are pruned.  With --keep-images=N the last N commits of each
+image that gc has seen are kept as refs rollback/<image ref>/0 (the current
+one) to rollback/<image ref>/N-1 so you can go back to them.
+
+The space reclaimed is worked out by walking the commits of the refs that
+are kept, reading the metadata objects directly.  With --dry-run that's all
+that's done: nothing is changed and ostree isn't run.
+"""
+
+import argparse
+import binascii
+import os
+import subprocess
+import sys
+
+from .impact import IMAGE_BRANCHES, human_size, read_targets
+from .incremental import read_ref
+from .usrmove import COMMIT, DIRTREE, read_object
+
+# Refs under here may be deleted
+GC_PREFIX = "deb/"
+ROLLBACK_PREFIX = "rollback/"
+
+# Maximum number of refs to pass to one `ostree refs --delete`
+MAX_REFS_PER_COMMAND = 500
+
+
+def list_refs(repo):
+    """Returns a dict from each ref in repo to its checksum"""
+    heads = os.path.join(repo, "refs", "heads")
+    out = {}
+    for dirpath, _, filenames in os.walk(heads):
+        for x in filenames:
+            ref = os.path.relpath(os.path.join(dirpath, x), heads)
+            out[ref] = read_ref(repo, ref)
+    return out
+
+
+def live_refs(repo, ninja_file):
+    """The refs in repo that are outputs of the build"""
+    prefix = os.path.normpath(repo) + "/refs/heads/"
+    return set(x[len(prefix):] for x in map(os.path.normpath,
+                                            read_targets(ninja_file))
+               if x.startswith(prefix))
+
+
+def is_image(ref):
+    return ref.startswith("deb/images/") and \
+        ref.rsplit("/", 1)[-1] in IMAGE_BRANCHES
+
+
+def plan_rollback(refs, live, keep_images):
+    """Returns (delete, create): the rollback refs to delete and a dict of the
+    ones to create, to keep the last keep_images commits of each live image.
+    Rollback refs of images that aren't live any more are deleted."""
+    existing = dict((ref, csum) for ref, csum in refs.items()
+                    if ref.startswith(ROLLBACK_PREFIX))
+    wanted = {}
+    for ref in sorted(live):
+        if not is_image(ref) or ref not in refs or keep_images < 2:
+            continue
+        history = [refs[ref]]
+        n = 0
+        while "%s%s/%i" % (ROLLBACK_PREFIX, ref, n) in existing:
+            csum = existing["%s%s/%i" % (ROLLBACK_PREFIX, ref, n)]
+            if csum not in history:
+                history.append(csum)
+            n += 1
+        for n, csum in enumerate(history[:keep_images]):
+            wanted["%s%s/%i" % (ROLLBACK_PREFIX, ref, n)] = csum
+    delete = sorted(ref for ref, csum in existing.items()
+                    if wanted.get(ref) != csum)
+    create = dict((ref, csum) for ref, csum in wanted.items()
+                  if existing.get(ref) != csum)
+    return delete, create
+
+
+def _objects(repo):
+    """Yields the path of every object in repo relative to objects/"""
+    objects = os.path.join(repo, "objects")
+    for prefix in os.listdir(objects):
+        if len(prefix) != 2:
+            continue
+        for x in os.listdir(os.path.join(objects, prefix)):
+            yield "%s/%s" % (prefix, x)
+
+
+def reachable(repo, commits):
+    """Returns the set of objects, as paths relative to objects/, that are
+    reachable from commits.  Like `ostree prune --refs-only` history is
+    followed for as far as the repo has it."""
+    out = set()
+    hexlify = binascii.hexlify
+
+    def rel(csum, objtype):
+        return "%s/%s.%s" % (csum[:2], csum[2:], objtype)
+
+    def walk_tree(tree, meta):
+        out.add(rel(meta, "dirmeta"))
+        if rel(tree, "dirtree") in out:
+            return
+        out.add(rel(tree, "dirtree"))
+        files, dirs = read_object(repo, tree, "dirtree", DIRTREE)
+        for _, csum in files:
+            csum = hexlify(csum).decode("ascii")
+            for objtype in ("file", "filez"):
+                out.add(rel(csum, objtype))
+        for _, subtree, submeta in dirs:
+            walk_tree(hexlify(subtree).decode("ascii"),
+                      hexlify(submeta).decode("ascii"))
+
+    for csum in commits:
+        while csum and rel(csum, "commit") not in out and \
+                os.path.exists(os.path.join(repo, "objects",
+                                            rel(csum, "commit"))):
+            out.add(rel(csum, "commit"))
+            out.add(rel(csum, "commitmeta"))
+            commit = read_object(repo, csum, "commit", COMMIT)
+            walk_tree(hexlify(commit[6]).decode("ascii"),
+                      hexlify(commit[7]).decode("ascii"))
+            csum = hexlify(commit[1]).decode("ascii")
+    return out
+
+
+def unreachable(repo, commits):
+    """Returns (count, bytes) of the objects in repo not reachable from
+    commits"""
+    keep = reachable(repo, commits)
+    count = 0
+    size = 0
+    for x in _objects(repo):
+        if x not in keep:
+            count += 1
+            size += os.lstat(os.path.join(repo, "objects", x)).st_size
+    return count, size
+
+
+def _ostree_refs(repo, args):
+    for i in range(0, len(args), MAX_REFS_PER_COMMAND):
+        subprocess.check_call(["ostree", "--repo=%s" % repo, "refs"] +
+                              args[i:i + MAX_REFS_PER_COMMAND])
+
+
+def gc(repo, ninja_file, keep_images=1, dry_run=False):
+    """Deletes the deb/ refs in repo that the build in ninja_file doesn't
+    produce and prunes the repo.  Returns a list of lines describing what
+    was (or, with dry_run, would be) done."""
+    refs = list_refs(repo)
+    live = live_refs(repo, ninja_file)
+    delete = sorted(ref for ref in refs
+                    if ref.startswith(GC_PREFIX) and ref not in live)
+    if delete and not any(ref in live for ref in refs):
+        raise ValueError(
+            "None of the refs in %s are built by %s.  Is the repo right?" % (
+                repo, ninja_file))
+    rollback_delete, rollback_create = plan_rollback(refs, live, keep_images)
+
+    gone = set(delete + rollback_delete)
+    commits = set(csum for ref, csum in refs.items() if ref not in gone)
+    commits.update(rollback_create.values())
+    count, size = unreachable(repo, commits)
+
+    kinds = {}
+    for ref in delete:
+        kind = "/".join(ref.split("/", 2)[:2])
+        kinds[kind] = kinds.get(kind, 0) + 1
+    report = [
+        "Refs: %i, of which %i are built by %s" % (
+            len(refs), len(live.intersection(refs)), ninja_file),
+        "Refs to delete: %i%s" % (len(delete), "".join(
+            "\n    %s: %i" % x for x in sorted(kinds.items()))),
+        "Rollback refs: %i to create, %i to delete" % (
+            len(rollback_create), len(rollback_delete)),
+        "Objects to prune: %i, %s" % (count, human_size(size)),
+    ]
+    if dry_run:
+        return report
+
+    if gone:
+        _ostree_refs(repo, ["--delete"] + sorted(gone))
+    for ref, csum in sorted(rollback_create.items()):
+        _ostree_refs(repo, ["--create=%s" % ref, csum])
+    subprocess.check_call(["ostree", "--repo=%s" % repo, "prune",
+                           "--refs-only"])
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Delete the refs the build no longer produces and prune "
+                    "the ostree repo")
+    parser.add_argument("--repo", default="_build/ostree")
+    parser.add_argument("--keep-images", type=int, default=1,
+                        help="How many commits of each image to keep for "
+                             "rollback, including the current one")
+    parser.add_argument("--dry-run", "-n", action="store_true",
+                        help="Only report what would be deleted")
+    parser.add_argument("ninja_file", nargs="?", default="build.ninja")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        report = gc(args.repo, args.ninja_file, args.keep_images,
+                    args.dry_run)
+    except (EnvironmentError, ValueError) as e:
+        sys.stderr.write("gc: %s\n" % e)
+        return 1
+    for line in report:
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
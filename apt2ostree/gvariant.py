@@ -0,0 +1,211 @@
+"""
+A minimal GVariant serialiser, enough to read and write ostree's metadata
+objects (commits, dirtrees and dirmetas) without libostree.
+
+Only normal form data is supported, which is what ostree writes.  See
+https://developer.gnome.org/glib/stable/gvariant-format-strings.html and the
+GVariant serialisation paper for the details.
+
+Values map to Python as follows:
+
+* `y`, `n`, `q`, `i`, `u`, `x`, `t`: int.  Little-endian, so ostree's
+  big-endian fields need byte-swapping by the caller.
+* `b`: bool
+* `s`, `o`, `g`: str
+* `ay`: bytes
+* other arrays: list
+* `a{..}`: list of (key, value) tuples, to preserve their order
+* tuples: tuple
+* `v`: `Variant`
+"""
+
+import struct
+from collections import namedtuple
+
+Variant = namedtuple("Variant", "type value")
+
+_FIXED = {
+    "y": (1, "<B"), "b": (1, "<?"), "n": (2, "<h"), "q": (2, "<H"),
+    "i": (4, "<i"), "u": (4, "<I"), "x": (8, "<q"), "t": (8, "<Q"),
+    "d": (8, "<d"),
+}
+_STRINGS = "sog"
+
+
+class _Type(object):
+    """A parsed GVariant type string"""
+    __slots__ = ("kind", "char", "children", "alignment", "fixed_size")
+
+    def __init__(self, kind, char=None, children=()):
+        self.kind = kind
+        self.char = char
+        self.children = list(children)
+        if kind == "basic" and char in _FIXED:
+            self.alignment = self.fixed_size = _FIXED[char][0]
+        elif kind == "basic":
+            self.alignment, self.fixed_size = 1, None
+        elif kind == "variant":
+            self.alignment, self.fixed_size = 8, None
+        elif kind == "array":
+            self.alignment, self.fixed_size = children[0].alignment, None
+        else:
+            # tuple or dict entry
+            self.alignment = max([c.alignment for c in children] or [1])
+            if any(c.fixed_size is None for c in children):
+                self.fixed_size = None
+            else:
+                size = 0
+                for c in children:
+                    size = _align(size, c.alignment) + c.fixed_size
+                self.fixed_size = max(_align(size, self.alignment), 1)
+
+
+def _align(n, alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def parse_type(typestr):
+    t, end = _parse_type(typestr, 0)
+    if end != len(typestr):
+        raise ValueError("Trailing characters in type %r" % typestr)
+    return t
+
+
+def _parse_type(s, i):
+    c = s[i]
+    if c in _FIXED or c in _STRINGS:
+        return _Type("basic", c), i + 1
+    elif c == "v":
+        return _Type("variant"), i + 1
+    elif c == "a":
+        child, i = _parse_type(s, i + 1)
+        return _Type("array", children=[child]), i
+    elif c in "({":
+        close = ")" if c == "(" else "}"
+        children = []
+        i += 1
+        while s[i] != close:
+            child, i = _parse_type(s, i)
+            children.append(child)
+        return _Type("tuple" if c == "(" else "dict", children=children), i + 1
+    raise ValueError("Unsupported type %r" % s)
+
+
+def _offset_size(size):
+    if size <= 0xff:
+        return 1
+    elif size <= 0xffff:
+        return 2
+    elif size <= 0xffffffff:
+        return 4
+    return 8
+
+
+def _pack_offsets(body, offsets):
+    """Appends framing offsets to body, choosing the smallest offset size
+    that can address the whole container"""
+    for size, fmt in ((1, "<B"), (2, "<H"), (4, "<I"), (8, "<Q")):
+        if size == 8 or len(body) + len(offsets) * size <= (1 << (8 * size)) - 1:
+            return body + b"".join(struct.pack(fmt, x) for x in offsets)
+
+
+def _read_offset(data, pos, size):
+    out = 0
+    for n, c in enumerate(bytearray(data[pos:pos + size])):
+        out |= c << (8 * n)
+    return out
+
+
+def serialize(typestr, value):
+    return _serialize(parse_type(typestr), value)
+
+
+def _serialize(t, value):
+    if t.kind == "basic":
+        if t.char in _FIXED:
+            return struct.pack(_FIXED[t.char][1], value)
+        return value.encode("utf-8") + b"\0"
+    elif t.kind == "variant":
+        return _serialize(parse_type(value.type), value.value) + (
+            b"\0" + value.type.encode("ascii"))
+    elif t.kind == "array":
+        child = t.children[0]
+        if child.kind == "basic" and child.char == "y":
+            return bytes(value)
+        if child.kind == "dict" and isinstance(value, dict):
+            value = sorted(value.items())
+        body = b""
+        offsets = []
+        for x in value:
+            body += b"\0" * (_align(len(body), child.alignment) - len(body))
+            body += _serialize(child, x)
+            offsets.append(len(body))
+        if child.fixed_size is not None:
+            return body
+        return _pack_offsets(body, offsets)
+    else:
+        body = b""
+        offsets = []
+        for n, (child, x) in enumerate(zip(t.children, value)):
+            body += b"\0" * (_align(len(body), child.alignment) - len(body))
+            body += _serialize(child, x)
+            if child.fixed_size is None and n != len(t.children) - 1:
+                offsets.append(len(body))
+        if t.fixed_size is not None:
+            return body + b"\0" * (t.fixed_size - len(body))
+        return _pack_offsets(body, list(reversed(offsets)))
+
+
+def deserialize(typestr, data):
+    return _deserialize(parse_type(typestr), bytes(data))
+
+
+def _deserialize(t, data):
+    if t.kind == "basic":
+        if t.char in _FIXED:
+            return struct.unpack(_FIXED[t.char][1], data)[0]
+        return data[:-1].decode("utf-8")
+    elif t.kind == "variant":
+        sep = data.rindex(b"\0")
+        typestr = data[sep + 1:].decode("ascii")
+        return Variant(typestr, _deserialize(parse_type(typestr), data[:sep]))
+    elif t.kind == "array":
+        child = t.children[0]
+        if child.kind == "basic" and child.char == "y":
+            return data
+        out = []
+        if child.fixed_size is not None:
+            for pos in range(0, len(data), child.fixed_size):
+                out.append(_deserialize(child, data[pos:pos + child.fixed_size]))
+            return out
+        if not data:
+            return out
+        osize = _offset_size(len(data))
+        table = _read_offset(data, len(data) - osize, osize)
+        n = (len(data) - table) // osize
+        start = 0
+        for k in range(n):
+            end = _read_offset(data, table + k * osize, osize)
+            start = _align(start, child.alignment)
+            out.append(_deserialize(child, data[start:end]))
+            start = end
+        return out
+    else:
+        osize = _offset_size(len(data))
+        out = []
+        pos = 0
+        n_offsets = 0
+        for n, child in enumerate(t.children):
+            pos = _align(pos, child.alignment)
+            if child.fixed_size is not None:
+                end = pos + child.fixed_size
+            elif n == len(t.children) - 1:
+                n_variable = sum(1 for c in t.children[:-1]
+                                 if c.fixed_size is None)
+                end = len(data) - n_variable * osize
+            else:
+                n_offsets += 1
+                end = _read_offset(data, len(data) - n_offsets * osize, osize)
+            out.append(_deserialize(child, data[pos:end]))
+            pos = end
+        return tuple(out)
@@ -0,0 +1,395 @@
+#!/usr/bin/python
+
+"""
+Estimates how much work a lockfile update will cause before building it.
+
+    python -m apt2ostree.impact old.lock new.lock
+
+Reports the packages added, removed and changed, how much there is to
+download and which image targets will be rebuilt.  Run it from the
+directory containing build.ninja after `ninja update-apt-lockfiles`, with
+the old lockfile from e.g. `git show HEAD:new.lock >old.lock`.
+
+A deb needs downloading if its `deb/pool/...` ref isn't in the ostree repo
+and it isn't in the deb cache.  Its size comes from the `Size` field of the
+lockfile if there is one.  Lockfiles written by `aptly lockfile create`
+don't have it, so otherwise the size comes from the Packages indices that
+the built-in resolver keeps in the index cache (see `index_cache.py`).  The
+rest are counted as unknown size unless --online is given, in which case we
+ask the mirrors in _build/deb_pool_mirrors with a HEAD request for each.
+
+The refs are read from the repo directly and the image targets are found in
+build.ninja and the files it includes, so without --online this is quick even
+for big lockfiles.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+from collections import namedtuple
+if sys.version_info[0] >= 3:
+    from urllib.error import URLError
+    from urllib.parse import unquote
+    from urllib.request import Request, urlopen
+else:
+    from urllib import unquote
+    from urllib2 import Request, URLError, urlopen
+
+from .apt import deb_pool_paths
+from .deb_cache import load_config
+from .fetch import candidate_urls, read_mirrors
+from .lockfile import Lockfile
+from .resolver import read_index
+
+# The branches built for each image.  See `Apt.build_image`.
+IMAGE_BRANCHES = ("unpacked", "configured", "complete")
+
+# Number of HEAD requests in flight at once
+HEAD_THREADS = 8
+TIMEOUT = 30
+
+
+def read_lockfile(filename):
+    with open(filename, "rb") as f:
+        return Lockfile(f)
+
+
+def diff(old, new):
+    """Returns (added, removed, changed) lists of (package, architecture,
+    old version, new version) between two `Lockfile`s"""
+    def by_name(entries):
+        return dict(((x.package, x.get("Architecture")), x) for x in entries)
+    a_only = by_name(old.difference(new))
+    b_only = by_name(new.difference(old))
+    added = []
+    removed = []
+    changed = []
+    for key in sorted(set(a_only) | set(b_only)):
+        a = a_only.get(key)
+        b = b_only.get(key)
+        row = key + (a and a.version, b and b.version)
+        if a is None:
+            added.append(row)
+        elif b is None:
+            removed.append(row)
+        elif a.sha256 != b.sha256:
+            changed.append(row)
+    return added, removed, changed
+
+
+def downloads(entries, repo, cache=None):
+    """Returns (to_download, cached) lists of the lockfile entries whose debs
+    aren't in repo, split by whether they're in the `DebCache` cache"""
+    to_download = []
+    cached = []
+    for entry in entries:
+        _, ref_base = deb_pool_paths(entry)
+        if os.path.exists("%s/refs/heads/%s/data" % (repo, ref_base)):
+            continue
+        if cache and os.path.exists(cache.filename(entry.sha256)):
+            cached.append(entry)
+        else:
+            to_download.append(entry)
+    return to_download, cached
+
+
+def _size(entry):
+    try:
+        return int(entry.get("Size"))
+    except (TypeError, ValueError):
+        return None
+
+
+_INDEX_SHA256 = re.compile(br"^SHA256: *(\w+)", re.M)
+_INDEX_SIZE = re.compile(br"^Size: *(\d+)", re.M)
+
+
+def index_sizes(directory, sha256s):
+    """Returns a dict from those of sha256s that are in the Packages indices
+    cached in directory (see `IndexCache.packages`) to the size of the deb"""
+    out = {}
+    wanted = set(x.encode("ascii") for x in sha256s)
+    for root, _, files in os.walk(directory):
+        if not wanted:
+            break
+        # The indices are in <component>/binary-<architecture>, named after
+        # their checksum
+        if not os.path.basename(root).startswith("binary-"):
+            continue
+        for name in files:
+            try:
+                data = read_index(os.path.join(root, name))
+            except (EnvironmentError, ValueError):
+                continue
+            for stanza in data.split(b"\n\n"):
+                m = _INDEX_SHA256.search(stanza)
+                if m is None or m.group(1) not in wanted:
+                    continue
+                size = _INDEX_SIZE.search(stanza)
+                if size is not None:
+                    out[m.group(1).decode("ascii")] = int(size.group(1))
+                    wanted.discard(m.group(1))
+    return out
+
+
+def _head_size(urls):
+    for url in urls:
+        request = Request(url)
+        request.get_method = lambda: "HEAD"
+        try:
+            response = urlopen(request, timeout=TIMEOUT)
+            return int(response.info().get("Content-Length"))
+        except (EnvironmentError, URLError, TypeError, ValueError):
+            continue
+    return None
+
+
+def head_sizes(entries, mirrors, threads=HEAD_THREADS):
+    """Returns a dict from the sha256 of each of the lockfile entries to the
+    size of its deb according to a HEAD request to mirrors, where one
+    answered"""
+    out = {}
+    todo = list(entries)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                entry = todo.pop()
+            size = _head_size(candidate_urls([unquote(entry.filename)],
+                                              mirrors))
+            if size is not None:
+                with lock:
+                    out[entry.sha256] = size
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for x in workers:
+        x.start()
+    for x in workers:
+        x.join()
+    return out
+
+
+def download_sizes(entries, index_cache=None, mirrors=()):
+    """Returns the size of the deb of each of the lockfile entries, or None
+    where it can't be found.  See the module docstring."""
+    sizes = dict((x.sha256, _size(x)) for x in entries)
+    missing = [x for x, size in sizes.items() if size is None]
+    if missing and index_cache:
+        sizes.update(index_sizes(index_cache, missing))
+    missing = [x for x in entries if sizes[x.sha256] is None]
+    if missing and mirrors:
+        sizes.update(head_sizes(missing, mirrors))
+    return [sizes[x.sha256] for x in entries]
+
+
+_UNESCAPED_COLON = re.compile(r"(?<!\$):")
+_UNESCAPED_SPACE = re.compile(r"(?<!\$) +")
+
+
+_VARIABLE = re.compile(r"^([\w.-]+) *= *(.*)$")
+_DOLLAR = re.compile(r"\$(\$| |:|\{([\w.-]+)\}|([\w-]+))")
+
+
+def _expand(text, scope):
+    """Unescapes text and expands the variables in it that are in scope"""
+    def sub(m):
+        name = m.group(2) or m.group(3)
+        if name is None:
+            return m.group(1)
+        return scope.get(name, "")
+    return _DOLLAR.sub(sub, text)
+
+
+def _paths(text, scope=None):
+    if "$" not in text:
+        return text.split()
+    return [_expand(x, scope or {})
+            for x in _UNESCAPED_SPACE.split(text.strip()) if x]
+
+
+def read_ninja(filename, dependents=None):
+    """Returns a dict from each input of the build statements in filename,
+    and the files it includes, to the set of outputs that are rebuilt when
+    it changes.  Order-only inputs are ignored.  Variables in paths are
+    expanded as ninja would."""
+    if dependents is None:
+        dependents = {}
+    for edge in read_edges(filename):
+        for x in edge.inputs:
+            dependents.setdefault(x, set()).update(edge.outputs)
+    return dependents
+
+
+def read_targets(filename):
+    """Returns the set of outputs of the build statements in filename and
+    the files it includes"""
+    out = set()
+    for edge in read_edges(filename):
+        out.update(edge.outputs)
+    return out
+
+
+# A build statement.  inputs are the explicit and implicit inputs and
+# variables are the statement's own, expanded.
+Edge = namedtuple("Edge", "rule outputs inputs order_only variables")
+
+
+def read_edges(filename):
+    """Yields an `Edge` for each build statement in filename and the files it
+    includes"""
+    return _edges(filename, {})
+
+
+def _edges(filename, scope):
+    with open(filename) as f:
+        lines = f.read().replace("$\n", " ").split("\n")
+    for n, line in enumerate(lines):
+        if line.startswith("build "):
+            # Paths may refer to the statement's own variables
+            variables, edge = _edge_variables(lines, n + 1, scope)
+            if "$" in line:
+                outputs, rest = _UNESCAPED_COLON.split(line[5:], 1)
+            else:
+                outputs, rest = line[5:].split(":", 1)
+            rest = rest.split(" || ", 1)
+            inputs = _paths(rest[0], edge)
+            yield Edge(
+                inputs[0], [x for x in _paths(outputs, edge) if x != "|"],
+                [x for x in inputs[1:] if x != "|"],
+                _paths(rest[1], edge) if len(rest) > 1 else [], variables)
+        elif line.startswith("subninja "):
+            # subninja files get a scope of their own
+            for x in _edges(
+                    _paths(line.split(" ", 1)[1], scope)[0], dict(scope)):
+                yield x
+        elif line.startswith("include "):
+            for x in _edges(_paths(line.split(" ", 1)[1], scope)[0], scope):
+                yield x
+        else:
+            m = _VARIABLE.match(line)
+            if m:
+                scope[m.group(1)] = _expand(m.group(2), scope)
+
+
+def _edge_variables(lines, start, scope):
+    """Returns the variables of the build statement ending just before
+    lines[start] and the scope of the statement"""
+    variables = {}
+    edge = scope
+    for line in lines[start:]:
+        m = _VARIABLE.match(line.lstrip()) if line.startswith(" ") else None
+        if m is None:
+            break
+        if edge is scope:
+            edge = dict(scope)
+        variables[m.group(1)] = edge[m.group(1)] = _expand(m.group(2), edge)
+    return variables, edge
+
+
+def affected(dependents, changed):
+    """Returns the set of everything that depends on the files in changed"""
+    out = set()
+    todo = list(changed)
+    while todo:
+        for x in dependents.get(todo.pop(), ()):
+            if x not in out:
+                out.add(x)
+                todo.append(x)
+    return out
+
+
+def image_targets(targets, repo):
+    """Picks out the image branches and the phony image targets"""
+    out = []
+    prefix = "%s/refs/heads/" % repo
+    for x in sorted(targets):
+        if x.startswith(prefix) and x.rsplit("/", 1)[-1] in IMAGE_BRANCHES:
+            out.append(x[len(prefix):])
+        elif x.startswith(("image-for-", "unpacked-image-for-")):
+            out.append(x)
+    return out
+
+
+def human_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            return "%.1f %s" % (size, unit) if unit != "B" else "%i B" % size
+        size /= 1024.
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Estimate the work a lockfile update will cause")
+    parser.add_argument("old", help="The lockfile before the update")
+    parser.add_argument("new", help="The lockfile after the update")
+    parser.add_argument(
+        "--lockfile", help="The lockfile as named in build.ninja.  Defaults "
+        "to NEW.")
+    parser.add_argument("--repo", default="_build/ostree")
+    parser.add_argument("--ninja-file", default="build.ninja")
+    parser.add_argument("--cache-config", default="_build/deb_cache.json")
+    parser.add_argument("--index-cache", default="_build/apt/index-cache")
+    parser.add_argument("--mirrors", default="_build/deb_pool_mirrors")
+    parser.add_argument("--online", action="store_true",
+                        help="Make HEAD requests for the sizes of debs that "
+                        "aren't in the index cache")
+    parser.add_argument("--json", action="store_true",
+                        help="Write the report as JSON")
+    args = parser.parse_args(argv[1:])
+
+    old = read_lockfile(args.old)
+    new = read_lockfile(args.new)
+    added, removed, changed = diff(old, new)
+    new_debs = list(new.difference(old))
+    to_download, cached = downloads(new_debs, args.repo,
+                                    load_config(args.cache_config))
+    mirrors = []
+    if args.online and os.path.exists(args.mirrors):
+        mirrors = read_mirrors(args.mirrors)
+    sizes = download_sizes(to_download, args.index_cache, mirrors)
+    known = sum(x for x in sizes if x is not None)
+    unknown = sum(1 for x in sizes if x is None)
+
+    targets = []
+    with open(args.old, "rb") as a, open(args.new, "rb") as b:
+        if a.read() != b.read():
+            dependents = read_ninja(args.ninja_file)
+            targets = image_targets(
+                affected(dependents, [args.lockfile or args.new]), args.repo)
+
+    if args.json:
+        json.dump({
+            "added": added, "removed": removed, "changed": changed,
+            "download": {
+                "debs": len(to_download), "bytes": known,
+                "unknown_size": unknown, "in_deb_cache": len(cached)},
+            "targets": targets,
+        }, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        return 0
+
+    for title, rows in [("Added", added), ("Removed", removed),
+                        ("Changed", changed)]:
+        print("%s: %i" % (title, len(rows)))
+        for name, arch, a, b in rows:
+            print("    %s:%s %s" % (name, arch, " -> ".join(
+                x for x in (a, b) if x)))
+    print("Download: %i debs, %s%s" % (
+        len(to_download), human_size(known),
+        " + %i of unknown size" % unknown if unknown else ""))
+    if cached:
+        print("From deb cache: %i debs" % len(cached))
+    print("Image targets to rebuild: %i" % len(targets))
+    for x in targets:
+        print("    %s" % x)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+
+"""
+Combines ostree commits incrementally, starting from the last result.
+
+`ostree_combine` overlays every input to build an image.  When a nightly
+lockfile update changes a dozen packages out of thousands that's almost all
+wasted work.  Instead we remember which commits went into the last result.
+Next time we start from the dirtrees of the last result, remove the files
+that belonged to the packages that have gone (including old versions of
+packages that have been upgraded) and merge in the trees of the new
+packages.  Like `usrmove.py` nothing is checked out: only the dirtrees on
+the paths to what changed are rewritten, so ownership, permissions and
+xattrs are whatever the inputs say.  Where several inputs have the same
+directory its metadata comes from the last of them, as in `ostree commit`
+with several `--tree=ref=`.
+
+The result must be the same as combining from scratch.  We fall back to
+combining from scratch whenever we can't be sure of that cheaply:
+
+* There's no previous result, or the branch has been changed since.
+* The packages that stay have changed order.
+* More than a fraction of the inputs have changed.
+* A file belonging to a package that has been added or removed also belongs
+  to a package that stays, so which one wins depends on the order.
+
+To find which files belong to which package we walk the dirtrees of each
+input commit.  Commits never change so the lists are cached by checksum.
+
+`ninja check-incremental-<lockfile>` compares the result with a from-scratch
+build.
+"""
+
+import argparse
+import binascii
+import errno
+import json
+import os
+import sys
+
+from .ninja import write_if_changed
+from .ostree_worker import check_output
+from .usrmove import COMMIT, Tree, read_object, read_ref, write_object
+
+# Fall back to combining from scratch if more than this fraction of the
+# inputs have changed
+MAX_DELTA = 0.25
+
+# Maximum number of `--tree=ref=` arguments to one `ostree commit`
+MAX_TREES_PER_COMMIT = 256
+
+
+class FallBack(Exception):
+    """Raised when we can't combine incrementally"""
+    pass
+
+
+def have_commit(repo, checksum):
+    return os.path.exists("%s/objects/%s/%s.commit" % (
+        repo, checksum[:2], checksum[2:]))
+
+
+class FileLists(object):
+    """The paths in each commit, cached in directory by checksum.  Each list
+    is a dict mapping path to True for directories and False for anything
+    else."""
+    def __init__(self, repo, directory):
+        self.repo = repo
+        self.directory = directory
+        self._lists = {}
+
+    def get(self, checksum):
+        if checksum in self._lists:
+            return self._lists[checksum]
+        filename = os.path.join(self.directory, checksum[:2],
+                                checksum + ".json")
+        try:
+            with open(filename) as f:
+                text = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            paths = {}
+            commit = read_object(self.repo, checksum, "commit", COMMIT)
+            self._walk(_hex(commit[6]), "", paths)
+            text = json.dumps(paths, sort_keys=True)
+            write_if_changed(filename, text)
+        # Loaded from the JSON either way so the paths are the same type
+        paths = json.loads(text)
+        self._lists[checksum] = paths
+        return paths
+
+    def _walk(self, tree, prefix, paths):
+        t = Tree(self.repo, tree)
+        for name in t.files:
+            paths[prefix + "/" + name] = False
+        for name, (subtree, _) in t.dirs.items():
+            paths[prefix + "/" + name] = True
+            self._walk(subtree, prefix + "/" + name, paths)
+
+
+def plan(old, new, lists, max_delta=MAX_DELTA):
+    """Works out how to turn the combination of old into the combination of
+    new.  old and new are lists of (ref, checksum).  Returns (delete, add,
+    dirs) where delete is a list of paths to remove, deepest first, add is
+    the list of checksums to merge in, in order, and dirs the directories
+    that remain which the changed inputs had, so whose metadata may have
+    changed.  Raises `FallBack` if we should combine from scratch instead."""
+    old_set = set(old)
+    new_set = set(new)
+    removed = [x for x in old if x not in new_set]
+    added = [x for x in new if x not in old_set]
+    kept = [x for x in new if x in old_set]
+    if kept != [x for x in old if x in new_set]:
+        raise FallBack("the order of the inputs has changed")
+    if len(removed) + len(added) > max_delta * max(len(new), 1):
+        raise FallBack("%i of %i inputs have changed" % (
+            len(removed) + len(added), len(new)))
+
+    changed = {}
+    for _, checksum in removed + added:
+        for path, is_dir in lists.get(checksum).items():
+            changed[path] = changed.get(path, False) or is_dir
+
+    # Directories stay if anything still has them.  Files mustn't be shared
+    # with any package that stays.
+    wanted_dirs = set()
+    for ref, checksum in kept:
+        for path, is_dir in lists.get(checksum).items():
+            if path not in changed:
+                continue
+            if is_dir and changed[path]:
+                wanted_dirs.add(path)
+            else:
+                raise FallBack("%s from %s is also in a changed input" % (
+                    path, ref))
+    for _, checksum in added:
+        for path, is_dir in lists.get(checksum).items():
+            if is_dir:
+                wanted_dirs.add(path)
+
+    delete = [path for path, is_dir in changed.items()
+              if not (is_dir and path in wanted_dirs)]
+    delete.sort(key=lambda p: (-p.count("/"), p))
+    return delete, [checksum for _, checksum in added], sorted(wanted_dirs)
+
+
+def combine_from_scratch(repo, checksums):
+    """Overlays checksums in order like `ostree_combine`.  Returns the
+    checksum of the result."""
+    if not checksums:
+        raise ValueError("Nothing to combine")
+    result = None
+    pending = list(checksums)
+    while pending:
+        trees = ([result] if result else []) + pending[:MAX_TREES_PER_COMMIT]
+        pending = pending[MAX_TREES_PER_COMMIT:]
+        result = _ostree(
+            repo, "commit", "--no-bindings", "--orphan", "--timestamp=0",
+            *["--tree=ref=%s" % x for x in trees])
+    return result
+
+
+class _Dir(object):
+    """A directory of the result being edited.  Subdirectories are (dirtree
+    checksum, dirmeta checksum) until they're edited, when they're replaced
+    by a `_Dir`."""
+    def __init__(self, repo, tree, meta):
+        self.repo = repo
+        self.meta = meta
+        t = Tree(repo, tree)
+        self.files = t.files
+        self.dirs = t.dirs
+
+    def subdir(self, name):
+        """The `_Dir` name or None"""
+        x = self.dirs.get(name)
+        if x is not None and not isinstance(x, _Dir):
+            x = self.dirs[name] = _Dir(self.repo, *x)
+        return x
+
+    def lookup(self, path):
+        """The `_Dir` at path or None"""
+        d = self
+        for name in path.strip("/").split("/"):
+            if d is None:
+                break
+            if name:
+                d = d.subdir(name)
+        return d
+
+    def merge(self, tree):
+        """Merges in the dirtree tree, later files replacing earlier ones"""
+        src = Tree(self.repo, tree)
+        for name, csum in src.files.items():
+            if name in self.dirs:
+                raise FallBack("can't replace directory %s with a file" % name)
+            self.files[name] = csum
+        for name, (subtree, meta) in src.dirs.items():
+            if name in self.files:
+                raise FallBack("can't replace file %s with a directory" % name)
+            if name in self.dirs:
+                self.subdir(name).merge(subtree)
+            else:
+                self.dirs[name] = (subtree, meta)
+
+    def write(self):
+        t = Tree(self.repo)
+        t.files = self.files
+        for name, x in self.dirs.items():
+            t.dirs[name] = (x.write(), x.meta) if isinstance(x, _Dir) else x
+        return t.write(self.repo)
+
+
+def _hex(checksum):
+    return binascii.hexlify(checksum).decode("ascii")
+
+
+def _dirmeta(repo, commit, path):
+    """The dirmeta checksum of the directory path in the commit object"""
+    tree, meta = _hex(commit[6]), _hex(commit[7])
+    for name in path.strip("/").split("/"):
+        if name:
+            tree, meta = Tree(repo, tree).dirs[name]
+    return meta
+
+
+def combine_incrementally(repo, previous, delete, add, dirs, new, lists):
+    """Removes the paths in delete from the commit previous and merges in
+    the commits add, as planned by `plan`.  The metadata of dirs, and of the
+    root, is taken from the last of new, the checksums of all the inputs,
+    that has them.  Returns the checksum of the result."""
+    commit = read_object(repo, previous, "commit", COMMIT)
+    root = _Dir(repo, _hex(commit[6]), _hex(commit[7]))
+    for path in delete:
+        parent = root.lookup(os.path.dirname(path))
+        if parent is not None:
+            name = os.path.basename(path)
+            parent.files.pop(name, None)
+            parent.dirs.pop(name, None)
+    for checksum in add:
+        root.merge(_hex(read_object(repo, checksum, "commit", COMMIT)[6]))
+
+    for path in ["/"] + dirs:
+        d = root.lookup(path)
+        if d is None:
+            continue
+        for checksum in reversed(new):
+            if path == "/" or lists.get(checksum).get(path):
+                d.meta = _dirmeta(repo, read_object(
+                    repo, checksum, "commit", COMMIT), path)
+                break
+
+    unhex = binascii.unhexlify
+    return write_object(repo, "commit", COMMIT, (
+        commit[:6] + (unhex(root.write()), unhex(root.meta))))
+
+
+def _ostree(repo, *args):
+    return check_output(
+        ["--repo=%s" % repo] + list(args)).decode("ascii").strip()
+
+
+def _load_state(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        pass
+    return None
+
+
+def combine(repo, branch, refs, state_filename, lists, max_delta=MAX_DELTA):
+    """Sets branch to the combination of refs, incrementally if possible.
+    Returns the checksum."""
+    new = []
+    for ref in refs:
+        checksum = read_ref(repo, ref)
+        if checksum is None:
+            raise RuntimeError("Ref %s doesn't exist" % ref)
+        new.append((ref, checksum))
+
+    state = _load_state(state_filename)
+    try:
+        if state is None:
+            raise FallBack("no previous result")
+        previous = state["commit"]
+        if read_ref(repo, branch) != previous or not have_commit(
+                repo, previous):
+            raise FallBack("%s has changed since the previous result" % branch)
+        old = [tuple(x) for x in state["inputs"]]
+        if old == new:
+            result = previous
+        else:
+            delete, add, dirs = plan(old, new, lists, max_delta)
+            sys.stderr.write("%s: %i paths to remove, %i inputs to add\n" % (
+                branch, len(delete), len(add)))
+            result = combine_incrementally(repo, previous, delete, add, dirs,
+                                           [c for _, c in new], lists)
+    except FallBack as e:
+        sys.stderr.write("%s: combining from scratch: %s\n" % (branch, e))
+        result = combine_from_scratch(repo, [c for _, c in new])
+
+    write_if_changed("%s/refs/heads/%s" % (repo, branch), result + "\n")
+    write_if_changed(state_filename, json.dumps(
+        {"commit": result, "inputs": new}, indent=0) + "\n")
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Combine ostree refs, starting from the last result")
+    parser.add_argument("--repo", required=True)
+    parser.add_argument("--branch", required=True)
+    parser.add_argument("--inputs", required=True,
+                        help="File listing the refs to combine, one per line")
+    parser.add_argument("--state", required=True,
+                        help="Where to remember what we combined last time")
+    parser.add_argument("--file-lists", required=True,
+                        help="Directory to cache the paths in each commit")
+    parser.add_argument("--max-delta", type=float, default=MAX_DELTA)
+    args = parser.parse_args(argv[1:])
+
+    with open(args.inputs) as f:
+        refs = [x.strip() for x in f if x.strip()]
+    combine(args.repo, args.branch, refs, args.state,
+            FileLists(args.repo, args.file_lists), args.max_delta)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+"""
+Decides whether `update_lockfile` needs to resolve the lockfile again.
+
+Resolving means aptly downloading the full Packages indices of every source,
+which is most of the time a nightly lockfile update takes.  But the indices
+only change when the InRelease file of the source does, and InRelease lists
+the SHA256 of every index.  So before running aptly we fetch InRelease for
+each source and pick out the checksums of the indices for our components and
+architecture.  If they, and the inputs of the rule, are the same as last
+time the lockfile is up to date and is left alone.
+
+InRelease is cached in `--cache`, one directory per archive URL and
+distribution, and only downloaded again if the server says it has changed
+(by ETag or Last-Modified).  The built-in resolver (`resolver.py`) gets its
+Packages indices from here too, cached per component and architecture and
+only downloaded again when InRelease says they've changed.
+
+    python -m apt2ostree.index_cache check --cache=DIR --state=FILE
+        --lockfile=LOCKFILE --inputs=STRING
+        --source URL DISTRIBUTION ARCHITECTURE COMPONENTS ...
+
+exits with status 0 if the lockfile is up to date.  Otherwise it exits with
+status 1 and writes the new state to FILE~, to be moved to FILE once the
+lockfile has been updated.
+"""
+
+import argparse
+import errno
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+if sys.version_info[0] >= 3:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+else:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+from .fetch import Fetcher
+from .ninja import write_if_changed
+from .resolver import lzma
+
+TIMEOUT = 60
+
+
+class IndexCache(object):
+    """The InRelease files of apt sources, cached in directory"""
+    def __init__(self, directory):
+        self.directory = directory
+        self._releases = {}
+
+    def _dir(self, archive_url, distribution):
+        key = "%s %s" % (archive_url.rstrip("/"), distribution)
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def release(self, archive_url, distribution):
+        """Returns the text of InRelease (or Release) for distribution,
+        downloading it again only if it has changed.  Returns None if the
+        archive has neither."""
+        return self._release(archive_url, distribution)[1]
+
+    def _release(self, archive_url, distribution):
+        d = self._dir(archive_url, distribution)
+        if d not in self._releases:
+            self._releases[d] = (None, None)
+            for name in ["InRelease", "Release"]:
+                url = "%s/dists/%s/%s" % (
+                    archive_url.rstrip("/"), distribution, name)
+                text = self._get(url, os.path.join(d, name))
+                if text is not None:
+                    self._releases[d] = (os.path.join(d, name), text)
+                    break
+        return self._releases[d]
+
+    def verified_release(self, archive_url, distribution, keyrings):
+        """Returns the text of InRelease for distribution, once gpgv has
+        checked that it's signed by one of keyrings"""
+        filename, _ = self._release(archive_url, distribution)
+        if filename is None or not filename.endswith("InRelease"):
+            raise ValueError("%s %s has no InRelease" % (
+                archive_url, distribution))
+        cmd = ["gpgv"]
+        for x in keyrings:
+            # gpgv looks for keyrings without a / in ~/.gnupg
+            cmd.append("--keyring=%s" % (x if "/" in x else "./" + x))
+        try:
+            return subprocess.check_output(
+                cmd + ["--output", "-", filename]).decode("utf-8")
+        except subprocess.CalledProcessError:
+            raise ValueError("Bad signature on %s for %s %s" % (
+                filename, archive_url, distribution))
+
+    def packages(self, archive_url, distribution, architecture, component,
+                 keyrings, fetcher=None):
+        """Returns the filename of the Packages index of component for
+        architecture, or None if there isn't one.  The indices are cached
+        per component and architecture and only downloaded again when
+        InRelease says they've changed."""
+        indices = release_indices(self.verified_release(
+            archive_url, distribution, keyrings))
+        for ext in ([".xz"] if lzma else []) + [".gz", ""]:
+            path = "%s/binary-%s/Packages%s" % (component, architecture, ext)
+            if path in indices:
+                break
+        else:
+            return None
+
+        d = os.path.join(self._dir(archive_url, distribution), component,
+                         "binary-" + architecture)
+        filename = os.path.join(d, indices[path] + ext)
+        if not os.path.exists(filename):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            if fetcher is None:
+                fetcher = Fetcher()
+            fetcher.fetch(["%s/dists/%s/%s" % (
+                archive_url.rstrip("/"), distribution, path)],
+                indices[path], filename)
+        # Only the latest version is worth keeping:
+        for x in os.listdir(d):
+            if x != os.path.basename(filename):
+                os.unlink(os.path.join(d, x))
+        return filename
+
+    def _get(self, url, filename):
+        headers = {}
+        try:
+            with open(filename + ".json") as f:
+                headers = json.load(f)
+            with open(filename) as f:
+                cached = f.read()
+        except (IOError, ValueError):
+            headers = {}
+            cached = None
+
+        request = Request(url)
+        if cached is not None:
+            if headers.get("ETag"):
+                request.add_header("If-None-Match", headers["ETag"])
+            if headers.get("Last-Modified"):
+                request.add_header("If-Modified-Since",
+                                   headers["Last-Modified"])
+        try:
+            response = urlopen(request, timeout=TIMEOUT)
+        except HTTPError as e:
+            if e.code == 304 and cached is not None:
+                return cached
+            elif e.code == 404:
+                return None
+            raise
+        except URLError as e:
+            if isinstance(e.reason, (IOError, OSError)) and \
+                    getattr(e.reason, "errno", None) == errno.ENOENT:
+                # A file: URL that doesn't exist
+                return None
+            raise
+        text = response.read().decode("utf-8")
+        info = response.info()
+        write_if_changed(filename, text)
+        write_if_changed(filename + ".json", json.dumps(dict(
+            (k, info.get(k)) for k in ["ETag", "Last-Modified"]),
+            sort_keys=True) + "\n")
+        return text
+
+    def checksums(self, archive_url, distribution, architecture, components):
+        """Returns a sorted list of "sha256 path" for the Packages indices of
+        components for architecture, or None if we can't tell"""
+        text = self.release(archive_url, distribution)
+        if text is None:
+            return None
+        return index_checksums(text, architecture, components)
+
+
+def release_indices(release):
+    """Returns a dict from the path of each file listed in the text of a
+    Release or InRelease file to its SHA256"""
+    out = {}
+    in_sha256 = False
+    for line in release.splitlines():
+        if not line.startswith(" "):
+            in_sha256 = line.strip() == "SHA256:"
+            continue
+        if in_sha256:
+            fields = line.split()
+            if len(fields) == 3:
+                out[fields[2]] = fields[0]
+    return out
+
+
+def index_checksums(release, architecture, components):
+    """Picks the SHA256s of the Packages indices for architecture (and "all")
+    in components out of the text of a Release or InRelease file"""
+    wanted = re.compile(r"^(%s)/binary-(%s|all)/Packages(\.\w+)?$" % (
+        "|".join(re.escape(x) for x in components), re.escape(architecture)))
+    return sorted("%s %s" % (sha256, path)
+                  for path, sha256 in release_indices(release).items()
+                  if wanted.match(path))
+
+
+def state(cache, inputs, sources):
+    """The state of the lockfile's inputs as text, or None if it can't be
+    worked out.  sources is a list of (archive_url, distribution,
+    architecture, components)."""
+    out = {"inputs": inputs, "sources": []}
+    for archive_url, distribution, architecture, components in sources:
+        checksums = cache.checksums(
+            archive_url, distribution, architecture, components)
+        if not checksums:
+            return None
+        out["sources"].append({
+            "archive_url": archive_url, "distribution": distribution,
+            "architecture": architecture, "components": components,
+            "indices": checksums})
+    return json.dumps(out, indent=1, sort_keys=True) + "\n"
+
+
+def check(cache, state_filename, lockfile, inputs, sources):
+    """Returns True if lockfile is up to date.  Otherwise writes the new state
+    to state_filename~ (if it can be worked out) and returns False."""
+    try:
+        os.unlink(state_filename + "~")
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    try:
+        new = state(cache, inputs, sources)
+    except (EnvironmentError, ValueError) as e:
+        sys.stderr.write("Can't check apt indices: %s\n" % e)
+        new = None
+    if new is None:
+        sys.stderr.write("%s: Updating lockfile\n" % lockfile)
+        return False
+
+    try:
+        with open(state_filename) as f:
+            old = f.read()
+    except IOError:
+        old = None
+    if old == new and os.path.exists(lockfile):
+        sys.stderr.write("%s: apt indices unchanged\n" % lockfile)
+        return True
+
+    write_if_changed(state_filename + "~", new)
+    return False
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check whether a lockfile's apt indices have changed")
+    parser.add_argument("command", choices=["check"])
+    parser.add_argument("--cache", required=True,
+                        help="Directory to cache InRelease files in")
+    parser.add_argument("--state", required=True,
+                        help="Where the state of the inputs is recorded")
+    parser.add_argument("--lockfile", required=True)
+    parser.add_argument("--inputs", default="",
+                        help="Anything else that affects the lockfile")
+    parser.add_argument(
+        "--source", nargs=4, action="append", default=[],
+        metavar=("URL", "DISTRIBUTION", "ARCHITECTURE", "COMPONENTS"))
+    args = parser.parse_args(argv[1:])
+
+    sources = [(url, dist, arch, components.split())
+               for url, dist, arch, components in args.source]
+    if check(IndexCache(args.cache), args.state, args.lockfile, args.inputs,
+             sources):
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,176 @@
+"""
+Random-access reader for apt Packages files such as our lockfiles.
+
+`parse_packages` builds a dict for every stanza by concatenating strings line
+by line.  Configure only needs a handful of fields from each stanza, so instead
+we memory-map the file, record where each stanza starts and ends and decode
+fields only when they're asked for.
+"""
+
+import mmap
+import os
+
+#: Fields decoded eagerly for each `Entry`.  These are the ones that
+#: `Apt.image_from_lockfile` needs for every package.
+ENTRY_FIELDS = (
+    ("package", b"Package"),
+    ("version", b"Version"),
+    ("filename", b"Filename"),
+    ("sha256", b"SHA256"),
+)
+
+
+class Lockfile(object):
+    """An index of the stanzas in an apt Packages file.
+
+    `f` is a file object opened in binary mode.  It may be closed once this
+    object has been constructed.
+    """
+    def __init__(self, f):
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # mmap refuses to map empty files
+            self._data = b""
+        else:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._spans = _find_stanzas(self._data)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __iter__(self):
+        return self.entries()
+
+    def entries(self):
+        """Yields an `Entry` for each stanza in file order"""
+        return self._entries(self._spans)
+
+    def difference(self, other):
+        """Yields an `Entry` for each stanza that isn't in the `Lockfile`
+        other, byte for byte.  Much quicker than comparing all the entries
+        when most of the stanzas are the same."""
+        data = other._data  # pylint: disable=protected-access
+        theirs = set(data[start:end] for start, end in other._spans)  # pylint: disable=protected-access
+        return self._entries([(start, end) for start, end in self._spans
+                              if self._data[start:end] not in theirs])
+
+    def _entries(self, spans):
+        data = self._data
+        keys = [(attr, b"\n" + name + b": ") for attr, name in ENTRY_FIELDS]
+        for start, end in spans:
+            entry = Entry(self, start, end)
+            for attr, key in keys:
+                # Fast path for the common case of a single line field that
+                # isn't on the first line of the stanza.  This is where
+                # configure spends its time so it's worth avoiding the
+                # function call overhead of `_get_field`.
+                pos = data.find(key, start, end)
+                if pos != -1:
+                    pos += len(key)
+                    eol = data.find(b"\n", pos, end)
+                    if eol != -1 and data[eol + 1:eol + 2] not in (
+                            b" ", b"\t"):
+                        setattr(entry, attr,
+                                data[pos:eol].decode("utf-8").strip())
+                        continue
+                setattr(entry, attr,
+                        _get_field(data, start, end, key[1:-2]))
+            yield entry
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.close()
+
+
+class Entry(object):
+    """A single stanza from a `Lockfile`.
+
+    `package`, `version`, `filename` and `sha256` are always available.  Any
+    other field can be read with `get`.
+    """
+    __slots__ = ("package", "version", "filename", "sha256", "_lockfile",
+                 "_start", "_end")
+
+    def __init__(self, lockfile, start, end):
+        self._lockfile = lockfile
+        self._start = start
+        self._end = end
+
+    def get(self, field, default=None):
+        value = _get_field(self._lockfile._data, self._start, self._end,  # pylint: disable=protected-access
+                           field.encode("utf-8"))
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def raw(self):
+        """The complete text of this stanza without the trailing blank line"""
+        data = self._lockfile._data  # pylint: disable=protected-access
+        return data[self._start:self._end].decode("utf-8")
+
+    def __repr__(self):
+        return "<Entry %s %s>" % (self.package, self.version)
+
+
+def _find_stanzas(data):
+    """Returns a list of (start, end) byte offsets, one per stanza.  `end` is
+    the offset of the newline terminating the last line of the stanza."""
+    spans = []
+    size = len(data)
+    pos = 0
+    while pos < size:
+        # Skip any blank lines between stanzas
+        while pos < size and data[pos:pos + 1] == b"\n":
+            pos += 1
+        if pos >= size:
+            break
+        end = data.find(b"\n\n", pos)
+        if end == -1:
+            end = size
+            if data[end - 1:end] == b"\n":
+                end -= 1
+        spans.append((pos, end))
+        pos = end + 2
+    return spans
+
+
+def _get_field(data, start, end, name):
+    """Decodes field `name` from the stanza data[start:end].  Continuation lines
+    are joined with newlines as `parse_packages` does.  Returns None if the
+    field isn't present."""
+    key = name + b": "
+    if data[start:start + len(key)] == key:
+        pos = start
+    else:
+        pos = data.find(b"\n" + key, start, end)
+        if pos == -1:
+            return None
+        pos += 1
+    pos += len(key)
+    eol = data.find(b"\n", pos, end)
+    if eol == -1:
+        return data[pos:end].decode("utf-8").strip()
+    if data[eol + 1:eol + 2] not in (b" ", b"\t"):
+        return data[pos:eol].decode("utf-8").strip()
+
+    # Multi-line field
+    lines = [data[pos:eol].decode("utf-8").strip()]
+    while eol < end and data[eol + 1:eol + 2] in (b" ", b"\t"):
+        pos = eol + 1
+        eol = data.find(b"\n", pos, end)
+        if eol == -1:
+            eol = end
+        lines.append(data[pos + 1:eol].decode("utf-8").strip())
+    return "\n".join(lines)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+"""
+Remembers how well each deb mirror has been performing so we try the best
+ones first.
+
+Without this every deb tries the mirrors in the order they're listed in
+`$builddir/deb_pool_mirrors`, so a dead or slow first mirror costs each of
+thousands of debs a timeout.  `MirrorHealth` keeps a success rate and moving
+averages of latency and throughput for each mirror in a JSON file under
+`$builddir`.  A mirror that fails repeatedly is quarantined: it's only tried
+after all the others, with the quarantine doubling in length each time it
+fails again.
+
+Like `deb_pool_mirrors` the cache is deliberately not part of the ninja
+dependency graph.  It affects how fast we download debs, never what we build.
+
+To see what we know:
+
+    python -m apt2ostree.mirror_health _build/mirror-health.json
+"""
+
+import errno
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+# Weight given to the newest sample in the moving averages
+EWMA_ALPHA = 0.2
+# Consecutive failures before a mirror is quarantined
+QUARANTINE_AFTER = 3
+QUARANTINE_SECONDS = 600
+MAX_QUARANTINE_SECONDS = 24 * 60 * 60
+# Used to combine latency and throughput into an expected download time
+TYPICAL_DEB_SIZE = 1024 * 1024
+# Throughput measured over less data than this is mostly latency
+MIN_THROUGHPUT_BYTES = 64 * 1024
+# How often the fetch service writes the cache back to disk
+SAVE_INTERVAL = 5
+
+
+class MirrorHealth(object):
+    """Thread-safe.  Multiple processes may share the same file: updates are
+    merged into whatever is on disk when we `save`."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._pending = []  # events not yet saved
+        self._last_save = time.time()
+        self.stats = _load(filename)
+
+    def mirror_of(self, url, mirrors):
+        """The mirror in mirrors that url belongs to or None"""
+        best = None
+        for mirror in mirrors:
+            prefix = mirror.rstrip("/") + "/"
+            if url.startswith(prefix) and (
+                    best is None or len(prefix) > len(best) + 1):
+                best = mirror.rstrip("/")
+        return best
+
+    def rank_urls(self, urls, mirrors):
+        """Returns urls sorted so the best mirrors come first.  URLs that don't
+        belong to any mirror (like the local file:// mirror) stay at the front
+        and the URLs for each mirror stay in the same order relative to each
+        other."""
+        now = time.time()
+        order = dict((m.rstrip("/"), n) for n, m in enumerate(mirrors))
+
+        def key(x):
+            n, url = x
+            mirror = self.mirror_of(url, mirrors)
+            if mirror is None:
+                return (0, False, 0.0, 0, n)
+            stats = self.stats.get(mirror)
+            return (1, _quarantined(stats, now), _score(stats),
+                    order[mirror], n)
+
+        with self._lock:
+            return [url for _, url in sorted(enumerate(urls), key=key)]
+
+    def record_success(self, mirror, latency, nbytes, seconds):
+        throughput = None
+        if nbytes >= MIN_THROUGHPUT_BYTES and seconds > 0:
+            throughput = nbytes / seconds
+        self._record(mirror, {"ok": True, "latency": latency,
+                              "throughput": throughput})
+
+    def record_failure(self, mirror):
+        self._record(mirror, {"ok": False})
+
+    def _record(self, mirror, event):
+        event["mirror"] = mirror
+        event["time"] = time.time()
+        with self._lock:
+            self._pending.append(event)
+            _apply(self.stats, event)
+
+    def maybe_save(self):
+        """Saves if we haven't saved in a while"""
+        if time.time() - self._last_save > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_save = time.time()
+        if not pending:
+            return
+        d = os.path.dirname(self.filename)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+        with open(self.filename + ".lock", "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            stats = _load(self.filename)
+            for event in pending:
+                _apply(stats, event)
+            with open(self.filename + "~", "w") as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
+                f.write("\n")
+            os.rename(self.filename + "~", self.filename)
+        with self._lock:
+            # Pick up what other processes have learnt too
+            for event in self._pending:
+                _apply(stats, event)
+            self.stats = stats
+
+
+def _load(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        # Corrupt.  It's only a cache.
+        pass
+    return {}
+
+
+def _apply(stats, event):
+    s = stats.setdefault(event["mirror"], {
+        "successes": 0, "failures": 0, "consecutive_failures": 0,
+        "latency": None, "throughput": None, "quarantined_until": 0})
+    if event["ok"]:
+        s["successes"] += 1
+        s["consecutive_failures"] = 0
+        s["quarantined_until"] = 0
+        s["latency"] = _ewma(s["latency"], event["latency"])
+        s["throughput"] = _ewma(s["throughput"], event["throughput"])
+    else:
+        s["failures"] += 1
+        s["consecutive_failures"] += 1
+        n = s["consecutive_failures"] - QUARANTINE_AFTER
+        if n >= 0:
+            s["quarantined_until"] = event["time"] + min(
+                QUARANTINE_SECONDS * 2 ** n, MAX_QUARANTINE_SECONDS)
+
+
+def _ewma(old, sample):
+    if sample is None:
+        return old
+    if old is None:
+        return sample
+    return old + EWMA_ALPHA * (sample - old)
+
+
+def _quarantined(stats, now):
+    return stats is not None and stats["quarantined_until"] > now
+
+
+def _score(stats):
+    """Expected seconds to download a typical deb, allowing for retries.
+    Lower is better.  Mirrors we know nothing about score 0 so they get tried
+    and we learn about them."""
+    if stats is None:
+        return 0.0
+    if not stats["successes"] or stats["latency"] is None:
+        return float("inf") if stats["failures"] else 0.0
+    expected = stats["latency"]
+    if stats["throughput"]:
+        expected += TYPICAL_DEB_SIZE / stats["throughput"]
+    success_rate = (stats["successes"] + 1.0) / (
+        stats["successes"] + stats["failures"] + 2.0)
+    return expected / success_rate
+
+
+def main(argv):
+    if len(argv) != 2:
+        sys.stderr.write("Usage: %s <mirror-health.json>\n" % argv[0])
+        return 1
+    stats = _load(argv[1])
+    now = time.time()
+    sys.stdout.write("%8s %8s %9s %11s %9s  %s\n" % (
+        "ok", "failed", "latency", "throughput", "score", "mirror"))
+    for mirror in sorted(stats, key=lambda m: (
+            _quarantined(stats[m], now), _score(stats[m]))):
+        s = stats[mirror]
+        sys.stdout.write("%8i %8i %8.3fs %9.0fk/s %8.3fs  %s%s\n" % (
+            s["successes"], s["failures"], s["latency"] or 0,
+            (s["throughput"] or 0) / 1024, _score(s), mirror,
+            " (quarantined)" if _quarantined(s, now) else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
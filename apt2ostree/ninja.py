@@ -1,41 +1,198 @@
 import errno
 import hashlib
+import json
+import multiprocessing
 import os
 import pipes
 import re
 import sys
 import textwrap
 import traceback
+if sys.version_info[0] >= 3:
+    from io import StringIO
+else:
+    from StringIO import StringIO
+from collections import OrderedDict
 
-from . import ninja_syntax
+from . import ninja_syntax, profiling
 
 NINJA_AUTO_VARS = set(["in", "out", "_args_digest"])
 ALREADY_WRITTEN = "ALREADY_WRITTEN"
 
+# Value for `Ninja(debug=...)`.  Record the Python stack that generated each
+# build statement in a sidecar file rather than as comments in the ninja file.
+# Use `python -m apt2ostree.provenance explain <target>` to read it.
+PROVENANCE = "provenance"
+
+# When ninja reruns configure to regenerate a single fragment it sets this
+# environment variable to the filename of the fragment.  Nothing else is
+# written.
+FRAGMENTS_ENV = "APT2OSTREE_NINJA_FRAGMENTS"
+
+# ninja's own pool that gives an edge the terminal, one at a time
+CONSOLE_POOL = "console"
+
+
+def default_pool_depths(cpus=None):
+    """The depths of the ninja pools used by the rules in apt.py and
+    ostree.py for a machine with cpus CPUs:
+
+    network: Edges that download.  They spend most of their time waiting on
+        the mirrors, so there are more of them than CPUs, but not so many that
+        they take every job slot.
+    ostree_write: Edges that commit to the ostree repo, which are mostly
+        limited by the disk.
+    heavy_checkout: Edges that check out or rewrite whole images in scratch
+        space.
+    """
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+    return {
+        "network": max(4, min(cpus + 2, 16)),
+        "ostree_write": max(2, cpus // 2),
+        "heavy_checkout": max(1, cpus // 4),
+    }
+
+
+# Default for `Ninja(compact=...)`
+COMPACT_ENV = "APT2OSTREE_NINJA_COMPACT"
+
+
+class _GraphWriter(ninja_syntax.Writer):
+    """The parts common to `Ninja` and `Fragment`.  Subclasses provide
+    `compact`, `debug`, `global_vars`, `profiler`, `provenance`, `rules` and
+    `targets`."""
+
+    def _instrument(self):
+        """Time the escaping and line wrapping done by `ninja_syntax.Writer`
+        if profiling is enabled"""
+        if self.profiler is not None:
+            self._escape_paths = self.profiler.wrap(
+                "ninja_syntax escape_path", self._escape_paths)
+            self._line = self.profiler.wrap(
+                "ninja_syntax _line", self._line)
 
-class Ninja(ninja_syntax.Writer):
+    def build(self, outputs, rule, inputs=None,
+              allow_non_identical_duplicates=False,
+              **kwargs):  # pylint: disable=arguments-differ
+        outputs = ninja_syntax.as_list(outputs)
+        inputs = ninja_syntax.as_list(inputs)
+        with profiling.timer(self.profiler, "Ninja.build sha256"):
+            s = hashlib.sha256()
+            s.update(str((rule, inputs, sorted(kwargs.items()))).encode('utf-8'))
+            rulehash = s.hexdigest()
+        for x in outputs:
+            try:
+                with profiling.timer(self.profiler, "Ninja.build add_target"):
+                    added = self.add_target(x, rulehash)
+                if added == ALREADY_WRITTEN:
+                    # Its a duplicate build statement, but it's identical to the
+                    # last time it was written so that's ok.
+                    return outputs
+            except DuplicateTarget:
+                if allow_non_identical_duplicates:
+                    return outputs
+                else:
+                    raise
+        if self.debug == PROVENANCE:
+            self.provenance.record(outputs)
+        elif self.debug:
+            self.output.write("# Generated by:\n")
+            stack = traceback.format_stack()[:-1]
+            for frame in stack:
+                for line in frame.split("\n"):
+                    if line:
+                        self.output.write("# ")
+                        self.output.write(line)
+                        self.output.write("\n")
+        return super(_GraphWriter, self).build(
+            outputs, rule, inputs=inputs, **kwargs)
+
+    def rule(self, name, *args, **kwargs):  # pylint: disable=arguments-differ
+        if name in self.rules:
+            assert self.rules[name] == (args, kwargs)
+        else:
+            self.rules[name] = (args, kwargs)
+            super(_GraphWriter, self).rule(name, *args, **kwargs)
+
+    def add_target(self, target, rulehash=None):
+        if not target:
+            raise RuntimeError("Invalid target filename %r" % target)
+        if target in self.targets:
+            if self.targets[target] == rulehash:
+                return ALREADY_WRITTEN
+            else:
+                raise DuplicateTarget(
+                    "Duplicate target %r with different rule" % target)
+        else:
+            self.targets[target] = rulehash
+            return None
+
+
+class Ninja(_GraphWriter):
     builddir = "_build"
 
-    def __init__(self, regenerate_command=None, width=78, debug=True,
-                 ninjafile="build.ninja", standalone=True):
+    def __init__(self, regenerate_command=None, width=78, debug=PROVENANCE,
+                 ninjafile="build.ninja", standalone=True, profile=None,
+                 compact=None):
+        """debug can be PROVENANCE (the default) to record where each build
+        statement came from in a sidecar file, True to write the Python stack
+        into the ninja file as comments, or False to do neither.
+
+        profile can be True to profile configure (see `profiling`), or the
+        filename to write the profile JSON to.  The default is taken from the
+        environment variable APT2OSTREE_PROFILE.
+
+        compact=True gives rules without a description of their own just the
+        rule name and its outputs as a description, rather than all their
+        variables, so ninja's progress lines are shorter.  Descriptions are
+        per rule, so it makes no real difference to the size of the ninja
+        files or how long ninja takes to load them.  The default is taken from
+        the environment variable APT2OSTREE_NINJA_COMPACT."""
+        if compact is None:
+            compact = os.environ.get(COMPACT_ENV, "0") not in ("", "0")
+        self.compact = compact
         if regenerate_command is None:
             regenerate_command = sys.argv
+        if profile is None:
+            profile = os.environ.get(profiling.PROFILE_ENV) or False
+            if profile in ("0", "1"):
+                profile = profile == "1"
+        if profile is True:
+            profile = "%s/profile-%s.json" % (self.builddir, ninjafile)
+        self.profile_filename = profile or None
+        self.profiler = profiling.Profiler() if profile else None
 
         self.debug = debug
         self.ninjafile = ninjafile
         self.standalone = standalone
 
-        output = open(self.ninjafile + '~', 'w')
+        # Set when we've been rerun by ninja just to regenerate some fragments
+        self.only_fragments = None
+        if os.environ.get(FRAGMENTS_ENV):
+            self.only_fragments = set(os.environ[FRAGMENTS_ENV].split())
+
+        # Buffered so the pools can be written at the top when we're closed
+        if self.only_fragments is None:
+            output = StringIO()
+        else:
+            output = open(os.devnull, 'w')
         super(Ninja, self).__init__(output, width)
         self.global_vars = {}
         self.targets = {}
         self.rules = {}
+        self.pools = OrderedDict()
+        self._pools_set = set()  # pools whose depth was given explicitly
         self.generator_deps = set()
+        self.fragments = OrderedDict()
+        self.provenance = Provenance() if debug == PROVENANCE else None
+        self._instrument()
 
         self.add_generator_dep(__file__)
         self.add_generator_dep(ninja_syntax.__file__)
         self.add_generator_dep(__file__ + '/../ostree.py')
         self.add_generator_dep(__file__ + '/../multistrap.py')
+        self.add_generator_dep(profiling.__file__)
 
         self.regenerate_command = regenerate_command
         self.variable("builddir", self.builddir)
@@ -44,30 +201,101 @@ class Ninja(ninja_syntax.Writer):
         if self.standalone:
             # Write a reconfigure script to rememeber arguments passed to
             # configure:
-            reconfigure = "%s/reconfigure-%s" % (self.builddir, ninjafile)
-            self.add_target(reconfigure)
+            self.reconfigure = "%s/reconfigure-%s" % (self.builddir, ninjafile)
+            self.add_target(self.reconfigure)
             try:
                 os.mkdir(self.builddir)
             except OSError as e:
                 if e.errno != errno.EEXIST:
                     raise
-            with open(reconfigure, 'w') as f:
-                f.write("#!/bin/sh\nexec %s\n" % (
-                    shquote(["./" + os.path.relpath(self.regenerate_command[0])]
-                            + self.regenerate_command[1:])))
-            os.chmod(reconfigure, 0o755)
-            self.rule("configure", reconfigure, generator=True)
+            if self.only_fragments is None:
+                with open(self.reconfigure, 'w') as f:
+                    f.write("#!/bin/sh\nexec %s\n" % (
+                        shquote(["./" + os.path.relpath(
+                            self.regenerate_command[0])]
+                                + self.regenerate_command[1:])))
+                os.chmod(self.reconfigure, 0o755)
+            self.rule("configure", self.reconfigure, generator=True)
 
         self.add_target("%s/.ninja_deps" % self.builddir)
         self.add_target("%s/.ninja_log" % self.builddir)
+        if self.provenance:
+            self.add_target(sidecar_filename(self.ninjafile, self.builddir))
+        if self.profiler:
+            self.add_target(self.profile_filename)
 
     def close(self):
         if not self.output.closed:
+            for fragment in self.fragments.values():
+                fragment.close()
+                self.subninja(fragment.filename)
             if self.standalone:
-                self.build(self.ninjafile, "configure",
-                           list(self.generator_deps))
+                self._write_generator_rules()
+            if self.only_fragments is None:
+                with open(self.ninjafile + '~', 'w') as f:
+                    header = ninja_syntax.Writer(f, self.width)
+                    for name, depth in self.pools.items():
+                        header.pool(name, depth)
+                    f.write(self.output.getvalue())
             super(Ninja, self).close()
-            os.rename(self.ninjafile + '~', self.ninjafile)
+            if self.only_fragments is None:
+                if self.standalone and self.fragments:
+                    # Written before ninjafile so ninja doesn't consider
+                    # ninjafile out-of-date as soon as it loads it:
+                    with open(self.configure_stamp, 'w'):
+                        pass
+                if self.provenance:
+                    write_if_changed(
+                        sidecar_filename(self.ninjafile, self.builddir),
+                        self.provenance.to_json(
+                            sidecar_filename(x, self.builddir)
+                            for x in self.fragments))
+                os.rename(self.ninjafile + '~', self.ninjafile)
+            if self.profiler:
+                self._write_profile()
+
+    def _write_profile(self):
+        sys.stderr.write(self.profiler.report())
+        if self.only_fragments is None:
+            d = os.path.dirname(self.profile_filename)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            with open(self.profile_filename, 'w') as f:
+                f.write(self.profiler.to_json())
+
+    def _write_generator_rules(self):
+        if not self.fragments:
+            self.build(self.ninjafile, "configure", list(self.generator_deps))
+            return
+
+        # ninja only rebuilds (and reloads) the ninjafile itself before
+        # starting a build, so the ninjafile depends on the fragments.
+        # Rebuilding the ninjafile is just a touch to get ninja to reload it.
+        # The full configure is represented by a stamp file so a change to a
+        # fragment's deps only causes that fragment to be regenerated.
+        self.build(self.configure_stamp, "configure",
+                   implicit=sorted(self.generator_deps))
+
+        self.rule("configure_fragment",
+                  "%s=$out %s" % (FRAGMENTS_ENV, self.reconfigure),
+                  description="Regenerating $out", generator=True,
+                  restat=True)
+        for fragment in self.fragments.values():
+            # Bypassing self.build because the fragment was already registered
+            # as a target by `fragment()`:
+            ninja_syntax.Writer.build(
+                self, fragment.filename, "configure_fragment",
+                sorted(fragment.deps), order_only=[self.configure_stamp],
+                implicit_outputs=sorted(fragment.outputs))
+
+        self.rule("touch_ninjafile", "touch $out",
+                  description="Reloading $out", generator=True)
+        self.build(self.ninjafile, "touch_ninjafile",
+                   [self.configure_stamp] + list(self.fragments))
+
+    @property
+    def configure_stamp(self):
+        return "%s/configure-%s.stamp" % (self.builddir, self.ninjafile)
 
     def __enter__(self):
         return self
@@ -89,41 +317,27 @@ class Ninja(ninja_syntax.Writer):
             self.global_vars[key] = value
         super(Ninja, self).variable(key, value, indent)
 
-    def build(self, outputs, rule, inputs=None,
-              allow_non_identical_duplicates=False,
-              **kwargs):  # pylint: disable=arguments-differ
-        outputs = ninja_syntax.as_list(outputs)
-        inputs = ninja_syntax.as_list(inputs)
-        for x in outputs:
-            s = hashlib.sha256()
-            s.update(str((rule, inputs, sorted(kwargs.items()))).encode('utf-8'))
-            try:
-                if self.add_target(x, s.hexdigest()) == ALREADY_WRITTEN:
-                    # Its a duplicate build statement, but it's identical to the
-                    # last time it was written so that's ok.
-                    return outputs
-            except DuplicateTarget:
-                if allow_non_identical_duplicates:
-                    return outputs
-                else:
-                    raise
-        if self.debug:
-            self.output.write("# Generated by:\n")
-            stack = traceback.format_stack()[:-1]
-            for frame in stack:
-                for line in frame.split("\n"):
-                    if line:
-                        self.output.write("# ")
-                        self.output.write(line)
-                        self.output.write("\n")
-        return super(Ninja, self).build(outputs, rule, inputs=inputs, **kwargs)
-
-    def rule(self, name, *args, **kwargs):  # pylint: disable=arguments-differ
-        if name in self.rules:
-            assert self.rules[name] == (args, kwargs)
-        else:
-            self.rules[name] = (args, kwargs)
-            super(Ninja, self).rule(name, *args, **kwargs)
+    def pool(self, name, depth=None):  # pylint: disable=arguments-differ
+        """Declares the pool name.  depth defaults to the one from
+        `default_pool_depths`.  The pools are written at the top of the ninja
+        file when it's closed, so a pool can be declared after the rules that
+        use it, and an explicit depth replaces the default even if the pool
+        was already used.  Giving two different depths is an error."""
+        if name == CONSOLE_POOL:
+            return
+        if depth is None:
+            if name not in self.pools:
+                try:
+                    self.pools[name] = default_pool_depths()[name]
+                except KeyError:
+                    raise ValueError("Unknown pool %s" % name)
+            return
+        if name in self._pools_set and depth != self.pools[name]:
+            raise RuntimeError(
+                "Setting depth of pool %s to %i, when it was already "
+                "set to %i" % (name, depth, self.pools[name]))
+        self.pools[name] = depth
+        self._pools_set.add(name)
 
     def open(self, filename, mode='r', **kwargs):
         if 'w' in mode:
@@ -147,37 +361,197 @@ class Ninja(ninja_syntax.Writer):
         else:
             return open(filename, mode, **kwargs)
 
+    def write_file(self, filename, contents, mode=None):
+        """Writes a file that depends only on the Python code and the files
+        passed to `add_generator_dep`.  It's only rewritten if its contents
+        have changed, and not at all when configure has been rerun just to
+        regenerate fragments as those reruns may run in parallel."""
+        self.add_target(filename)
+        if self.only_fragments is None:
+            write_if_changed(filename, contents)
+            if mode is not None:
+                os.chmod(filename, mode)
+
     def add_generator_dep(self, filename):
         """Cause configure to be rerun if changes are made to filename"""
         self.generator_deps.add(
             os.path.relpath(filename).replace('.pyc', '.py'))
 
-    def add_target(self, target, rulehash=None):
-        if not target:
-            raise RuntimeError("Invalid target filename %r" % target)
-        if target in self.targets:
-            if self.targets[target] == rulehash:
-                return ALREADY_WRITTEN
-            else:
-                raise DuplicateTarget(
-                    "Duplicate target %r with different rule" % target)
-        else:
-            self.targets[target] = rulehash
-            return None
+    def fragment(self, filename):
+        """Returns the `Fragment` that will be written to `filename` and
+        included from this ninja file with `subninja`"""
+        if filename not in self.fragments:
+            self.add_target(filename)
+            if self.provenance:
+                self.add_target(sidecar_filename(filename, self.builddir))
+            self.fragments[filename] = Fragment(self, filename)
+        return self.fragments[filename]
 
     def write_gitignore(self, filename=None):
         if filename is None:
             filename = "%s/.gitignore" % self.builddir
         self.add_target(filename)
+        if self.only_fragments is not None:
+            return
         with open(filename, 'w') as f:
             for x in self.targets:
                 f.write("%s\n" % os.path.relpath(x, os.path.dirname(filename)))
 
 
+class Fragment(_GraphWriter):
+    """
+    A part of the build graph that is written to its own file and included from
+    the main ninja file with `subninja`.
+
+    The contents of a fragment must depend only on the Python code and on the
+    files passed to `add_dep`.  In return, when those files change ninja
+    regenerates just this fragment rather than rerunning the whole of configure.
+    The file is only rewritten if its contents have changed.
+
+    `enabled` is False when configure has been rerun to regenerate some other
+    fragment.  Callers can check it to skip work whose output would be thrown
+    away.
+    """
+    def __init__(self, parent, filename):
+        super(Fragment, self).__init__(StringIO(), parent.width)
+        self.parent = parent
+        self.filename = filename
+        self.enabled = (parent.only_fragments is None or
+                        filename in parent.only_fragments)
+        self.deps = set()
+        self.outputs = set()
+        self.rules = {}
+        self.provenance = Provenance() if self.debug == PROVENANCE else None
+        self._instrument()
+
+    @property
+    def compact(self):
+        return self.parent.compact
+
+    @property
+    def debug(self):
+        return self.parent.debug
+
+    @property
+    def profiler(self):
+        return self.parent.profiler
+
+    @property
+    def global_vars(self):
+        return self.parent.global_vars
+
+    @property
+    def targets(self):
+        return self.parent.targets
+
+    def pool(self, name, depth=None):  # pylint: disable=arguments-differ
+        """Pools are declared in the main ninja file so every fragment can
+        use them"""
+        self.parent.pool(name, depth)
+
+    def add_dep(self, filename):
+        """Cause this fragment to be regenerated if changes are made to
+        filename"""
+        self.deps.add(os.path.relpath(filename))
+        if not self.parent.standalone:
+            self.parent.add_generator_dep(filename)
+
+    def write_file(self, filename, contents):
+        """Writes a file that, like this fragment, depends only on the Python
+        code and on the files passed to `add_dep`.  It's regenerated along
+        with the fragment so build statements in the fragment can use it as
+        an input."""
+        self.outputs.add(os.path.relpath(filename))
+        self.parent.add_target(filename)
+        if self.enabled:
+            write_if_changed(filename, contents)
+
+    def close(self):
+        if not self.output.closed:
+            if self.enabled:
+                write_if_changed(self.filename, self.output.getvalue())
+                if self.provenance:
+                    write_if_changed(
+                        sidecar_filename(self.filename, self.parent.builddir),
+                        self.provenance.to_json())
+            super(Fragment, self).close()
+
+
+class Provenance(object):
+    """A compact index from build target to the Python stack that generated its
+    build statement"""
+
+    def __init__(self):
+        self.frames = {}  # (filename, lineno, name) -> frame id
+        self.stacks = {}  # tuple of frame ids -> stack id
+        self.targets = {}  # target -> stack id
+
+    def record(self, targets, skip=1):
+        """Record the current Python stack as the origin of targets.  The
+        innermost `skip` frames (not counting this one) are left out."""
+        frame = sys._getframe(skip + 1)  # pylint: disable=protected-access
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, frame.f_lineno, code.co_name)
+            frame_id = self.frames.get(key)
+            if frame_id is None:
+                frame_id = self.frames[key] = len(self.frames)
+            stack.append(frame_id)
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        stack_id = self.stacks.get(stack)
+        if stack_id is None:
+            stack_id = self.stacks[stack] = len(self.stacks)
+        for target in targets:
+            self.targets[target] = stack_id
+
+    def to_json(self, includes=None):
+        frames = [None] * len(self.frames)
+        for key, n in self.frames.items():
+            frames[n] = list(key)
+        stacks = [None] * len(self.stacks)
+        for key, n in self.stacks.items():
+            stacks[n] = list(key)
+        return json.dumps({
+            "frames": frames,
+            "stacks": stacks,
+            "targets": self.targets,
+            "includes": sorted(includes or []),
+        }, sort_keys=True, separators=(",", ":")) + "\n"
+
+
 class DuplicateTarget(RuntimeError):
     pass
 
 
+def sidecar_filename(ninjafile, builddir="_build"):
+    """Where the `Provenance` for ninjafile is written"""
+    if ninjafile.startswith(builddir + "/"):
+        return ninjafile + ".provenance.json"
+    else:
+        return "%s/provenance-%s.json" % (builddir, ninjafile)
+
+
+def write_if_changed(filename, contents):
+    """Writes contents to filename.  The file (and its mtime) is left alone if
+    it already has those contents."""
+    try:
+        with open(filename) as f:
+            if f.read() == contents:
+                return False
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    d = os.path.dirname(filename)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    with open(filename + '~', 'w') as f:
+        f.write(contents)
+    os.rename(filename + '~', filename)
+    return True
+
+
 def _is_string(val):
     if sys.version_info[0] >= 3:
         str_type = str
@@ -227,13 +601,20 @@ class Rule(object):
 
         self.vars = vars_in(command).union(vars_in(inputs)).union(vars_in(outputs))
 
+        self.short_description = description or "%s $out" % self.name
         if description is None:
             description = "%s(%s)" % (self.name, ", ".join(
-                "%s=$%s" % (x, x) for x in self.vars))
+                "%s=$%s" % (x, x) for x in sorted(self.vars)))
         self.description = description
 
     def build(self, ninja, outputs=None, inputs=None, implicit=None,
               order_only=None, implicit_outputs=None, pool=None, **kwargs):
+        with profiling.timer(ninja.profiler, "Rule.build %s" % self.name):
+            return self._build(ninja, outputs, inputs, implicit, order_only,
+                               implicit_outputs, pool, **kwargs)
+
+    def _build(self, ninja, outputs, inputs, implicit, order_only,
+               implicit_outputs, pool, **kwargs):
         if outputs is None:
             outputs = []
         if inputs is None:
@@ -242,8 +623,13 @@ class Rule(object):
             order_only = []
         if implicit is None:
             implicit = []
+        for x in [self.kwargs.get("pool"), pool]:
+            if x:
+                ninja.pool(x)
         ninja.newline()
-        ninja.rule(self.name, self.command, description=self.description,
+        ninja.rule(self.name, self.command,
+                   description=(self.short_description if ninja.compact
+                                else self.description),
                    **self.kwargs)
         v = set(kwargs.keys())
         missing_args = self.vars - v - set(ninja.global_vars.keys()) - NINJA_AUTO_VARS
@@ -66,20 +66,19 @@ class Writer(object):
     def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
               variables=None, implicit_outputs=None, pool=None):
         outputs = as_list(outputs)
-        out_outputs = [escape_path(x) for x in outputs]
-        all_inputs = [escape_path(x) for x in as_list(inputs)]
+        out_outputs = self._escape_paths(outputs)
+        all_inputs = self._escape_paths(as_list(inputs))
 
         if implicit:
-            implicit = [escape_path(x) for x in as_list(implicit)]
+            implicit = self._escape_paths(as_list(implicit))
             all_inputs.append('|')
             all_inputs.extend(implicit)
         if order_only:
-            order_only = [escape_path(x) for x in as_list(order_only)]
+            order_only = self._escape_paths(as_list(order_only))
             all_inputs.append('||')
             all_inputs.extend(order_only)
         if implicit_outputs:
-            implicit_outputs = [escape_path(x)
-                                for x in as_list(implicit_outputs)]
+            implicit_outputs = self._escape_paths(as_list(implicit_outputs))
             out_outputs.append('|')
             out_outputs.extend(implicit_outputs)
 
@@ -108,6 +107,9 @@ class Writer(object):
     def default(self, paths):
         self._line('default %s' % ' '.join(as_list(paths)))
 
+    def _escape_paths(self, paths):
+        return [escape_path(x) for x in paths]
+
     def _count_dollars_before_index(self, s, i):
         """Returns the number of '$' characters right in front of s[i]."""
         dollar_count = 0
@@ -1,7 +1,14 @@
+import hashlib
 from collections import namedtuple
 
 from .ninja import Rule
 
+# Default number of inputs to each commit made by `ostree_combine_tree`
+COMBINE_FANOUT = 32
+
+# The socket of the ostree worker, if enabled.  See `ostree_worker.py`.
+OSTREE_WORKER_ENV = "APT2OSTREE_OSTREE_WORKER"
+
 
 class OstreeRef(namedtuple("OstreeImage", "filename")):
     @property
@@ -23,14 +30,109 @@ ostree_combine = Rule(
     "ostree_combine", """\
         echo $in
          | sed 's,$ostree_repo/refs/heads/,--tree=ref=,g'
-         | xargs -xr ostree --repo=$ostree_repo commit -b $branch --no-bindings
-                            --orphan --timestamp=0;
+         | xargs -xr $ostree --repo=$ostree_repo commit -b $branch
+                            --no-bindings --orphan --timestamp=0;
         [ -e $out ]""",
     restat=True,
     output_type=OstreeRef,
     outputs=["$ostree_repo/refs/heads/$branch"],
     order_only=["$ostree_repo/config"],
-    description="Ostree Combine for $branch")
+    description="Ostree Combine for $branch",
+    pool="ostree_write")
+
+
+def ostree_combine_tree(ninja, inputs, branch, keys=None,
+                        fanout=COMBINE_FANOUT, nodes_ninja=None):
+    """Like `ostree_combine.build` but for any number of inputs.  Rather than
+    one commit with a `--tree=ref=` for every input the inputs are combined
+    through a balanced tree of intermediate commits, each with about `fanout`
+    inputs.
+
+    Where one level of the tree is split into groups is decided by hashing
+    `keys` (one per input, defaulting to the inputs themselves) so adding,
+    removing or changing one input only changes the intermediate commits on
+    its path to the root.  Use stable keys like package names so a new version
+    of a package doesn't move the boundaries either.
+
+    The intermediate commits are named after their inputs so they're shared
+    between trees.  Their build edges are written to `nodes_ninja`, which
+    defaults to `ninja`."""
+    if fanout < 2:
+        raise ValueError("fanout must be at least 2, not %r" % fanout)
+    if keys is None:
+        keys = inputs
+    if nodes_ninja is None:
+        nodes_ninja = ninja
+    items = list(zip(keys, inputs))
+    level = 0
+    while len(items) > fanout:
+        chunks = _split_chunks(items, fanout, level)
+        if len(chunks) == 1:
+            break
+        next_items = []
+        for chunk in chunks:
+            chunk_inputs = [x for _, x in chunk]
+            if len(chunk_inputs) == 1:
+                next_items.append(chunk[0])
+                continue
+            digest = hashlib.sha256(
+                " ".join(chunk_inputs).encode("utf-8")).hexdigest()
+            node = ostree_combine.build(
+                nodes_ninja, inputs=chunk_inputs,
+                branch="deb/combined/%s" % digest)
+            next_items.append((chunk[-1][0], node.filename))
+        items = next_items
+        level += 1
+    return ostree_combine.build(
+        ninja, inputs=[x for _, x in items], branch=branch)
+
+
+def _split_chunks(items, fanout, level):
+    """Splits items into runs ending where the hash of the key is 0 modulo
+    fanout, so on average fanout long.  Runs are capped at 2 * fanout."""
+    chunks = []
+    chunk = []
+    for key, value in items:
+        chunk.append((key, value))
+        h = int(hashlib.sha256(
+            ("%i %s" % (level, key)).encode("utf-8")).hexdigest()[:8], 16)
+        if h % fanout == 0 or len(chunk) >= 2 * fanout:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+# See `incremental.py`.  $inputs_file lists the refs to combine.  They're
+# passed to `build` as `implicit` dependencies rather than on the command
+# line.
+ostree_combine_incremental = Rule(
+    "ostree_combine_incremental", """\
+        $apt2ostree_python -m apt2ostree.incremental
+            --repo=$ostree_repo --branch=$branch --inputs=$inputs_file
+            --state=$builddir/incremental/$branch.json
+            --file-lists=$builddir/incremental/file-lists""",
+    restat=True,
+    output_type=OstreeRef,
+    inputs=["$inputs_file"],
+    outputs=["$ostree_repo/refs/heads/$branch"],
+    order_only=["$ostree_repo/config"],
+    description="Incremental combine for $branch",
+    pool="ostree_write")
+
+ostree_assert_same = Rule(
+    "ostree_assert_same", """\
+        if ! cmp $in; then
+            ostree --repo=$ostree_repo diff $a $b;
+            echo "$a and $b differ" >&2;
+            exit 1;
+        fi;
+        mkdir -p $$(dirname $out);
+        touch $out""",
+    inputs=["$ostree_repo/refs/heads/$a", "$ostree_repo/refs/heads/$b"],
+    outputs=["$builddir/ostree_assert_same/$b.stamp"],
+    description="Checking $a and $b are the same")
 
 ostree_addfile = Rule(
     "file_into_ostree", """\
@@ -48,4 +150,74 @@ ostree_addfile = Rule(
     inputs=["$ostree_repo/refs/heads/$in_branch", "$in_file"],
     output_type=OstreeRef,
     outputs=["$ostree_repo/refs/heads/$out_branch"],
-    description="Add file $in_branch")
+    description="Add file $in_branch",
+    pool="ostree_write")
+
+
+# Publishing.  Devices pull from an archive mode repo, which stores objects
+# compressed.  Each image is committed there with the previous published
+# commit of its branch as parent and a timestamp, as ostree clients won't
+# move to an older commit, and a static delta from the previous commit is
+# generated so devices only download what has changed.  The commit is only
+# made if the image has changed since it was last published: the source
+# commit is recorded in the metadata key apt2ostree.source.  The edges are
+# in the ostree_write pool so ninja compresses several images at once.
+ostree_init_archive = Rule("ostree_init_archive", """\
+    mkdir -p $publish_repo;
+    ostree init --repo=$publish_repo --mode=archive-z2;
+    """, outputs=['$publish_repo/config'], restat=True)
+
+ostree_publish = Rule(
+    "ostree_publish", """\
+        set -ex;
+        new=$$(cat $in);
+        old=$$(cat $out 2>/dev/null || true);
+        if [ -n "$$old" ] && [ "$$(ostree --repo=$publish_repo show
+                --print-metadata-key=apt2ostree.source $$old)" = "'$$new'" ];
+        then
+            exit 0;
+        fi;
+        ostree --repo=$publish_repo pull-local $ostree_repo $$new;
+        ostree --repo=$publish_repo commit --branch=$publish_branch
+            --tree=ref=$$new $${old:+--parent=$$old}
+            --add-metadata-string=apt2ostree.source=$$new
+            --subject="$in_branch $$new" $gpg_args;
+        if [ -n "$$old" ]; then
+            ostree --repo=$publish_repo static-delta generate
+                --from=$$old --to=$$(cat $out);
+        fi""",
+    restat=True,
+    inputs=["$ostree_repo/refs/heads/$in_branch"],
+    output_type=OstreeRef,
+    outputs=["$publish_repo/refs/heads/$publish_branch"],
+    order_only=["$publish_repo/config"],
+    description="Publish $in_branch to $publish_repo",
+    pool="ostree_write")
+
+ostree_summary = Rule(
+    "ostree_summary", """\
+        ostree --repo=$publish_repo summary --update $gpg_args""",
+    outputs=["$publish_repo/summary"],
+    order_only=["$publish_repo/config"],
+    description="Update summary of $publish_repo")
+
+
+def ostree_publish_images(ninja, images, publish_repo, branches=None,
+                          gpg_args=""):
+    """Publishes images, a list of `OstreeRef`s, to the archive mode repo
+    publish_repo, creating it if necessary.  Each image is published as the
+    branch of the same name, or the corresponding entry of branches.
+    gpg_args are passed to the commit and summary commands, e.g.
+    "--gpg-sign=KEYID".  Returns the filename of the summary, which is
+    updated once all the images are published."""
+    if branches is None:
+        branches = [x.ref for x in images]
+    ostree_init_archive.build(ninja, publish_repo=publish_repo)
+    published = [
+        ostree_publish.build(
+            ninja, in_branch=image.ref, publish_repo=publish_repo,
+            publish_branch=branch, gpg_args=gpg_args).filename
+        for image, branch in zip(images, branches)]
+    return ostree_summary.build(
+        ninja, inputs=published, publish_repo=publish_repo,
+        gpg_args=gpg_args)[0]
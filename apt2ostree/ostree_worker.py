@@ -0,0 +1,503 @@
+#!/usr/bin/python
+
+"""
+A long-lived process that keeps the ostree repo open and does ostree's work
+for the build rules, instead of a new `ostree` process for every step.
+
+Every `ostree` process opens the repo, reads its config and starts its own
+transaction.  With lots of debs and `-j64` that's a lot of processes
+contending on the repo.  The worker opens the repo once, with libostree via
+GObject introspection, and serves requests over a unix socket.  Commits that
+arrive together are written in one shared transaction.
+
+The client takes the same arguments as `ostree`:
+
+    python -m apt2ostree.ostree_worker --repo=_build/ostree commit ...
+
+It starts the worker if it isn't running already.  The worker exits once
+it's been idle for a while.  We only understand the subset of `commit`,
+`ls` and `checkout` that our rules use.  Anything else, or when the worker
+can't be started (e.g. there's no OSTree typelib), is passed to the real
+`ostree` so the results are always the same as without the worker.
+
+Enable it with `Apt(ninja, ostree_worker=True)`.  The rules then run
+`$ostree` rather than `ostree` and the Python helpers find the worker's
+socket in the environment variable APT2OSTREE_OSTREE_WORKER.
+"""
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+from .ostree import OSTREE_WORKER_ENV
+
+# How long the worker waits for more requests before exiting
+IDLE_TIMEOUT = 30
+
+# After each request how long to wait for another to share its transaction
+BATCH_WINDOW = 0.01
+MAX_BATCH = 64
+
+# How long a client waits for a worker it has started
+START_TIMEOUT = 10
+
+# From ostree's ot-builtin-ls.c
+_LS_ATTRIBUTES = (
+    "standard::name,standard::type,standard::size,standard::is-symlink,"
+    "standard::symlink-target,unix::device,unix::inode,unix::mode,"
+    "unix::uid,unix::gid,unix::rdev")
+
+_AT_FDCWD = -100
+
+_ALIASES = {
+    "-b": "--branch", "-s": "--subject", "-R": "--recursive",
+    "-U": "--user-mode", "-H": "--require-hardlinks",
+}
+
+_COMMANDS = {
+    # command: (options with a value, flags)
+    "commit": (["--repo", "--branch", "--subject", "--timestamp",
+                "--owner-uid", "--owner-gid", "--tree"],
+               ["--orphan", "--no-bindings", "--no-xattrs"]),
+    "ls": (["--repo"], ["--recursive", "--nul-filenames-only"]),
+    "checkout": (["--repo"], ["--user-mode", "--require-hardlinks",
+                              "--union"]),
+}
+
+
+class Unsupported(Exception):
+    """Raised for requests that must be passed to the `ostree` CLI"""
+    pass
+
+
+def parse_args(args):
+    """Parses the arguments to `ostree`.  Returns (command, options,
+    positional arguments) where options maps the long name of each option to
+    a list of values, or True for flags.  Raises `Unsupported` for anything
+    we don't understand."""
+    args = list(args)
+    options = {}
+    while args and args[0].startswith("--repo="):
+        options.setdefault("--repo", []).append(args.pop(0)[len("--repo="):])
+    if not args or args[0] not in _COMMANDS:
+        raise Unsupported("Unsupported command")
+    command = args.pop(0)
+    with_value, flags = _COMMANDS[command]
+    positional = []
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith("-"):
+            positional.append(arg)
+            continue
+        if not arg.startswith("--") and len(arg) > 2:
+            # A cluster of short flags like -UH
+            expanded = ["-" + c for c in arg[1:]]
+            if all(_ALIASES.get(x) in flags for x in expanded):
+                args[:0] = expanded
+                continue
+            raise Unsupported(arg)
+        name, eq, value = arg.partition("=")
+        name = _ALIASES.get(name, name)
+        if name in with_value:
+            if not eq:
+                if not args:
+                    raise Unsupported("%s needs a value" % arg)
+                value = args.pop(0)
+            options.setdefault(name, []).append(value)
+        elif name in flags and not eq:
+            options[name] = True
+        else:
+            raise Unsupported(arg)
+    return command, options, positional
+
+
+def _one(options, name, default=None):
+    values = options.get(name, [default])
+    if len(values) != 1:
+        raise Unsupported("%s given more than once" % name)
+    return values[0]
+
+
+def _int(options, name):
+    value = _one(options, name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise Unsupported("%s=%s" % (name, value))
+
+
+class Worker(object):
+    """Runs requests against one ostree repo"""
+    def __init__(self, repo):
+        import gi
+        gi.require_version("OSTree", "1.0")
+        from gi.repository import Gio, OSTree
+        self.Gio = Gio
+        self.OSTree = OSTree
+        self.path = os.path.realpath(repo)
+        self.repo = OSTree.Repo.new(Gio.File.new_for_path(self.path))
+        self.repo.open(None)
+
+    def run_batch(self, requests):
+        """Runs requests, a list of dicts with "args" and "cwd", sharing one
+        transaction.  Returns a list of (status, stdout, stderr), with status
+        None for requests the client must run with the `ostree` CLI."""
+        results = []
+        refs = []
+        self.repo.prepare_transaction(None)
+        try:
+            for request in requests:
+                try:
+                    stdout, ref = self.run(request["args"], request["cwd"])
+                    results.append((0, stdout, ""))
+                    if ref:
+                        refs.append(ref)
+                except Unsupported:
+                    results.append((None, "", ""))
+                except Exception as e:  # pylint: disable=broad-except
+                    results.append((1, "", "error: %s\n" % (
+                        getattr(e, "message", None) or e)))
+            self.repo.commit_transaction(None)
+        except:
+            self.repo.abort_transaction(None)
+            raise
+        # Written ourselves rather than with `transaction_set_ref` so they
+        # keep their mtime if they haven't changed and ninja's restat works:
+        from .ninja import write_if_changed
+        for ref, checksum in refs:
+            write_if_changed("%s/refs/heads/%s" % (self.path, ref),
+                             checksum + "\n")
+        return results
+
+    def run(self, args, cwd):
+        """Returns (stdout, (ref, checksum) or None)"""
+        command, options, positional = parse_args(args)
+        for repo in options.pop("--repo", []):
+            if os.path.realpath(os.path.join(cwd, repo)) != self.path:
+                raise Unsupported("Different repo %s" % repo)
+        return getattr(self, command)(options, positional, cwd)
+
+    def commit(self, options, positional, cwd):
+        # As in ostree's ot-builtin-commit.c
+        OSTree = self.OSTree
+        branch = _one(options, "--branch")
+        subject = _one(options, "--subject")
+        timestamp = _int(options, "--timestamp")
+        owner_uid = _int(options, "--owner-uid")
+        owner_gid = _int(options, "--owner-gid")
+        if positional or not options.get("--tree"):
+            raise Unsupported("Only --tree= is supported")
+        if not branch and not options.get("--orphan"):
+            raise Unsupported("Need --branch or --orphan")
+        if not options.get("--no-bindings") and branch:
+            raise Unsupported("Ref bindings aren't supported")
+
+        modifier = None
+        if options.get("--no-xattrs") or owner_uid is not None or \
+                owner_gid is not None:
+            flags = OSTree.RepoCommitModifierFlags.NONE
+            if options.get("--no-xattrs"):
+                flags |= OSTree.RepoCommitModifierFlags.SKIP_XATTRS
+
+            def commit_filter(_repo, _path, file_info, *_):
+                if owner_uid is not None:
+                    file_info.set_attribute_uint32("unix::uid", owner_uid)
+                if owner_gid is not None:
+                    file_info.set_attribute_uint32("unix::gid", owner_gid)
+                return OSTree.RepoCommitFilterResult.ALLOW
+            modifier = OSTree.RepoCommitModifier.new(
+                flags, commit_filter, None)
+
+        mtree = OSTree.MutableTree.new()
+        for tree in options["--tree"]:
+            kind, _, value = tree.partition("=")
+            if kind == "dir":
+                self.repo.write_dfd_to_mtree(
+                    _AT_FDCWD, os.path.join(cwd, value), mtree, modifier,
+                    None)
+            elif kind == "tar":
+                self.repo.write_archive_to_mtree(
+                    self.Gio.File.new_for_path(os.path.join(cwd, value)),
+                    mtree, modifier, False, None)
+            elif kind == "ref":
+                _, root, _ = self.repo.read_commit(value, None)
+                self.repo.write_directory_to_mtree(root, mtree, modifier, None)
+            else:
+                raise Unsupported("--tree=%s" % tree)
+        _, root = self.repo.write_mtree(mtree, None)
+
+        parent = None
+        if not options.get("--orphan"):
+            _, parent = self.repo.resolve_rev(branch, True)
+        if timestamp is None:
+            _, checksum = self.repo.write_commit(
+                parent, subject, None, None, root, None)
+        else:
+            _, checksum = self.repo.write_commit_with_time(
+                parent, subject, None, None, root, timestamp, None)
+        return checksum + "\n", (branch, checksum) if branch else None
+
+    def ls(self, options, positional, _cwd):
+        # As in ostree's ot-builtin-ls.c
+        Gio = self.Gio
+        if not positional:
+            raise Unsupported("Need a commit")
+        _, root, _ = self.repo.read_commit(positional[0], None)
+        out = []
+
+        def print_one(f, info):
+            if options.get("--nul-filenames-only"):
+                out.append(f.get_path() + "\0")
+                return
+            type_c = {
+                Gio.FileType.REGULAR: "-",
+                Gio.FileType.DIRECTORY: "d",
+                Gio.FileType.SYMBOLIC_LINK: "l",
+            }.get(info.get_file_type(), "?")
+            line = "%c0%04o %u %u %6u %s" % (
+                type_c, info.get_attribute_uint32("unix::mode") & 0o7777,
+                info.get_attribute_uint32("unix::uid"),
+                info.get_attribute_uint32("unix::gid"),
+                info.get_size(), f.get_path())
+            if info.get_file_type() == Gio.FileType.SYMBOLIC_LINK:
+                line += " -> %s" % info.get_symlink_target()
+            out.append(line + "\n")
+
+        def recurse(f, depth):
+            children = f.enumerate_children(
+                _LS_ATTRIBUTES, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None)
+            for info in iter(lambda: children.next_file(None), None):
+                child = f.get_child(info.get_name())
+                print_one(child, info)
+                if info.get_file_type() == Gio.FileType.DIRECTORY and \
+                        depth != 1:
+                    recurse(child, depth - 1)
+
+        for path in positional[1:] or ["/"]:
+            f = root.resolve_relative_path(path)
+            info = f.query_info(
+                _LS_ATTRIBUTES, Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None)
+            print_one(f, info)
+            if info.get_file_type() == Gio.FileType.DIRECTORY:
+                recurse(f, -1 if options.get("--recursive") else 1)
+        return "".join(out), None
+
+    def checkout(self, options, positional, cwd):
+        # As in ostree's ot-builtin-checkout.c
+        OSTree = self.OSTree
+        if len(positional) != 2 or positional[0].startswith(":"):
+            raise Unsupported("Only `checkout COMMIT DESTINATION`")
+        try:
+            checkout_options = OSTree.RepoCheckoutAtOptions()
+            if options.get("--user-mode"):
+                checkout_options.mode = OSTree.RepoCheckoutMode.USER
+            if options.get("--union"):
+                checkout_options.overwrite_mode = \
+                    OSTree.RepoCheckoutOverwriteMode.UNION_FILES
+            if options.get("--require-hardlinks"):
+                checkout_options.no_copy_fallback = True
+        except (AttributeError, TypeError) as e:
+            raise Unsupported(str(e))
+        _, checksum = self.repo.resolve_rev(positional[0], False)
+        self.repo.checkout_at(checkout_options, _AT_FDCWD,
+                              os.path.join(cwd, positional[1]), checksum, None)
+        return "", None
+
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return sock
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+
+
+def _read_line(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data.decode("utf-8"))
+
+
+def serve(socket_path, repo, idle_timeout=IDLE_TIMEOUT):
+    """Serves requests until we've been idle for idle_timeout seconds.
+    Returns 0 if we served or someone else is serving, 1 if we can't."""
+    lock = open(socket_path + ".lock", "w")
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if time.time() > deadline:
+            return 0
+        time.sleep(0.05)
+    existing = _connect(socket_path)
+    if existing is not None:
+        existing.close()
+        return 0
+
+    unavailable = socket_path + ".unavailable"
+    try:
+        worker = Worker(repo)
+    except Exception as e:  # pylint: disable=broad-except
+        sys.stderr.write("ostree worker unavailable: %s\n" % e)
+        with open(unavailable, "w") as f:
+            f.write("%s\n" % e)
+        return 1
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(128)
+    try:
+        while True:
+            ready = select.select([server], [], [], idle_timeout)[0]
+            if not ready:
+                # Stop new clients finding us before we serve the last ones:
+                os.unlink(socket_path)
+                ready = select.select([server], [], [], 0)[0]
+                if not ready:
+                    break
+            batch = []
+            while ready and len(batch) < MAX_BATCH:
+                conn, _ = server.accept()
+                conn.settimeout(START_TIMEOUT)
+                try:
+                    batch.append((conn, _read_line(conn)))
+                except (socket.error, ValueError):
+                    conn.close()
+                ready = select.select([server], [], [], BATCH_WINDOW)[0]
+            batch = [(c, r) for c, r in batch if r is not None]
+            if not batch:
+                continue
+            results = worker.run_batch([r for _, r in batch])
+            for (conn, _), (status, stdout, stderr) in zip(batch, results):
+                try:
+                    conn.sendall(json.dumps({
+                        "status": status, "stdout": stdout,
+                        "stderr": stderr}).encode("utf-8") + b"\n")
+                except socket.error:
+                    pass
+                conn.close()
+            if not os.path.exists(socket_path):
+                break
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    return 0
+
+
+def _repo(args):
+    for arg in args:
+        if arg.startswith("--repo="):
+            return arg[len("--repo="):]
+    return None
+
+
+def _start(socket_path, repo):
+    """Starts a worker.  Returns a connection to it or None."""
+    if os.path.exists(socket_path + ".unavailable"):
+        return None
+    with open(os.devnull, "r+") as devnull, \
+            open(socket_path + ".log", "a") as log:
+        # stderr goes to a log because ninja waits for the stderr of the
+        # command that started us to be closed:
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "apt2ostree.ostree_worker", "serve",
+             "--socket=%s" % socket_path, "--repo=%s" % repo],
+            stdin=devnull, stdout=devnull, stderr=log, preexec_fn=os.setsid)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        sock = _connect(socket_path)
+        if sock is not None:
+            return sock
+        if proc.poll():
+            return None
+        time.sleep(0.01)
+    return None
+
+
+def request(socket_path, args):
+    """Runs `ostree args` in the worker, starting it if necessary.  Returns
+    (status, stdout, stderr), or None if it must be run with the `ostree`
+    CLI instead."""
+    repo = _repo(args)
+    if repo is None:
+        return None
+    message = json.dumps({"args": list(args), "cwd": os.getcwd()})
+    for _ in range(2):
+        sock = _connect(socket_path) or _start(socket_path, repo)
+        if sock is None:
+            return None
+        try:
+            sock.sendall(message.encode("utf-8") + b"\n")
+            reply = _read_line(sock)
+        finally:
+            sock.close()
+        if reply is not None:
+            if reply["status"] is None:
+                return None
+            return reply["status"], reply["stdout"], reply["stderr"]
+        # The worker exited before it got to us.  Try again.
+    return None
+
+
+def check_output(args):
+    """Like `subprocess.check_output(["ostree"] + args)`, but using the
+    worker if there is one"""
+    socket_path = os.environ.get(OSTREE_WORKER_ENV)
+    result = request(socket_path, args) if socket_path else None
+    if result is None:
+        return subprocess.check_output(["ostree"] + list(args))
+    status, stdout, stderr = result
+    sys.stderr.write(stderr)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, ["ostree"] + list(args))
+    return stdout.encode("utf-8")
+
+
+def main(argv):
+    if argv[1:2] == ["serve"]:
+        parser = argparse.ArgumentParser(
+            description="Serve ostree requests for the build rules")
+        parser.add_argument("command", choices=["serve"])
+        parser.add_argument("--socket", required=True)
+        parser.add_argument("--repo", required=True)
+        parser.add_argument("--idle-timeout", type=float,
+                            default=IDLE_TIMEOUT)
+        args = parser.parse_args(argv[1:])
+        return serve(args.socket, args.repo, args.idle_timeout)
+
+    socket_path = os.environ.get(OSTREE_WORKER_ENV)
+    result = request(socket_path, argv[1:]) if socket_path else None
+    if result is None:
+        os.execvp("ostree", ["ostree"] + argv[1:])
+    status, stdout, stderr = result
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+"""
+Helpers for the fast path of `dpkg_configure`.
+
+Rather than copying the whole image out of ostree and back in again the fast
+path checks it out as hardlinks to the objects in the repo and mounts an
+overlayfs on top so nothing run by `dpkg --configure` can modify the repo.
+Afterwards the upper directory of the overlay holds only what was changed.
+We commit that over the top of the unpacked image with `ostree commit
+--tree=ref=... --tree=tar=...` so ostree doesn't even have to look at the
+files that haven't changed.
+
+The hardlinked files belong to whoever owns the repo and may have lost their
+setuid bits, so we can't commit their ownership and permissions as they are.
+Before `dpkg --configure` runs `restore_modes` chmods everything whose
+permissions differ from those recorded in ostree back, through the overlay,
+so the maintainer scripts see the same permissions as in a copying checkout
+and whatever they do to them ends up in the upper directory as it is.
+Ownership can't be restored that way without copying up the whole image, so
+`write_tar` puts back the ownership recorded in ostree for anything that
+hasn't been chowned since it was checked out.  New files that belong to the
+owner of the checkout, copied from it with `cp -p` for instance, are given
+to root as they would have been in a copying checkout.
+
+Changes we can't represent as an overlay on top of the original commit
+(deleted files and replaced directories) are found by `problems`.  When
+there are any the whole image has to be committed from the overlay mount.
+"""
+
+import argparse
+import os
+import stat
+import sys
+import tarfile
+
+# From the overlayfs documentation
+OPAQUE_XATTR = "trusted.overlay.opaque"
+REDIRECT_XATTR = "trusted.overlay.redirect"
+
+
+class Original(object):
+    __slots__ = ("mode", "uid", "gid")
+
+    def __init__(self, mode, uid, gid):
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+
+
+def read_ls(f):
+    """Parses the output of `ostree ls -R` into a dict from path to
+    `Original`"""
+    out = {}
+    for line in f:
+        # Format: "-00644 0 0 1234 /usr/bin/foo"
+        fields = line.rstrip("\n").split(None, 4)
+        if len(fields) < 5:
+            continue
+        path = fields[4]
+        if fields[0][0] == "l":
+            path = path.split(" -> ", 1)[0]
+        out[path] = Original(int(fields[0][1:], 8), int(fields[1]),
+                             int(fields[2]))
+    return out
+
+
+def _walk(root):
+    """Yields (path relative to root, full path) for everything in root,
+    parents before children, root itself first"""
+    yield ".", root
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            full = os.path.join(dirpath, name)
+            yield os.path.relpath(full, root), full
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _getxattr(path, name):
+    try:
+        return os.getxattr(path, name, follow_symlinks=False)
+    except (AttributeError, OSError):
+        return None
+
+
+def problems(upper, lower):
+    """Returns a list of the changes in the overlay upper directory that we
+    can't commit as an overlay on top of lower"""
+    out = []
+    for rel, full in _walk(upper):
+        st = os.lstat(full)
+        if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+            out.append("%s was deleted" % rel)
+            continue
+        if stat.S_ISDIR(st.st_mode) and (
+                _getxattr(full, OPAQUE_XATTR) or
+                _getxattr(full, REDIRECT_XATTR)):
+            out.append("%s was replaced" % rel)
+            continue
+        lst = _lstat(os.path.join(lower, rel))
+        if lst is not None and stat.S_IFMT(lst.st_mode) != stat.S_IFMT(
+                st.st_mode):
+            out.append("%s changed type" % rel)
+    return out
+
+
+def restore_modes(target, lower, original):
+    """chmods everything in target, the overlay mounted on lower, whose
+    permissions in lower differ from those in original back to them"""
+    for path, orig in sorted(original.items()):
+        rel = path.lstrip("/") or "."
+        lst = _lstat(os.path.join(lower, rel))
+        if lst is None or stat.S_ISLNK(lst.st_mode):
+            continue
+        if stat.S_IMODE(lst.st_mode) != stat.S_IMODE(orig.mode):
+            os.chmod(os.path.join(target, rel), stat.S_IMODE(orig.mode))
+
+
+def write_tar(out, root, lower, original):
+    """Writes everything under root to out as a tarball.  Ownership that is
+    the same as in lower is replaced by that in original, the `read_ls` of
+    the commit that lower is a checkout of.  Anything that isn't in original
+    owned by the owner of lower is given to root.  Permissions are taken as
+    they are, so `restore_modes` must have been run first."""
+    owner = os.lstat(lower)
+    tar = tarfile.open(fileobj=out, mode="w|", format=tarfile.GNU_FORMAT)
+    for rel, full in _walk(root):
+        st = os.lstat(full)
+        info = tar.gettarinfo(full, arcname="./" + rel if rel != "." else ".")
+        if info.islnk():
+            # Hardlinks to the same ostree object.  A copying checkout would
+            # have given us separate files.
+            info.type = tarfile.REGTYPE
+            info.linkname = ""
+            info.size = st.st_size
+        orig = original.get("/" if rel == "." else "/" + rel)
+        lst = _lstat(os.path.join(lower, rel))
+        if rel == "." and orig is not None:
+            # The top of the checkout, which we created ourselves
+            info.uid, info.gid, info.mode = orig.uid, orig.gid, orig.mode
+        elif orig is not None and lst is not None and stat.S_IFMT(
+                lst.st_mode) == stat.S_IFMT(st.st_mode):
+            if st.st_uid == lst.st_uid:
+                info.uid = orig.uid
+            if st.st_gid == lst.st_gid:
+                info.gid = orig.gid
+        elif orig is None:
+            if st.st_uid == owner.st_uid:
+                info.uid = 0
+            if st.st_gid == owner.st_gid:
+                info.gid = 0
+        info.uname = info.gname = ""
+        if info.isreg():
+            with open(full, "rb") as f:
+                tar.addfile(info, f)
+        else:
+            tar.addfile(info)
+    tar.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Commit helpers for the fast path of dpkg_configure")
+    subparsers = parser.add_subparsers(dest="command")
+    check = subparsers.add_parser(
+        "check", help="Exit with status 1 if UPPER can't be committed as an "
+        "overlay on LOWER")
+    check.add_argument("--lower", required=True)
+    check.add_argument("upper")
+    modes = subparsers.add_parser(
+        "restore-modes", help="Restore the permissions that the checkout "
+        "LOWER lost through TARGET, the overlay mounted on it")
+    modes.add_argument("--lower", required=True)
+    modes.add_argument("--lower-ls", required=True,
+                       help="The output of `ostree ls -R` of LOWER's commit")
+    modes.add_argument("target")
+    tar = subparsers.add_parser(
+        "tar", help="Write DIR to stdout as a tarball, restoring ownership "
+        "from the checkout LOWER")
+    tar.add_argument("--lower", required=True)
+    tar.add_argument("--lower-ls", required=True,
+                     help="The output of `ostree ls -R` of LOWER's commit")
+    tar.add_argument("dir")
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "check":
+        found = problems(args.upper, args.lower)
+        for x in found:
+            sys.stderr.write("%s\n" % x)
+        return 1 if found else 0
+    elif args.command == "restore-modes":
+        with open(args.lower_ls) as f:
+            restore_modes(args.target, args.lower, read_ls(f))
+        return 0
+    elif args.command == "tar":
+        with open(args.lower_ls) as f:
+            original = read_ls(f)
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        write_tar(out, args.dir, args.lower, original)
+        out.flush()
+        return 0
+    else:
+        parser.error("Missing command")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,129 @@
+"""
+Opt-in instrumentation of configure.
+
+When generating graphs for thousands of debs it's not obvious where configure
+spends its time.  Pass `Ninja(profile=True)` or set the environment variable
+`APT2OSTREE_PROFILE=1` (or `APT2OSTREE_PROFILE=<filename>`) to record call
+counts and cumulative wall time for each `Rule` and for the expensive parts of
+`Ninja.build`.  A report sorted by time is printed to stderr when the ninja
+file is closed and the same data is written as JSON so it can be tracked in CI.
+
+Times are inclusive: the time for a `Rule` includes the time spent hashing,
+escaping and wrapping the build statement it generates.
+"""
+
+import json
+import sys
+import time
+
+PROFILE_ENV = "APT2OSTREE_PROFILE"
+
+if sys.version_info[0] >= 3:
+    _clock = time.perf_counter
+else:
+    _clock = time.time
+
+
+class Profiler(object):
+    def __init__(self):
+        self.stats = {}  # name -> [count, seconds]
+        self.start = _clock()
+
+    def add(self, name, seconds, count=1):
+        stat = self.stats.get(name)
+        if stat is None:
+            self.stats[name] = [count, seconds]
+        else:
+            stat[0] += count
+            stat[1] += seconds
+
+    def timer(self, name):
+        """A context manager that records the time spent within it against
+        name"""
+        return _Timer(self, name)
+
+    def wrap(self, name, func):
+        """Returns func, but with each call timed against name"""
+        def wrapper(*args, **kwargs):
+            start = _clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, _clock() - start)
+        return wrapper
+
+    def iterate(self, name, iterable):
+        """Yields the items of iterable, timing the work done producing each
+        one against name"""
+        it = iter(iterable)
+        while True:
+            start = _clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(name, _clock() - start, count=0)
+                return
+            self.add(name, _clock() - start)
+            yield item
+
+    def sorted_stats(self):
+        return sorted(self.stats.items(), key=lambda x: (-x[1][1], x[0]))
+
+    def report(self):
+        total = _clock() - self.start
+        out = ["configure profile: %.3fs total\n" % total,
+               "%10s %10s %10s  %s\n" % ("calls", "seconds", "usec/call",
+                                         "name")]
+        for name, (count, seconds) in self.sorted_stats():
+            out.append("%10i %10.3f %10.1f  %s\n" % (
+                count, seconds, seconds * 1e6 / count if count else 0, name))
+        return "".join(out)
+
+    def to_json(self):
+        return json.dumps({
+            "total_seconds": _clock() - self.start,
+            "stats": [{"name": name, "calls": count, "seconds": seconds}
+                      for name, (count, seconds) in self.sorted_stats()],
+        }, indent=2, sort_keys=True) + "\n"
+
+
+class _Timer(object):
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        self.profiler.add(self.name, _clock() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _1, _2, _3):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(profiler, name):
+    """Like `Profiler.timer`, but profiler may be None in which case nothing is
+    recorded"""
+    if profiler is None:
+        return _NULL_TIMER
+    return _Timer(profiler, name)
+
+
+def iterate(profiler, name, iterable):
+    """Like `Profiler.iterate`, but profiler may be None"""
+    if profiler is None:
+        return iterable
+    return profiler.iterate(name, iterable)
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+"""
+Shows which Python code generated a build statement.
+
+Writing the full Python stack into build.ninja as comments for every build
+statement is slow and makes the ninja file much bigger.  Instead, by default,
+`Ninja` records just the code location of each frame, deduplicated, in a JSON
+sidecar file (see `ninja.Provenance`).  The source lines are only looked up
+when someone asks:
+
+    python -m apt2ostree.provenance explain _build/ostree/refs/heads/deb/...
+"""
+
+import argparse
+import json
+import linecache
+import os
+import sys
+
+from .ninja import sidecar_filename
+
+
+def explain(target, ninjafile="build.ninja"):
+    """Returns the formatted Python stack that generated the build statement
+    for target, or None if we don't know about target."""
+    todo = [sidecar_filename(ninjafile)]
+    while todo:
+        with open(todo.pop()) as f:
+            index = json.load(f)
+        if target in index["targets"]:
+            out = []
+            for frame_id in index["stacks"][index["targets"][target]]:
+                filename, lineno, name = index["frames"][frame_id]
+                out.append('  File "%s", line %i, in %s\n' % (
+                    filename, lineno, name))
+                line = linecache.getline(filename, lineno).strip()
+                if line:
+                    out.append("    %s\n" % line)
+            return "".join(out)
+        todo.extend(index["includes"])
+    return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Show which Python code generated a ninja build statement")
+    parser.add_argument("-f", "--ninjafile", default="build.ninja")
+    subparsers = parser.add_subparsers(dest="command")
+    explain_parser = subparsers.add_parser("explain")
+    explain_parser.add_argument("target", nargs="+")
+    args = parser.parse_args(argv[1:])
+
+    if args.command != "explain":
+        parser.error("Missing command")
+
+    ret = 0
+    for target in args.target:
+        target = os.path.normpath(target)
+        stack = explain(target, args.ninjafile)
+        if stack is None:
+            sys.stderr.write("No build statement for %s\n" % target)
+            ret = 1
+        else:
+            sys.stdout.write("%s generated by:\n%s" % (target, stack))
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
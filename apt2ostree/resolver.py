@@ -0,0 +1,385 @@
+"""
+Resolves lockfiles without aptly.
+
+`PackageIndex` holds the Packages indices of a set of apt sources for one
+architecture.  It's built once and can then resolve any number of package
+lists, so updating many lockfiles that share apt sources only parses the
+indices once.  Dependency expressions are parsed the first time they're
+needed and kept, as are the version comparisons used to order each package's
+versions.
+
+Resolution follows what `aptly lockfile create` does:
+
+* Each requested package, and its dependencies, resolve to the newest version
+  that satisfies any version constraint.
+* Depends and Pre-Depends are followed.  Of a list of alternatives the first
+  that can be satisfied is taken, unless one of them is satisfied already.
+* Virtual packages are satisfied by the packages that provide them.
+* Essential packages and those with Priority: required are included, unless
+  turned off with `include_essential=False` or
+  `include_priority_required=False`.
+* With `follow_deps=False` (aptly's `-solver=no-deps`) dependencies aren't
+  followed at all.
+
+The lockfile has the same fields, in the same order, as the ones written by
+aptly.
+"""
+
+import gzip
+import re
+from collections import deque
+from functools import cmp_to_key
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# The fields `aptly lockfile create` keeps, in the order it writes them
+LOCKFILE_FIELDS = (
+    "Package", "Architecture", "Version", "Replaces", "Provides", "Depends",
+    "Pre-Depends", "Conflicts", "Breaks", "Filename", "MD5sum", "SHA1",
+    "SHA256", "Multi-Arch")
+
+
+class ResolveError(Exception):
+    pass
+
+
+def _order(c):
+    if c is None or c.isdigit():
+        return 0
+    elif c.isalpha():
+        return ord(c)
+    elif c == "~":
+        return -1
+    else:
+        return ord(c) + 256
+
+
+def _compare_part(a, b):
+    """Compares upstream versions or revisions as dpkg does"""
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or \
+                (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i] if i < len(a) else None)
+            bc = _order(b[j] if j < len(b) else None)
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+        first_diff = 0
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _split_version(v):
+    epoch, _, rest = v.partition(":") if ":" in v else ("0", "", v)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else \
+        (rest, "", "")
+    return int(epoch or "0"), upstream, revision
+
+
+def version_compare(a, b):
+    """Compares Debian versions a and b.  Returns <0, 0 or >0 like `cmp`."""
+    if a == b:
+        return 0
+    ea, ua, ra = _split_version(a)
+    eb, ub, rb = _split_version(b)
+    if ea != eb:
+        return ea - eb
+    return _compare_part(ua, ub) or _compare_part(ra, rb)
+
+
+_OPS = {
+    "<<": lambda c: c < 0,
+    "<=": lambda c: c <= 0,
+    "<": lambda c: c <= 0,
+    "=": lambda c: c == 0,
+    ">=": lambda c: c >= 0,
+    ">": lambda c: c >= 0,
+    ">>": lambda c: c > 0,
+}
+
+
+def satisfies(version, op, wanted):
+    """Whether version satisfies the version constraint (op wanted).  op of
+    None is satisfied by anything."""
+    if op is None:
+        return True
+    if version is None:
+        return False
+    return _OPS[op](version_compare(version, wanted))
+
+
+_RELATION = re.compile(
+    r"^\s*([^\s:(\[<]+)(?::\S+?)?\s*"
+    r"(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^)\s]+)\s*\))?\s*"
+    r"(?:\[[^\]]*\]\s*)?(?:<[^>]*>\s*)*$")
+
+_relations_cache = {}
+
+
+def parse_relations(text):
+    """Parses a Depends style field into a list of lists of alternative
+    (name, op, version) tuples.  Architecture qualifiers and restrictions
+    are dropped."""
+    try:
+        return _relations_cache[text]
+    except KeyError:
+        pass
+    out = []
+    for group in text.split(","):
+        if not group.strip():
+            continue
+        alternatives = []
+        for x in group.split("|"):
+            m = _RELATION.match(x)
+            if not m:
+                raise ValueError("Can't parse relation %r" % x)
+            alternatives.append(m.groups())
+        out.append(alternatives)
+    _relations_cache[text] = out
+    return out
+
+
+_FIELDS = re.compile(
+    br"^(Package|Version|Architecture|Essential|Priority|Provides|Depends|"
+    br"Pre-Depends): *(.*)$", re.M)
+
+
+class Package(object):
+    """A stanza from a Packages index"""
+    __slots__ = ("name", "version", "essential", "required", "provides",
+                 "_depends", "_relations", "_stanza")
+
+    def __init__(self, stanza, fields):
+        self._stanza = stanza
+        self.name = fields[b"Package"].decode("utf-8")
+        self.version = fields[b"Version"].decode("utf-8")
+        self.essential = fields.get(b"Essential") == b"yes"
+        self.required = fields.get(b"Priority") == b"required"
+        self.provides = [
+            (name, version if op == "=" else None)
+            for group in parse_relations(
+                fields.get(b"Provides", b"").decode("utf-8"))
+            for name, op, version in group]
+        self._depends = b", ".join(
+            fields[x] for x in (b"Pre-Depends", b"Depends") if x in fields)
+        self._relations = None
+
+    def relations(self):
+        """The Pre-Depends and Depends of this package, parsed"""
+        if self._relations is None:
+            self._relations = parse_relations(self._depends.decode("utf-8"))
+        return self._relations
+
+    def lockfile_stanza(self):
+        """This package as it's written to a lockfile"""
+        fields = {}
+        name = None
+        for line in self._stanza.decode("utf-8").split("\n"):
+            if line[:1] in (" ", "\t"):
+                if name in fields:
+                    fields[name] += "\n" + line
+            elif line:
+                name = line.split(":", 1)[0]
+                if name in LOCKFILE_FIELDS:
+                    fields[name] = line
+        return "".join(fields[x] + "\n" for x in LOCKFILE_FIELDS
+                       if x in fields) + "\n"
+
+    def __repr__(self):
+        return "<Package %s %s>" % (self.name, self.version)
+
+
+def read_index(filename):
+    """Returns the contents of the Packages index filename, decompressing it
+    if necessary"""
+    if filename.endswith(".gz"):
+        f = gzip.open(filename, "rb")
+    elif filename.endswith(".xz"):
+        f = lzma.open(filename, "rb")
+    else:
+        f = open(filename, "rb")
+    with f:
+        return f.read()
+
+
+class PackageIndex(object):
+    """The packages for one architecture from a set of Packages indices.
+    When the same version of a package appears in more than one index the
+    first one added wins."""
+    def __init__(self, architecture):
+        self.architecture = architecture
+        # name -> [Package], newest version first
+        self.packages = {}
+        # virtual package name -> [(Package, provided version or None)]
+        self.provides = {}
+        # Names of the packages with a version that's Essential or
+        # Priority: required
+        self.essential = set()
+        self.required = set()
+        self._sorted = set()
+
+    def add(self, data):
+        """Adds the stanzas of a Packages index.  data is its contents as
+        bytes."""
+        archs = (self.architecture.encode("utf-8"), b"all")
+        for stanza in data.split(b"\n\n"):
+            stanza = stanza.strip(b"\n")
+            if not stanza:
+                continue
+            fields = dict(_FIELDS.findall(stanza))
+            if fields.get(b"Architecture") not in archs:
+                continue
+            pkg = Package(stanza, fields)
+            versions = self.packages.setdefault(pkg.name, [])
+            if any(x.version == pkg.version for x in versions):
+                continue
+            versions.append(pkg)
+            if len(versions) > 1:
+                self._sorted.discard(pkg.name)
+            for name, version in pkg.provides:
+                self.provides.setdefault(name, []).append((pkg, version))
+            if pkg.essential:
+                self.essential.add(pkg.name)
+            if pkg.required:
+                self.required.add(pkg.name)
+
+    def add_file(self, filename):
+        self.add(read_index(filename))
+
+    def versions(self, name):
+        """The versions of package name, newest first"""
+        versions = self.packages.get(name, [])
+        if len(versions) > 1 and name not in self._sorted:
+            versions.sort(key=cmp_to_key(
+                lambda a, b: version_compare(b.version, a.version)))
+            self._sorted.add(name)
+        return versions
+
+    def candidate(self, name):
+        versions = self.versions(name)
+        return versions[0] if versions else None
+
+    def find(self, name, op=None, version=None):
+        """Returns the package that satisfies the relation (name op version)
+        or None.  Real packages are preferred to virtual ones."""
+        for pkg in self.versions(name):
+            if satisfies(pkg.version, op, version):
+                return pkg
+        providers = sorted(
+            (pkg.name, pkg) for pkg, provided in self.provides.get(name, [])
+            if satisfies(provided, op, version) and
+            self.candidate(pkg.name) is pkg)
+        if providers:
+            return providers[0][1]
+        return None
+
+    def resolve(self, packages, follow_deps=True, include_essential=True,
+                include_priority_required=True):
+        """Returns the sorted list of `Package`s to install to get packages.
+        Each of packages is a package name, optionally followed by
+        "=version"."""
+        selected = {}
+        provided = {}
+        errors = []
+        queue = deque()
+
+        def select(pkg):
+            """Returns False if another version of pkg was already
+            selected"""
+            if pkg.name in selected:
+                return selected[pkg.name] is pkg
+            selected[pkg.name] = pkg
+            for name, version in pkg.provides:
+                provided.setdefault(name, []).append(version)
+            queue.append(pkg)
+            return True
+
+        def satisfied(name, op, version):
+            if name in selected and satisfies(
+                    selected[name].version, op, version):
+                return True
+            return any(satisfies(x, op, version)
+                       for x in provided.get(name, []))
+
+        for x in packages:
+            name, _, version = x.partition("=")
+            pkg = self.find(name, "=" if version else None, version)
+            if pkg is None:
+                errors.append("Unable to locate package %s" % x)
+            else:
+                select(pkg)
+
+        names = set()
+        if include_essential:
+            names.update(self.essential)
+        if include_priority_required:
+            names.update(self.required)
+        for name in sorted(names):
+            pkg = self.candidate(name)
+            if (include_essential and pkg.essential) or \
+                    (include_priority_required and pkg.required):
+                select(pkg)
+
+        while follow_deps and queue:
+            pkg = queue.popleft()
+            for alternatives in pkg.relations():
+                if any(satisfied(*x) for x in alternatives):
+                    continue
+                # Only one version of a package can be installed, so an
+                # alternative that needs a different version from the one
+                # already selected can't be used.
+                for x in alternatives:
+                    dep = self.find(*x)
+                    if dep is not None and select(dep):
+                        break
+                else:
+                    errors.append(
+                        "%s %s depends on %s which can't be satisfied" % (
+                            pkg.name, pkg.version, " | ".join(
+                                _format_relation(*x) for x in alternatives)))
+
+        if errors:
+            raise ResolveError("\n".join(errors))
+        return sorted(selected.values(), key=lambda x: x.name)
+
+
+def _format_relation(name, op, version):
+    if op is None:
+        return name
+    return "%s (%s %s)" % (name, op, version)
+
+
+def resolver_options(aptly_args):
+    """The keyword arguments to `PackageIndex.resolve` equivalent to the
+    `aptly lockfile create` arguments that `Apt.generate_lockfile` uses"""
+    return {
+        "follow_deps": "-solver=no-deps" not in aptly_args,
+        "include_essential": "-include-essential=false" not in aptly_args,
+        "include_priority_required":
+            "-include-priority-required=false" not in aptly_args,
+    }
+
+
+def write_lockfile(f, packages):
+    """Writes the `Package`s packages to the text file f"""
+    for pkg in packages:
+        f.write(pkg.lockfile_stanza())
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+
+"""
+Prepares an image for `dpkg --configure -a` starting from an image that has
+already been configured.
+
+Many images are variants of a common base: their lockfiles contain every
+package of the base lockfile, at the same version, plus a few more.  Rather
+than configuring all the packages again we start from the configured base
+image, unpack the additional packages over the top and add them to
+var/lib/dpkg/status as unpacked.  `dpkg --configure -a` then only has to
+configure the additional packages.
+
+If the base isn't a subset of the image we start from the unpacked image
+instead and configure everything.
+
+dpkg would activate the triggers of the base packages as the additional
+packages were unpacked: file triggers for the paths they install (libc-bin's
+ldconfig, mime and icon caches and so on) and the triggers named by
+`activate` in their triggers control files.  We unpack them ourselves so we
+work out which triggers they activate from var/lib/dpkg/triggers in the base
+and mark the interested base packages as triggers-pending.
+`dpkg --configure -a` then runs those triggers.
+
+What isn't the same as configuring from scratch is that the postinsts of the
+base packages aren't run again, so a postinst that looks at which other
+packages are installed, rather than using a trigger, won't see the
+additional packages.  `ninja check-seeded-<branch>` compares the result with
+configuring from scratch.
+"""
+
+import argparse
+import binascii
+import os
+import shutil
+import sys
+
+from .incremental import combine_from_scratch, read_ref
+from .ninja import write_if_changed
+from .ostree_worker import check_output
+from .usrmove import COMMIT, Tree, read_object, usrmove
+
+TRIGGERS_DIR = "var/lib/dpkg/triggers"
+
+
+def read_manifest(filename):
+    """Reads the manifest written by `Apt.image_from_lockfile`.  Returns a
+    list of (package, version, architecture, sha256, data_ref, info_ref)."""
+    out = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                out.append(tuple(fields))
+    return out
+
+
+def extra_packages(base, image):
+    """Returns the entries in image manifest that aren't in base, or None if
+    base isn't a subset of image"""
+    base_debs = set(x[:4] for x in base)
+    image_debs = set(x[:4] for x in image)
+    if not base_debs.issubset(image_debs):
+        return None
+    return [x for x in image if x[:4] not in base_debs]
+
+
+def _stanzas(text):
+    return [x.strip("\n") + "\n" for x in text.split("\n\n") if x.strip()]
+
+
+def _key(stanza):
+    """(Package, Architecture) of a dpkg status stanza"""
+    fields = {}
+    for line in stanza.split("\n"):
+        if ":" in line and not line.startswith((" ", "\t")):
+            name, value = line.split(":", 1)
+            fields[name] = value.strip()
+    return fields.get("Package"), fields.get("Architecture")
+
+
+def merge_status(base_status, image_status, extra):
+    """The base's dpkg status, with the stanzas for the extra packages from
+    the image's status appended"""
+    wanted = set((x[0], x[2]) for x in extra)
+    out = _stanzas(base_status)
+    out += [x for x in _stanzas(image_status) if _key(x) in wanted]
+    return "\n".join(out) + "\n" if out else ""
+
+
+def _hex(checksum):
+    return binascii.hexlify(checksum).decode("ascii")
+
+
+def _root(repo, ref):
+    """The checksum of the root dirtree of the commit ref points to"""
+    checksum = read_ref(repo, ref) or ref
+    return _hex(read_object(repo, checksum, "commit", COMMIT)[6])
+
+
+def _subtree(repo, tree, path):
+    """The dirtree at path under the dirtree tree, or None"""
+    for name in path.split("/"):
+        tree = Tree(repo, tree).dirs.get(name, (None,))[0]
+        if tree is None:
+            return None
+    return tree
+
+
+def _paths(repo, tree, prefix=""):
+    """Yields the absolute path of everything under the dirtree tree"""
+    t = Tree(repo, tree)
+    for name in t.files:
+        yield "%s/%s" % (prefix, name)
+    for name, (subtree, _) in t.dirs.items():
+        yield "%s/%s" % (prefix, name)
+        for x in _paths(repo, subtree, "%s/%s" % (prefix, name)):
+            yield x
+
+
+def read_interests(repo, ref):
+    """Reads the trigger interests recorded in var/lib/dpkg/triggers of the
+    image ref.  Returns (files, explicit): files is a list of (path,
+    package) for file triggers and explicit a dict from the name of each
+    explicit trigger to the packages interested in it."""
+    files = []
+    explicit = {}
+    tree = _subtree(repo, _root(repo, ref), TRIGGERS_DIR)
+    if tree is None:
+        return files, explicit
+    for name in sorted(Tree(repo, tree).files):
+        if name in ("Lock", "Unincorp"):
+            continue
+        text = _ostree(repo, "cat", ref, "/%s/%s" % (TRIGGERS_DIR, name))
+        for line in text.splitlines():
+            fields = line.split()
+            if name == "File" and len(fields) == 2:
+                files.append((fields[0], fields[1].split("/")[0]))
+            elif name != "File" and len(fields) == 1:
+                explicit.setdefault(name, []).append(
+                    fields[0].split("/")[0])
+    return files, explicit
+
+
+def read_activations(repo, data_ref, info_ref):
+    """Returns the paths a package installs and the names of the triggers
+    its triggers control file activates"""
+    paths = set(_paths(repo, _root(repo, data_ref)))
+    names = set()
+    for path in _paths(repo, _root(repo, info_ref)):
+        if not path.endswith(".triggers"):
+            continue
+        for line in _ostree(repo, "cat", info_ref, path).splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0].startswith("activate"):
+                names.add(fields[1])
+    return paths, names
+
+
+def pending_triggers(interests, paths, names):
+    """Returns a dict from each package with an interest in `read_interests`
+    format that the paths installed or trigger names activated activate, to
+    the set of its triggers to run.  A file trigger is named after the path
+    of its interest, as in dpkg's Triggers-Pending."""
+    files, explicit = interests
+    out = {}
+    for interest, package in files:
+        prefix = interest.rstrip("/") + "/"
+        if interest in paths or interest in names or any(
+                x.startswith(prefix) for x in paths):
+            out.setdefault(package, set()).add(interest)
+    for name in names:
+        for package in explicit.get(name, []):
+            out.setdefault(package, set()).add(name)
+    return out
+
+
+def mark_pending(status, pending):
+    """Marks the installed packages in the dpkg status text that have
+    triggers in pending (as returned by `pending_triggers`) as
+    triggers-pending, with the triggers in Triggers-Pending"""
+    by_name = {}
+    for package, names in pending.items():
+        name, _, arch = package.partition(":")
+        by_name.setdefault(name, []).append((arch, names))
+    out = []
+    for stanza in _stanzas(status):
+        name, arch = _key(stanza)
+        names = set()
+        for x, y in by_name.get(name, []):
+            if not x or x == arch:
+                names.update(y)
+        lines = stanza.rstrip("\n").split("\n")
+        status_lines = [n for n, line in enumerate(lines)
+                        if line.startswith("Status:")]
+        if names and status_lines:
+            n = status_lines[0]
+            want, flag, state = lines[n].split(":", 1)[1].split()
+            if state in ("installed", "triggers-pending"):
+                lines[n] = "Status: %s %s triggers-pending" % (want, flag)
+                for m, line in enumerate(lines):
+                    if line.startswith("Triggers-Pending:"):
+                        names.update(line.split(":", 1)[1].split())
+                        del lines[m]
+                        break
+                lines.append("Triggers-Pending: %s" % " ".join(sorted(names)))
+        out.append("\n".join(lines) + "\n")
+    return "\n".join(out) + "\n" if out else ""
+
+
+def _ostree(repo, *args):
+    return check_output(["--repo=%s" % repo] + list(args)).decode("utf-8")
+
+
+def seed(repo, in_branch, out_branch, base_branch, base_manifest, manifest,
+         status, available, tmpdir, do_usrmove=False):
+    """Sets out_branch to the image to run `dpkg --configure -a` in.
+    do_usrmove should match the `usrmove` the image was built with."""
+    extra = extra_packages(read_manifest(base_manifest),
+                           read_manifest(manifest))
+    if extra is None:
+        sys.stderr.write("%s isn't a subset of %s.  Configuring all "
+                         "packages.\n" % (base_manifest, manifest))
+        result = read_ref(repo, in_branch)
+    else:
+        sys.stderr.write("Seeding from %s: %i packages to configure\n" % (
+            base_branch, len(extra)))
+        data = [x[4] for x in extra]
+        if data and do_usrmove:
+            # The base has already had usrmove applied so its /bin is a
+            # symlink.  The new packages must be moved to match.
+            data = [usrmove(repo, combine_from_scratch(repo, data),
+                            tmpdir + ".usrmove")]
+        combined = combine_from_scratch(
+            repo, [base_branch] + data + [x[5] for x in extra])
+
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        dpkg_dir = os.path.join(tmpdir, "var/lib/dpkg")
+        os.makedirs(dpkg_dir)
+        with open(status) as f:
+            image_status = f.read()
+        paths = set()
+        names = set()
+        for x in extra:
+            p, n = read_activations(repo, x[4], x[5])
+            paths.update(p)
+            names.update(n)
+        pending = pending_triggers(read_interests(repo, base_branch), paths,
+                                   names)
+        if pending:
+            sys.stderr.write("Triggers to run: %s\n" % " ".join(
+                sorted(pending)))
+        base_status = mark_pending(
+            _ostree(repo, "cat", base_branch, "/var/lib/dpkg/status"),
+            pending)
+        with open(os.path.join(dpkg_dir, "status"), "w") as f:
+            f.write(merge_status(base_status, image_status, extra))
+        shutil.copyfile(available, os.path.join(dpkg_dir, "available"))
+        result = _ostree(
+            repo, "commit", "--no-bindings", "--orphan", "--timestamp=0",
+            "--tree=ref=%s" % combined, "--tree=dir=%s" % tmpdir,
+            "--owner-uid=0", "--owner-gid=0", "--no-xattrs").strip()
+        shutil.rmtree(tmpdir)
+    write_if_changed("%s/refs/heads/%s" % (repo, out_branch), result + "\n")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Prepare an image for configuring from a configured base")
+    parser.add_argument("--repo", required=True)
+    parser.add_argument("--in-branch", required=True,
+                        help="The unpacked image")
+    parser.add_argument("--out-branch", required=True)
+    parser.add_argument("--base-branch", required=True,
+                        help="The configured base image")
+    parser.add_argument("--base-manifest", required=True)
+    parser.add_argument("--manifest", required=True)
+    parser.add_argument("--status", required=True,
+                        help="var/lib/dpkg/status of the unpacked image")
+    parser.add_argument("--available", required=True,
+                        help="var/lib/dpkg/available of the unpacked image")
+    parser.add_argument("--tmpdir", required=True)
+    parser.add_argument("--usrmove", action="store_true",
+                        help="The image was built with usrmove")
+    args = parser.parse_args(argv[1:])
+
+    seed(args.repo, args.in_branch, args.out_branch, args.base_branch,
+         args.base_manifest, args.manifest, args.status, args.available,
+         args.tmpdir, args.usrmove)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+"""
+Reports how much of an image each of its packages accounts for.
+
+    python -m apt2ostree.sizes --repo=_build/ostree --manifest=MANIFEST
+        [--image=BRANCH] [--json=FILE] [--text=FILE] [OTHER_MANIFEST...]
+
+or `ninja size-report-<lockfile>`, which writes
+_build/size-report/<lockfile>.txt and .json.
+
+The packages of an image are read from the manifest written by
+`Apt.image_from_lockfile`, which gives the data and info commits of each
+deb.  Sizes come from walking those commits' dirtrees and stat-ing the file
+objects they refer to, so nothing is checked out and no file content is
+read.  A file object that appears more than once, in one package or in
+several, is the same bytes on disk so it's counted once per package and once
+in the image total.  Sizes are of the content: in a bare-user repo that's
+what's on disk, less block rounding.
+
+Each package's bytes are split into those shared with the other images
+given as OTHER_MANIFEST, which are already in the repo for them, and those
+only this image needs.  Packages of the other images that haven't been built
+don't count as shared, so `ninja size-report-<lockfile>` doesn't need to
+build the other images first.  With --image the image commit itself is walked too
+and anything in it that isn't from a package (what `dpkg --configure`
+wrote, for instance) is reported as unattributed.
+
+The text report has a line per package, largest first, with tab-separated
+columns so it can be re-sorted with `sort -n -k2` and so on.  The JSON
+report has the same numbers for checking against size budgets.
+"""
+
+import argparse
+import binascii
+import json
+import os
+import sys
+
+from .impact import human_size
+from .incremental import read_ref
+from .seed import read_manifest
+from .usrmove import COMMIT, DIRTREE, read_object
+
+
+class Sizes(object):
+    """The file objects of commits and their sizes, cached"""
+    def __init__(self, repo):
+        self.repo = repo
+        self._files = {}  # commit checksum -> frozenset of file checksums
+        self._sizes = {}  # file checksum -> size
+
+    def files(self, ref):
+        """The set of file object checksums in the commit ref points to"""
+        csum = read_ref(self.repo, ref)
+        if csum is None:
+            raise ValueError("%s: No such ref %s" % (self.repo, ref))
+        if csum not in self._files:
+            commit = read_object(self.repo, csum, "commit", COMMIT)
+            out = set()
+            self._walk(_hex(commit[6]), out, set())
+            self._files[csum] = frozenset(out)
+        return self._files[csum]
+
+    def _walk(self, tree, out, seen):
+        if tree in seen:
+            return
+        seen.add(tree)
+        files, dirs = read_object(self.repo, tree, "dirtree", DIRTREE)
+        out.update(_hex(csum) for _, csum in files)
+        for _, subtree, _ in dirs:
+            self._walk(_hex(subtree), out, seen)
+
+    def size(self, csum):
+        if csum not in self._sizes:
+            self._sizes[csum] = os.lstat("%s/objects/%s/%s.file" % (
+                self.repo, csum[:2], csum[2:])).st_size
+        return self._sizes[csum]
+
+    def total(self, files):
+        return sum(self.size(x) for x in files)
+
+
+def _hex(checksum):
+    return binascii.hexlify(checksum).decode("ascii")
+
+
+def report(sizes, manifest, others=(), image=None):
+    """Returns the size report of the image with the manifest (as returned by
+    `read_manifest`) as a dict.  others are the manifests of the other
+    images in the repo.  Their packages that haven't been built yet aren't in
+    the repo, so can't be shared, and are skipped."""
+    elsewhere = set()
+    for other in others:
+        for entry in other:
+            for ref in entry[4:6]:
+                if read_ref(sizes.repo, ref) is not None:
+                    elsewhere.update(sizes.files(ref))
+
+    packages = []
+    in_packages = set()
+    for package, version, architecture, _, data_ref, info_ref in manifest:
+        files = sizes.files(data_ref) | sizes.files(info_ref)
+        in_packages.update(files)
+        packages.append({
+            "package": package,
+            "version": version,
+            "architecture": architecture,
+            "files": len(files),
+            "bytes": sizes.total(files),
+            "shared_bytes": sizes.total(files & elsewhere),
+        })
+    packages.sort(key=lambda x: (-x["bytes"], x["package"]))
+
+    out = {
+        "packages": packages,
+        "package_bytes": sizes.total(in_packages),
+        "shared_bytes": sizes.total(in_packages & elsewhere),
+    }
+    if image is not None:
+        files = sizes.files(image)
+        out["image"] = image
+        out["commit"] = read_ref(sizes.repo, image)
+        out["bytes"] = sizes.total(files)
+        out["unattributed_bytes"] = sizes.total(files - in_packages)
+    return out
+
+
+def format_text(r):
+    lines = []
+    if "image" in r:
+        lines.append("# %s (%s): %s, %s not from a package" % (
+            r["image"], r["commit"], human_size(r["bytes"]),
+            human_size(r["unattributed_bytes"])))
+    lines.append("# Packages: %s, of which %s shared with other images" % (
+        human_size(r["package_bytes"]), human_size(r["shared_bytes"])))
+    lines.append("# package\tbytes\tshared_bytes\tfiles\tversion")
+    for x in r["packages"]:
+        lines.append("%s\t%i\t%i\t%i\t%s" % (
+            x["package"], x["bytes"], x["shared_bytes"], x["files"],
+            x["version"]))
+    return "".join(x + "\n" for x in lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Report how much of an image each package accounts for")
+    parser.add_argument("--repo", default="_build/ostree")
+    parser.add_argument("--manifest", required=True,
+                        help="The manifest of the image's packages")
+    parser.add_argument("--image", help="The image branch")
+    parser.add_argument("--json", help="Write the report as JSON to this "
+                        "file rather than as text to stdout")
+    parser.add_argument("--text", help="Write the text report to this file")
+    parser.add_argument("others", nargs="*", metavar="OTHER_MANIFEST",
+                        help="The manifests of the other images in the "
+                        "repo")
+    args = parser.parse_args(argv[1:])
+
+    others = [read_manifest(x) for x in args.others
+              if os.path.abspath(x) != os.path.abspath(args.manifest)]
+    try:
+        r = report(Sizes(args.repo), read_manifest(args.manifest), others,
+                   args.image)
+    except (EnvironmentError, ValueError) as e:
+        sys.stderr.write("sizes: %s\n" % e)
+        return 1
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(r, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.text:
+        with open(args.text, "w") as f:
+            f.write(format_text(r))
+    if not args.json and not args.text:
+        sys.stdout.write(format_text(r))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+"""
+Reports where the time of a build went, from ninja's log.
+
+    python -m apt2ostree.timings [--log=_build/.ninja_log] [--top=20]
+        [--target=TARGET...] [--json] [build.ninja]
+
+or `ninja build-times`.
+
+ninja records when each command it runs starts and finishes in
+_build/.ninja_log, by output.  This joins that with the build statements in
+build.ninja and the fragments it includes to give:
+
+* the number of steps, total time, 95th percentile and maximum of each
+  rule (`download_deb`, `make_dpkg_info`, `dpkg_configure`, ...),
+* the packages that took longest, adding up the steps with a `pkgname` or
+  `ref_base` variable that belong to each, and
+* the critical path to each image: the chain of steps, each depending on the
+  one before, that took longest.  However many jobs ninja is given the image
+  can't be built any faster than this, so it's what to look at first.
+
+The images are the `image-for-<lockfile>` targets, or
+`unpacked-image-for-<lockfile>` where there's no configured image, unless
+--target is given.
+
+The log has the last time each step ran, which may not be the last build if
+the step was up to date then.  Steps that aren't in the log at all are
+counted as taking no time.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+
+from .impact import read_edges
+
+LOG_HEADER = "# ninja log v"
+
+
+def read_log(filename):
+    """Returns a dict from each output in the ninja log to the (start, end)
+    of the last time it was built, in milliseconds"""
+    out = {}
+    with open(filename) as f:
+        for line in f:
+            if line.startswith(LOG_HEADER):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            out[os.path.normpath(fields[3])] = (int(fields[0]),
+                                                int(fields[1]))
+    return out
+
+
+def _round(secs):
+    # To the millisecond, as in the log
+    return round(secs, 3)
+
+
+def percentile(values, p):
+    """The nearest-rank pth percentile of values"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100. * len(values))) - 1)]
+
+
+class Build(object):
+    """The build statements of a ninja file with the time each took"""
+    def __init__(self, edges, log):
+        self.edges = edges
+        self.producer = {}
+        for n, edge in enumerate(edges):
+            for x in edge.outputs:
+                self.producer[os.path.normpath(x)] = n
+
+        self.duration = {}
+        for n, edge in enumerate(edges):
+            for x in edge.outputs:
+                times = log.get(os.path.normpath(x))
+                if times is not None:
+                    self.duration[n] = (times[1] - times[0]) / 1000.
+                    break
+
+        # ref_base -> pkgname, as download_deb doesn't have the name
+        self.names = {}
+        for edge in edges:
+            if "pkgname" in edge.variables and "ref_base" in edge.variables:
+                self.names[edge.variables["ref_base"]] = \
+                    edge.variables["pkgname"]
+
+    def package(self, edge):
+        """The name of the package edge builds something for or None"""
+        v = edge.variables
+        return v.get("pkgname") or self.names.get(v.get("ref_base"),
+                                                  v.get("ref_base"))
+
+    def label(self, n):
+        edge = self.edges[n]
+        return self.package(edge) or (edge.outputs[0] if edge.outputs
+                                      else "")
+
+    def rules(self):
+        """Returns a list of dicts with the count, total, p95 and max time of
+        each rule that was run, largest total first"""
+        times = {}
+        for n, edge in enumerate(self.edges):
+            if n in self.duration:
+                times.setdefault(edge.rule, []).append(self.duration[n])
+        out = [{"rule": rule, "count": len(x), "total": _round(sum(x)),
+                "p95": percentile(x, 95), "max": max(x)}
+               for rule, x in times.items()]
+        out.sort(key=lambda x: (-x["total"], x["rule"]))
+        return out
+
+    def not_logged(self):
+        """The number of (non-phony) steps that aren't in the log"""
+        return sum(1 for n, edge in enumerate(self.edges)
+                   if edge.rule != "phony" and n not in self.duration)
+
+    def packages(self):
+        """Returns a list of dicts with the total time of each package and
+        the time taken by each rule for it, largest total first"""
+        times = {}
+        for n, edge in enumerate(self.edges):
+            package = self.package(edge)
+            if package is not None and n in self.duration:
+                rules = times.setdefault(package, {})
+                rules[edge.rule] = rules.get(edge.rule, 0) + self.duration[n]
+        out = [{"package": package, "total": _round(sum(rules.values())),
+                "rules": dict((rule, _round(secs))
+                              for rule, secs in rules.items())}
+               for package, rules in times.items()]
+        out.sort(key=lambda x: (-x["total"], x["package"]))
+        return out
+
+    def critical_path(self, target):
+        """Returns the steps of the longest chain of steps that target depends
+        on as a list of (edge index, duration), first step first"""
+        start = self.producer.get(os.path.normpath(target))
+        if start is None:
+            raise ValueError("Nothing builds %s" % target)
+        # edge index -> (length of the longest chain ending in it, the
+        # previous step in that chain)
+        longest = {}
+        visiting = set()
+        stack = [start]
+        while stack:
+            n = stack[-1]
+            if n in longest:
+                stack.pop()
+                continue
+            visiting.add(n)
+            edge = self.edges[n]
+            deps = set(self.producer[x] for x in map(
+                os.path.normpath, edge.inputs + edge.order_only)
+                if x in self.producer)
+            todo = [x for x in deps if x not in longest and x not in visiting]
+            if todo:
+                stack.extend(sorted(todo))
+                continue
+            best = None
+            for x in sorted(deps):
+                if x in longest and (best is None or
+                                     longest[x][0] > longest[best][0]):
+                    best = x
+            longest[n] = (self.duration.get(n, 0) +
+                          (longest[best][0] if best is not None else 0), best)
+            visiting.discard(n)
+            stack.pop()
+
+        out = []
+        n = start
+        while n is not None:
+            if self.edges[n].rule != "phony":
+                out.append((n, self.duration.get(n, 0)))
+            n = longest[n][1]
+        out.reverse()
+        return out
+
+    def images(self):
+        """The image targets to report the critical paths of"""
+        phony = set(x for edge in self.edges if edge.rule == "phony"
+                    for x in edge.outputs)
+        out = sorted(x for x in phony if x.startswith("image-for-"))
+        out += sorted(
+            x for x in phony if x.startswith("unpacked-image-for-") and
+            x[len("unpacked-"):] not in phony)
+        return out
+
+
+def report(build, targets=None, top=20):
+    """Returns the report as a dict"""
+    paths = []
+    for target in targets or build.images():
+        steps = build.critical_path(target)
+        paths.append({
+            "target": target,
+            "total": _round(sum(secs for _, secs in steps)),
+            "steps": [{"rule": build.edges[n].rule, "label": build.label(n),
+                       "seconds": secs} for n, secs in steps],
+        })
+    return {
+        "rules": build.rules(),
+        "packages": build.packages()[:top],
+        "critical_paths": paths,
+        "not_logged": build.not_logged(),
+    }
+
+
+def format_text(r):
+    lines = ["%-28s %6s %10s %9s %9s" % (
+        "Rule", "Steps", "Total (s)", "p95 (s)", "Max (s)")]
+    for x in r["rules"]:
+        lines.append("%-28s %6i %10.1f %9.1f %9.1f" % (
+            x["rule"], x["count"], x["total"], x["p95"], x["max"]))
+    if r["not_logged"]:
+        lines.append("Steps not in the log: %i" % r["not_logged"])
+    lines.append("")
+    lines.append("Slowest packages:")
+    for x in r["packages"]:
+        lines.append("    %8.1f s  %s (%s)" % (
+            x["total"], x["package"], ", ".join(
+                "%s %.1f s" % rule for rule in sorted(
+                    x["rules"].items(), key=lambda y: -y[1]))))
+    for path in r["critical_paths"]:
+        lines.append("")
+        lines.append("Critical path to %s: %.1f s in %i steps" % (
+            path["target"], path["total"], len(path["steps"])))
+        for x in path["steps"]:
+            lines.append("    %8.1f s  %-24s %s" % (
+                x["seconds"], x["rule"], x["label"]))
+    return "".join(x + "\n" for x in lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Report where the time of a build went")
+    parser.add_argument("--log", default="_build/.ninja_log")
+    parser.add_argument("--top", type=int, default=20,
+                        help="How many of the slowest packages to list")
+    parser.add_argument("--target", action="append",
+                        help="Report the critical path to this target "
+                             "rather than to each image")
+    parser.add_argument("--json", action="store_true",
+                        help="Write the report as JSON")
+    parser.add_argument("ninja_file", nargs="?", default="build.ninja")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        build = Build(list(read_edges(args.ninja_file)), read_log(args.log))
+        r = report(build, args.target, args.top)
+    except (EnvironmentError, ValueError) as e:
+        sys.stderr.write("timings: %s\n" % e)
+        return 1
+    if args.json:
+        json.dump(r, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        sys.stdout.write(format_text(r))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+"""
+Updates lockfiles by resolving their packages against apt sources with
+aptly.
+
+    python -m apt2ostree.update_lockfile --tmpdir=DIR SPEC...
+
+Each SPEC is a JSON file written by `Apt.generate_lockfile` describing one
+lockfile.  Lockfiles whose apt indices haven't changed are skipped (see
+`index_cache.py`).  The rest are resolved concurrently.  Lockfiles that share
+apt sources share their aptly mirrors: the mirrors are created once and each
+resolution gets its own copy of the aptly HOME, as aptly can't share its
+database between processes.
+
+The result is the same as resolving each lockfile on its own.  A lockfile is
+only written if it has changed.
+
+Lockfiles whose spec has "resolver": "builtin" are resolved with
+`resolver.py` rather than aptly.  The Packages indices come from the index
+cache and each set of apt sources is loaded once for all the lockfiles that
+use it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pipes
+import shutil
+import subprocess
+import sys
+import threading
+
+from .fetch import FetchError, Fetcher
+from .index_cache import IndexCache, check
+from .resolver import (PackageIndex, ResolveError, resolver_options,
+                       write_lockfile)
+
+INDEX_CACHE = "_build/apt/index-cache"
+
+
+def read_spec(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _inputs(spec):
+    return " ".join(spec["packages"] + [spec["architecture"]] +
+                    spec["aptly_args"] + [spec["resolver"]])
+
+
+def _run(cmd, **kwargs):
+    sys.stderr.write("+ %s\n" % " ".join(pipes.quote(x) for x in cmd))
+    subprocess.check_call(cmd, **kwargs)
+
+
+def _install(spec):
+    """Replaces the lockfile with lockfile~ if they're different"""
+    lockfile = spec["lockfile"]
+    with open(lockfile + "~", "rb") as a:
+        new = a.read()
+    try:
+        with open(lockfile, "rb") as b:
+            old = b.read()
+    except IOError:
+        old = None
+    if new == old:
+        os.unlink(lockfile + "~")
+    else:
+        os.rename(lockfile + "~", lockfile)
+    if os.path.exists(spec["state"] + "~"):
+        os.rename(spec["state"] + "~", spec["state"])
+
+
+def _remove_partial(spec):
+    if os.path.exists(spec["lockfile"] + "~"):
+        os.unlink(spec["lockfile"] + "~")
+
+
+def resolve(spec, home):
+    """Writes the lockfile described by spec using the aptly mirrors in home"""
+    env = dict(os.environ)
+    env["HOME"] = home
+    try:
+        with open(spec["lockfile"] + "~", "wb") as f:
+            _run(["aptly", "lockfile", "create",
+                  "-mirrors", ",".join(spec["mirrors"]),
+                  "-architectures=" + spec["architecture"]] +
+                 spec["aptly_args"] + ["-gpg-provider=internal"] +
+                 spec["packages"], stdout=f, env=env)
+    except:
+        _remove_partial(spec)
+        raise
+    _install(spec)
+
+
+def load_index(cache, spec, fetcher):
+    """Returns a `PackageIndex` of the apt sources of spec"""
+    architecture = spec["architecture"]
+    index = PackageIndex(architecture)
+    for archive_url, distribution, _, components in spec["sources"]:
+        for component in components:
+            for arch in [architecture, "all"]:
+                filename = cache.packages(
+                    archive_url, distribution, arch, component,
+                    spec["keyrings"], fetcher)
+                if filename is not None:
+                    index.add_file(filename)
+    return index
+
+
+def resolve_builtin(cache, specs):
+    """Writes the lockfiles described by specs with `resolver.py`.  Each set
+    of apt sources is only loaded once.  Returns a list of error messages,
+    empty on success."""
+    errors = []
+    indices = {}
+    fetcher = Fetcher()
+    for spec in specs:
+        key = json.dumps([spec["architecture"], spec["sources"],
+                          spec["keyrings"]])
+        try:
+            if key not in indices:
+                indices[key] = load_index(cache, spec, fetcher)
+            packages = indices[key].resolve(
+                spec["packages"], **resolver_options(spec["aptly_args"]))
+            try:
+                with open(spec["lockfile"] + "~", "w") as f:
+                    write_lockfile(f, packages)
+            except:
+                _remove_partial(spec)
+                raise
+            _install(spec)
+        except (EnvironmentError, ValueError, FetchError, ResolveError) as e:
+            errors.append("%s: %s" % (spec["lockfile"], e))
+    fetcher.close()
+    return errors
+
+
+def update(specs, tmpdir, jobs=None):
+    """Updates the lockfiles described by specs.  Returns a list of error
+    messages, empty on success."""
+    cache = IndexCache(INDEX_CACHE)
+    todo = [x for x in specs
+            if not check(cache, x["state"], x["lockfile"], _inputs(x),
+                         x["sources"])]
+    errors = resolve_builtin(
+        cache, [x for x in todo if x["resolver"] == "builtin"])
+    todo = [x for x in todo if x["resolver"] == "aptly"]
+    if not todo:
+        return errors
+
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    homes = {}
+    queue = []
+    for n, spec in enumerate(todo):
+        create_mirrors = spec["create_mirrors"]
+        if create_mirrors not in homes:
+            homes[create_mirrors] = os.path.join(tmpdir, "mirrors-%i" %
+                                                 len(homes))
+            os.makedirs(homes[create_mirrors])
+            env = dict(os.environ)
+            env["HOME"] = homes[create_mirrors]
+            _run([create_mirrors], env=env)
+        queue.append((spec, homes[create_mirrors], os.path.join(
+            tmpdir, "%i" % n)))
+
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                spec, mirrors, home = queue.pop(0)
+            try:
+                shutil.copytree(mirrors, home, symlinks=True)
+                resolve(spec, home)
+                shutil.rmtree(home)
+            except (EnvironmentError, subprocess.CalledProcessError) as e:
+                with lock:
+                    errors.append("%s: %s" % (spec["lockfile"], e))
+
+    if jobs is None:
+        # Like ninja: resolving is partly waiting for the network
+        jobs = multiprocessing.cpu_count() + 2
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(jobs, len(queue)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if not errors:
+        shutil.rmtree(tmpdir)
+    return errors
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Update lockfiles from their apt sources")
+    parser.add_argument("--tmpdir", required=True)
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="How many lockfiles to resolve at once.  "
+                        "Defaults to the number of CPUs + 2.")
+    parser.add_argument("spec", nargs="+")
+    args = parser.parse_args(argv[1:])
+
+    errors = update([read_spec(x) for x in args.spec], args.tmpdir,
+                    args.jobs)
+    for x in errors:
+        sys.stderr.write("Failed to update %s\n" % x)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
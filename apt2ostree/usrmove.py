@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+"""
+Moves /bin, /sbin and /lib under /usr in an ostree commit, replacing them
+with symlinks.
+
+Rather than checking the image out and committing it again we rewrite the
+commit's dirtree objects directly.  /bin is merged into /usr/bin as if it had
+been checked out over the top with `ostree checkout --union`, so where both
+have a file of the same name the one from /bin wins.  Only the dirtrees on
+the path from the root to what changed are written.  File content is never
+read.
+
+The symlinks themselves are file objects, so they're written by a tiny
+`ostree commit` of a directory containing just the symlinks.
+"""
+
+import argparse
+import binascii
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+from . import gvariant
+from .ninja import write_if_changed
+from .ostree_worker import check_output
+
+DIRTREE = "(a(say)a(sayay))"
+COMMIT = "(a{sv}aya(say)sstayay)"
+
+MOVED = ["bin", "sbin", "lib"]
+
+
+def _hex(checksum):
+    return binascii.hexlify(checksum).decode("ascii")
+
+
+def _object_path(repo, checksum, objtype):
+    return "%s/objects/%s/%s.%s" % (repo, checksum[:2], checksum[2:], objtype)
+
+
+def read_ref(repo, ref):
+    """Returns the checksum ref points to or None"""
+    try:
+        with open("%s/refs/heads/%s" % (repo, ref)) as f:
+            return f.read().strip()
+    except IOError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+
+def read_object(repo, checksum, objtype, typestr):
+    with open(_object_path(repo, checksum, objtype), "rb") as f:
+        return gvariant.deserialize(typestr, f.read())
+
+
+def write_object(repo, objtype, typestr, value):
+    """Writes a metadata object to repo.  Returns its checksum."""
+    data = gvariant.serialize(typestr, value)
+    checksum = hashlib.sha256(data).hexdigest()
+    filename = _object_path(repo, checksum, objtype)
+    if os.path.exists(filename):
+        return checksum
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    fd, tmpname = tempfile.mkstemp(dir="%s/tmp" % repo)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+    return checksum
+
+
+class Tree(object):
+    """An ostree dirtree with its files and subdirectories in dicts keyed by
+    name.  Files map to their checksum, subdirectories to (dirtree checksum,
+    dirmeta checksum)."""
+    def __init__(self, repo, checksum=None):
+        self.files = {}
+        self.dirs = {}
+        if checksum is not None:
+            files, dirs = read_object(repo, checksum, "dirtree", DIRTREE)
+            for name, csum in files:
+                self.files[name] = _hex(csum)
+            for name, tree, meta in dirs:
+                self.dirs[name] = (_hex(tree), _hex(meta))
+
+    def write(self, repo):
+        unhex = binascii.unhexlify
+        return write_object(repo, "dirtree", DIRTREE, (
+            [(name, unhex(csum))
+             for name, csum in sorted(self.files.items())],
+            [(name, unhex(tree), unhex(meta))
+             for name, (tree, meta) in sorted(self.dirs.items())]))
+
+
+def union(repo, dest, src):
+    """Returns the checksum of the dirtree dest with src checked out over the
+    top.  Directories in dest keep their metadata."""
+    tree = Tree(repo, dest)
+    other = Tree(repo, src)
+    for name, csum in other.files.items():
+        if name in tree.dirs:
+            raise ValueError("Can't replace directory %s with a file" % name)
+        tree.files[name] = csum
+    for name, (subtree, meta) in other.dirs.items():
+        if name in tree.files:
+            raise ValueError("Can't replace file %s with a directory" % name)
+        if name in tree.dirs:
+            tree.dirs[name] = (
+                union(repo, tree.dirs[name][0], subtree), tree.dirs[name][1])
+        else:
+            tree.dirs[name] = (subtree, meta)
+    return tree.write(repo)
+
+
+def _symlinks(repo, tmpdir):
+    """Returns a dict from name to the checksum of a symlink file object
+    pointing to usr/<name>, owned by root"""
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    for name in MOVED:
+        os.symlink("usr/" + name, os.path.join(tmpdir, name))
+    commit = check_output(
+        ["--repo=%s" % repo, "commit", "--no-bindings", "--orphan",
+         "--timestamp=0", "--owner-uid=0", "--owner-gid=0", "--no-xattrs",
+         "--tree=dir=%s" % tmpdir]).decode("ascii").strip()
+    shutil.rmtree(tmpdir)
+    root = read_object(repo, commit, "commit", COMMIT)[6]
+    return Tree(repo, _hex(root)).files
+
+
+def usrmove(repo, checksum, tmpdir):
+    """Returns the checksum of the commit checksum with bin, sbin and lib
+    moved under usr"""
+    commit = read_object(repo, checksum, "commit", COMMIT)
+    root_meta = _hex(commit[7])
+    root = Tree(repo, _hex(commit[6]))
+    moved = [x for x in MOVED if x in root.dirs]
+    if not moved:
+        return checksum
+
+    usr, usr_meta = root.dirs.get("usr", (None, root_meta))
+    usr = Tree(repo, usr)
+    for name in moved:
+        tree, meta = root.dirs.pop(name)
+        if name in usr.dirs:
+            usr.dirs[name] = (union(repo, usr.dirs[name][0], tree),
+                              usr.dirs[name][1])
+        elif name in usr.files:
+            raise ValueError("Can't replace file usr/%s with a directory" %
+                             name)
+        else:
+            usr.dirs[name] = (tree, meta)
+    root.dirs["usr"] = (usr.write(repo), usr_meta)
+
+    symlinks = _symlinks(repo, tmpdir)
+    for name in moved:
+        root.files[name] = symlinks[name]
+
+    return write_object(repo, "commit", COMMIT, (
+        commit[:6] + (binascii.unhexlify(root.write(repo)), commit[7])))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Move /bin, /sbin and /lib under /usr in an ostree commit")
+    parser.add_argument("--repo", required=True)
+    parser.add_argument("--in-branch", required=True)
+    parser.add_argument("--out-branch", required=True)
+    parser.add_argument("--tmpdir", required=True)
+    args = parser.parse_args(argv[1:])
+
+    checksum = read_ref(args.repo, args.in_branch)
+    if checksum is None:
+        parser.error("Ref %s doesn't exist" % args.in_branch)
+    result = usrmove(args.repo, checksum, args.tmpdir)
+    write_if_changed("%s/refs/heads/%s" % (args.repo, args.out_branch),
+                     result + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+"""
+Exercises `apt2ostree.fetch` against a local HTTP/1.1 server and compares it
+with running `curl` and `sha256sum` once per file as `download_deb` used to.
+
+Usage:
+
+    ./benchmark_fetch.py [--files=500] [--size=65536]
+
+Also checks that an interrupted download is resumed with a range request,
+that a file with the wrong SHA256 is rejected and that a mirror serving the
+wrong bytes is passed over for the next one.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+if sys.version_info[0] >= 3:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from apt2ostree.fetch import (ChecksumError, Fetcher, FetchError,
+                              FetchServer, stream_via_service)
+from apt2ostree.mirror_health import MirrorHealth
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serves files with keep-alive and single range requests.  Counts
+    connections and range requests so we can check they're used."""
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    ranges = 0
+
+    def setup(self):
+        SimpleHTTPRequestHandler.setup(self)
+        RangeHandler.connections += 1
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            self.send_error(404)
+            return
+        start = 0
+        rng = self.headers.get("Range")
+        if rng and rng.startswith("bytes=") and rng.endswith("-"):
+            RangeHandler.ranges += 1
+            start = int(rng[len("bytes="):-1])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class BadHandler(RangeHandler):
+    """An out of sync mirror: serves different bytes under the same name"""
+    def do_GET(self):
+        data = b"rebuilt" * 1000
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--size", type=int, default=65536)
+    args = parser.parse_args(argv[1:])
+
+    tmpdir = tempfile.mkdtemp(prefix="benchmark_fetch.")
+    old_cwd = os.getcwd()
+    try:
+        srcdir = os.path.join(tmpdir, "src")
+        os.mkdir(srcdir)
+        shas = []
+        for n in range(args.files):
+            data = os.urandom(args.size)
+            with open(os.path.join(srcdir, "%i.deb" % n), "wb") as f:
+                f.write(data)
+            shas.append(hashlib.sha256(data).hexdigest())
+
+        os.chdir(srcdir)
+        server = Server(("127.0.0.1", 0), RangeHandler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        base = "http://127.0.0.1:%i" % server.server_address[1]
+
+        check_resume(base, tmpdir, shas[0])
+        check_bad_mirror(base, tmpdir, shas[0])
+
+        if have_curl():
+            outdir = os.path.join(tmpdir, "curl")
+            os.mkdir(outdir)
+            start = time.time()
+            for n, sha in enumerate(shas):
+                out = os.path.join(outdir, "%i.deb" % n)
+                subprocess.check_call(
+                    ["curl", "-sL", "--fail", "-o", out,
+                     "%s/%i.deb" % (base, n)])
+                actual = subprocess.check_output(["sha256sum", out]).split()[0]
+                assert actual.decode() == sha
+            print("curl + sha256sum:   %8.2f ms" % (
+                (time.time() - start) * 1000))
+
+        outdir = os.path.join(tmpdir, "fetch")
+        os.mkdir(outdir)
+        RangeHandler.connections = 0
+        fetcher = Fetcher()
+        start = time.time()
+        for n, sha in enumerate(shas):
+            fetcher.fetch(["%s/%i.deb" % (base, n)], sha,
+                          os.path.join(outdir, "%i.deb" % n))
+        print("Fetcher:            %8.2f ms (%i connections)" % (
+            (time.time() - start) * 1000, RangeHandler.connections))
+        fetcher.close()
+
+        outdir = os.path.join(tmpdir, "fetch_many")
+        os.mkdir(outdir)
+        RangeHandler.connections = 0
+        fetcher = Fetcher()
+        start = time.time()
+        errors = fetcher.fetch_many(
+            (["%s/%i.deb" % (base, n)], sha,
+             os.path.join(outdir, "%i.deb" % n))
+            for n, sha in enumerate(shas))
+        assert not errors, errors
+        print("Fetcher.fetch_many: %8.2f ms (%i connections)" % (
+            (time.time() - start) * 1000, RangeHandler.connections))
+        fetcher.close()
+
+        server.shutdown()
+        return 0
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(tmpdir)
+
+
+def have_curl():
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["curl", "--version"], stdout=devnull)
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def check_resume(base, tmpdir, sha):
+    fetcher = Fetcher()
+    dest = os.path.join(tmpdir, "resumed.deb")
+    with open("0.deb", "rb") as f:
+        data = f.read()
+    with open(dest + ".part", "wb") as f:
+        f.write(data[:len(data) // 3])
+    RangeHandler.ranges = 0
+    fetcher.fetch(["%s/missing.deb" % base, "%s/0.deb" % base], sha, dest)
+    with open(dest, "rb") as f:
+        assert f.read() == data
+    assert RangeHandler.ranges == 1, RangeHandler.ranges
+    assert not os.path.exists(dest + ".part")
+
+    try:
+        fetcher.fetch(["%s/0.deb" % base], "0" * 64,
+                      os.path.join(tmpdir, "bad.deb"))
+        raise AssertionError("Expected SHA256 mismatch")
+    except FetchError as e:
+        assert "doesn't match" in str(e)
+    assert not os.path.exists(os.path.join(tmpdir, "bad.deb.part"))
+    fetcher.close()
+    print("Range resume and SHA256 checks: OK")
+
+
+def check_bad_mirror(base, tmpdir, sha):
+    bad_server = Server(("127.0.0.1", 0), BadHandler)
+    t = threading.Thread(target=bad_server.serve_forever)
+    t.daemon = True
+    t.start()
+    bad = "http://127.0.0.1:%i" % bad_server.server_address[1]
+    with open("0.deb", "rb") as f:
+        data = f.read()
+    health = MirrorHealth(os.path.join(tmpdir, "health.json"))
+    fetcher = Fetcher(health=health)
+    mirrors = [bad, base]
+    urls = ["%s/0.deb" % bad, "%s/0.deb" % base]
+
+    # `fetch` goes on to the next mirror by itself
+    dest = os.path.join(tmpdir, "from_bad_mirror.deb")
+    assert fetcher.fetch(urls, sha, dest, mirrors) == urls[1]
+    with open(dest, "rb") as f:
+        assert f.read() == data
+    # Wrong bytes count against the mirror, not for it
+    assert health.stats[bad]["failures"] == 1, health.stats[bad]
+    assert health.stats[bad]["successes"] == 0, health.stats[bad]
+    assert health.stats[base]["successes"] == 1, health.stats[base]
+    assert health.rank_urls(urls, mirrors) == urls[::-1]
+    fetcher.close()
+
+    # `stream` tells us which mirror was bad so `deb.download_and_import` can
+    # throw away what it was given and try the others
+    fetcher = Fetcher()
+    out = []
+    try:
+        fetcher.stream(urls, sha, out.append, mirrors)
+        raise AssertionError("Expected SHA256 mismatch")
+    except ChecksumError as e:
+        assert e.url == urls[0], e.url
+    out = []
+    assert fetcher.stream(urls[1:], sha, out.append, mirrors) == urls[1]
+    assert b"".join(out) == data
+
+    # And so does the fetch service
+    socket_path = os.path.join(tmpdir, "fetch.sock")
+    service = FetchServer(socket_path, Fetcher())
+    t = threading.Thread(target=service.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        stream_via_service(socket_path, urls, sha, out.append)
+        raise AssertionError("Expected SHA256 mismatch")
+    except ChecksumError as e:
+        assert e.url == urls[0], e.url
+    out = []
+    assert stream_via_service(
+        socket_path, urls[1:], sha, out.append) == urls[1]
+    assert b"".join(out) == data
+
+    service.shutdown()
+    service.server_close()
+    bad_server.shutdown()
+    fetcher.close()
+    print("Bad mirror checks: OK")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
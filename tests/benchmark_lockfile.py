@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+"""
+Compares the speed of `apt2ostree.apt.parse_packages` with
+`apt2ostree.lockfile.Lockfile` for reading the fields that
+`Apt.image_from_lockfile` needs.
+
+Usage:
+
+    ./benchmark_lockfile.py [--repeat=5] [--synthetic-stanzas=50000]
+
+Runs against `multistrap_compare/multistrap.conf.lock` and a synthetic lockfile
+built by repeating its stanzas with unique package names and SHAs.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from apt2ostree.apt import parse_packages
+from apt2ostree.lockfile import Lockfile
+
+
+LOCKFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "multistrap_compare/multistrap.conf.lock")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--synthetic-stanzas", type=int, default=50000)
+    args = parser.parse_args(argv[1:])
+
+    tmpdir = tempfile.mkdtemp(prefix="benchmark_lockfile.")
+    try:
+        synthetic = os.path.join(tmpdir, "synthetic.lock")
+        write_synthetic_lockfile(LOCKFILE, synthetic, args.synthetic_stanzas)
+
+        for filename in [LOCKFILE, synthetic]:
+            print("%s (%i bytes):" % (filename, os.stat(filename).st_size))
+            for name, fn in [("parse_packages", read_with_parse_packages),
+                             ("Lockfile", read_with_lockfile)]:
+                count, secs = best_of(args.repeat, fn, filename)
+                print("    %-16s %7i stanzas %9.2f ms" % (
+                    name, count, secs * 1000))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def read_with_parse_packages(filename):
+    n = 0
+    with open(filename) as f:
+        for pkg in parse_packages(f):
+            _ = (pkg['Package'], pkg['Version'], pkg['Filename'],
+                 pkg['SHA256'])
+            n += 1
+    return n
+
+
+def read_with_lockfile(filename):
+    n = 0
+    with open(filename, 'rb') as f:
+        lockfile = Lockfile(f)
+    for pkg in lockfile:
+        _ = (pkg.package, pkg.version, pkg.filename, pkg.sha256)
+        n += 1
+    return n
+
+
+def best_of(repeat, fn, filename):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = fn(filename)
+        secs = time.time() - start
+        if best is None or secs < best:
+            best = secs
+    return count, best
+
+
+def write_synthetic_lockfile(template, out, n_stanzas):
+    with open(template, 'rb') as f:
+        stanzas = [x for x in f.read().split(b"\n\n") if x.strip()]
+    with open(out, 'wb') as f:
+        for n in range(n_stanzas):
+            stanza = stanzas[n % len(stanzas)]
+            lines = []
+            for line in stanza.split(b"\n"):
+                if line.startswith(b"Package: "):
+                    line += b"-%i" % n
+                elif line.startswith(b"SHA256: "):
+                    line = b"SHA256: " + hashlib.sha256(
+                        line + b"%i" % n).hexdigest().encode("ascii")
+                lines.append(line)
+            f.write(b"\n".join(lines) + b"\n\n")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
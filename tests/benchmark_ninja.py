@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+"""
+Measures the size of the ninja files apt2ostree writes for big lockfiles and
+how long ninja takes to load them, with and without compact mode (see
+`Ninja.__init__`).
+
+Usage:
+
+    ./benchmark_ninja.py [--repeat=3] [--stanzas=1000,10000,50000]
+
+For each size a synthetic lockfile is made from
+`multistrap_compare/multistrap.conf.lock` as in `benchmark_lockfile.py` and a
+configure script building an image from it is run in a temporary directory.
+Loading is timed by running `ninja -d stats -n .FORCE`, which has nothing to
+do, so the time is ninja starting up: mostly parsing build.ninja and its
+fragments, which is also reported on its own.
+
+Compact mode only changes the descriptions, so both modes must give ninja the
+same build graph: this is checked by comparing `ninja -t targets all` and
+`ninja -t commands`.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(TESTS + '/..')
+from benchmark_lockfile import LOCKFILE, write_synthetic_lockfile
+
+CONFIGURE = """\
+import sys
+sys.path.append(%(root)r)
+from apt2ostree import Apt, Ninja, ubuntu_apt_sources
+from apt2ostree.lockfile import Lockfile
+
+with open("synthetic.lock", "rb") as f:
+    packages = [x.package for x in Lockfile(f)]
+with Ninja(sys.argv) as ninja:
+    ninja.variable("ostree_repo", "_build/ostree")
+    apt = Apt(ninja)
+    image = apt.build_image("synthetic.lock", packages,
+                            ubuntu_apt_sources("xenial"))
+    ninja.default(image.filename)
+    apt.write_phony_rules()
+"""
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stanzas", default="1000,10000,50000")
+    args = parser.parse_args(argv[1:])
+
+    failures = 0
+    for n in [int(x) for x in args.stanzas.split(",")]:
+        tmpdir = tempfile.mkdtemp(prefix="benchmark_ninja.")
+        try:
+            write_synthetic_lockfile(
+                LOCKFILE, os.path.join(tmpdir, "synthetic.lock"), n)
+            with open(os.path.join(tmpdir, "configure.py"), "w") as f:
+                f.write(CONFIGURE % {"root": TESTS + "/.."})
+            print("%i packages:" % n)
+            graphs = []
+            for compact in ["0", "1"]:
+                graphs.append(benchmark(
+                    tmpdir, compact, args.repeat,
+                    "compact" if compact == "1" else "default"))
+            if graphs[0] != graphs[1]:
+                print("FAIL: compact mode gives a different build graph")
+                failures += 1
+        finally:
+            shutil.rmtree(tmpdir)
+    return 1 if failures else 0
+
+
+def benchmark(tmpdir, compact, repeat, name):
+    env = dict(os.environ)
+    env["APT2OSTREE_NINJA_COMPACT"] = compact
+    start = time.time()
+    subprocess.check_call([sys.executable, "configure.py"], cwd=tmpdir,
+                          env=env, stdout=subprocess.PIPE)
+    configure = time.time() - start
+
+    size = 0
+    for dirpath, _, filenames in os.walk(tmpdir):
+        for x in filenames:
+            if x.endswith(".ninja"):
+                size += os.stat(os.path.join(dirpath, x)).st_size
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        stats = subprocess.check_output(
+            ["ninja", "-d", "stats", "-n", ".FORCE"], cwd=tmpdir)
+        secs = time.time() - start
+        parse = float(re.search(
+            br"^\.ninja parse\s.*\s([0-9.]+)$", stats, re.M).group(1))
+        if best is None or secs < best[0]:
+            best = (secs, parse)
+    print("    %-8s %10.1f kB ninja  configure %6.2f s  load %6.3f s "
+          "(parse %7.1f ms)" % (name, size / 1024., configure, best[0],
+                                best[1]))
+
+    targets = subprocess.check_output(
+        ["ninja", "-t", "targets", "all"], cwd=tmpdir)
+    commands = subprocess.check_output(
+        ["ninja", "-t", "commands"], cwd=tmpdir)
+    return sorted(targets.split(b"\n")), sorted(commands.split(b"\n"))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
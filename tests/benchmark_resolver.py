@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+"""
+Checks `apt2ostree.resolver` against the lockfiles in examples/ and measures
+how fast it is, optionally against `aptly lockfile create`.
+
+Usage:
+
+    ./benchmark_resolver.py [--repeat=5] [--synthetic-stanzas=50000]
+
+    # Compare with aptly resolving against a real archive:
+    ./benchmark_resolver.py \\
+        --source http://archive.ubuntu.com/ubuntu xenial amd64 "main universe" \\
+        --keyring ../apt2ostree/keyrings/ubuntu/xenial/ubuntu-keyring.gpg \\
+        nginx-core
+
+The checks use the lockfiles themselves as fixture indices: resolving every
+package in a lockfile must give back the same lockfile byte for byte, and
+resolving the example's package list must give a subset of it.
+`multistrap_compare/multistrap.conf.lock` has complete stanzas so it's also
+used to check the handling of Essential and Priority: required packages.
+
+The benchmark resolves against a synthetic index made by adding renamed
+copies of the stanzas of that lockfile, without Essential and Priority.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from apt2ostree.index_cache import IndexCache
+from apt2ostree.lockfile import Lockfile
+from apt2ostree.resolver import PackageIndex, read_index, write_lockfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + '/..'
+
+# (lockfile, architecture, packages) as in the configure scripts
+EXAMPLES = [
+    ("examples/nginx/Packages.lock", "amd64", ["nginx-core"]),
+    ("examples/multistrap/multistrap.conf.lock", "armhf", ["systemd"]),
+]
+COMPLETE = ("tests/multistrap_compare/multistrap.conf.lock", "armhf",
+            ["apt", "systemd"])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--synthetic-stanzas", type=int, default=50000)
+    parser.add_argument(
+        "--source", nargs=4, action="append", default=[],
+        metavar=("URL", "DISTRIBUTION", "ARCHITECTURE", "COMPONENTS"))
+    parser.add_argument("--keyring", action="append", default=[])
+    parser.add_argument("packages", nargs="*")
+    args = parser.parse_args(argv[1:])
+
+    failures = check()
+    for x in failures:
+        print("FAIL: %s" % x)
+    if failures:
+        return 1
+    print("Checks passed")
+
+    tmpdir = tempfile.mkdtemp(prefix="benchmark_resolver.")
+    try:
+        synthetic = os.path.join(tmpdir, "Packages")
+        write_synthetic_index(os.path.join(ROOT, COMPLETE[0]), synthetic,
+                              args.synthetic_stanzas)
+        benchmark(synthetic, COMPLETE[1], COMPLETE[2], args.repeat)
+        if args.source:
+            compare_with_aptly(args.source, args.keyring, args.packages,
+                               tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+def resolve(filename, architecture, packages, **kwargs):
+    index = PackageIndex(architecture)
+    index.add_file(os.path.join(ROOT, filename))
+    return index, index.resolve(packages, **kwargs)
+
+
+def check():
+    failures = []
+    for filename, architecture, packages in EXAMPLES:
+        with open(os.path.join(ROOT, filename)) as f:
+            expected = f.read()
+        index, out = resolve(filename, architecture, packages)
+        _, everything = resolve(filename, architecture, sorted(index.packages))
+        if "".join(x.lockfile_stanza() for x in everything) != expected:
+            failures.append("%s: Resolving all its packages doesn't give the "
+                            "same lockfile" % filename)
+        names = set(x.name for x in out)
+        if not set(packages) <= names:
+            failures.append("%s: %s missing" % (filename, packages))
+
+    filename, architecture, packages = COMPLETE
+    index, out = resolve(filename, architecture, packages)
+    names = set(x.name for x in out)
+    for name in index.packages:
+        pkg = index.candidate(name)
+        if (pkg.essential or pkg.required) and name not in names:
+            failures.append("%s: Essential/required %s missing" % (
+                filename, name))
+    _, out = resolve(filename, architecture, packages, follow_deps=False,
+                     include_essential=False, include_priority_required=False)
+    if sorted(x.name for x in out) != sorted(packages):
+        failures.append("%s: no-deps resolved %s" % (
+            filename, [x.name for x in out]))
+    _, out = resolve(filename, architecture, packages,
+                     include_essential=False, include_priority_required=False)
+    if any(x.name == "dash" for x in out):
+        failures.append("%s: dash included without include_essential" %
+                        filename)
+    return failures
+
+
+def benchmark(filename, architecture, packages, repeat):
+    print("%s (%i bytes):" % (filename, os.stat(filename).st_size))
+    data = read_index(filename)
+    secs, index = best_of(repeat, lambda: _index(architecture, data))
+    print("    %-28s %9.2f ms" % ("Build index", secs * 1000))
+    start = time.time()
+    out = index.resolve(packages)
+    print("    %-28s %9.2f ms (%i packages)" % (
+        "First resolution", (time.time() - start) * 1000, len(out)))
+    secs, _ = best_of(repeat, lambda: index.resolve(packages))
+    print("    %-28s %9.2f ms" % ("Reusing the index", secs * 1000))
+
+
+def _index(architecture, data):
+    index = PackageIndex(architecture)
+    index.add(data)
+    return index
+
+
+def compare_with_aptly(sources, keyrings, packages, tmpdir):
+    architecture = sources[0][2]
+    cache = IndexCache(os.path.join(tmpdir, "index-cache"))
+    start = time.time()
+    index = PackageIndex(architecture)
+    for url, distribution, _, components in sources:
+        for component in components.split():
+            for arch in [architecture, "all"]:
+                filename = cache.packages(url, distribution, arch, component,
+                                          keyrings)
+                if filename is not None:
+                    index.add_file(filename)
+    ours = os.path.join(tmpdir, "builtin.lock")
+    with open(ours, "w") as f:
+        write_lockfile(f, index.resolve(packages))
+    print("builtin resolver: %.2f s" % (time.time() - start))
+
+    env = dict(os.environ)
+    env["HOME"] = os.path.join(tmpdir, "aptly")
+    os.mkdir(env["HOME"])
+    keyring_args = ["-keyring=%s" % x for x in keyrings]
+    theirs = os.path.join(tmpdir, "aptly.lock")
+    start = time.time()
+    mirrors = []
+    for n, (url, distribution, arch, components) in enumerate(sources):
+        mirrors.append("mirror-%i" % n)
+        subprocess.check_call(
+            ["aptly", "mirror", "create", "-architectures=" + arch] +
+            keyring_args + ["-gpg-provider=internal", mirrors[-1], url,
+                            distribution] + components.split(), env=env)
+    with open(theirs, "w") as f:
+        subprocess.check_call(
+            ["aptly", "lockfile", "create", "-mirrors", ",".join(mirrors),
+             "-architectures=" + architecture] + keyring_args +
+            ["-gpg-provider=internal"] + packages, stdout=f, env=env)
+    print("aptly: %.2f s" % (time.time() - start))
+
+    with open(ours, "rb") as a, open(theirs, "rb") as b:
+        ours, theirs = Lockfile(a), Lockfile(b)
+    only_ours = sorted(x.package for x in ours.difference(theirs))
+    only_theirs = sorted(x.package for x in theirs.difference(ours))
+    if only_ours or only_theirs:
+        print("Lockfiles differ:\n    builtin only: %s\n    aptly only: %s" %
+              (" ".join(only_ours), " ".join(only_theirs)))
+    else:
+        print("Lockfiles are identical")
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        secs = time.time() - start
+        if best is None or secs < best:
+            best = secs
+    return best, result
+
+
+def write_synthetic_index(template, out, n_stanzas):
+    """The stanzas of template followed by renamed copies of them to make
+    n_stanzas in all"""
+    with open(template, 'rb') as f:
+        stanzas = [x for x in f.read().split(b"\n\n") if x.strip()]
+    with open(out, 'wb') as f:
+        for n in range(n_stanzas):
+            stanza = stanzas[n % len(stanzas)]
+            if n >= len(stanzas):
+                stanza = b"\n".join(
+                    x for x in stanza.split(b"\n")
+                    if not x.startswith((b"Essential:", b"Priority:")))
+                stanza = stanza.replace(b"Package: ", b"Package: copy%i-" % n,
+                                        1)
+            f.write(stanza + b"\n\n")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
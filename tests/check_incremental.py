@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+"""
+End-to-end check of `apt2ostree.incremental`: builds an image from fake
+packages, changes some of the packages and checks that combining
+incrementally gives the same commit as combining from scratch.
+
+Like real packages the fake ones have directories and files that aren't
+owned by root, setgid directories and symlinks, and directories that several
+packages have with different ownership, so it checks that those come out as
+they would from scratch.
+
+Usage:
+
+    ./check_incremental.py [--packages=200] [--changes=10]
+
+Requires ostree.
+"""
+
+import argparse
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from apt2ostree.incremental import FileLists, combine, combine_from_scratch
+
+
+def _add(tar, path, kind, mode, uid=0, gid=0, data=b"", linkname=""):
+    info = tarfile.TarInfo("./" + path)
+    info.type = kind
+    info.mode = mode
+    info.uid = uid
+    info.gid = gid
+    info.linkname = linkname
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data) if data else None)
+
+
+def make_package(repo, tmpdir, name, version, flavour):
+    """Commits a fake package to deb/pool/<name>_<version>/data.  Packages
+    of different flavours have some of the same directories with different
+    ownership and permissions."""
+    files = ["usr/share/doc/%s/copyright" % name,
+             "usr/lib/%s/%s.so" % (name, name),
+             "usr/bin/%s" % name]
+    dirs = [("usr", 0o755, 0, 0), ("usr/share", 0o755, 0, 0),
+            ("usr/share/doc", 0o755, 0, 0),
+            ("usr/share/doc/%s" % name, 0o755, 0, 0),
+            ("usr/lib", 0o755, 0, 0), ("usr/lib/%s" % name, 0o755, 0, 0),
+            ("usr/bin", 0o755, 0, 0)]
+    if flavour == 0:
+        # Directories that other packages have too, like base-files'
+        # /var/mail (root:mail 2775)
+        files.append("usr/share/man/man1/%s.1" % name)
+        dirs += [("usr/share/man", 0o755, 0, 0),
+                 ("usr/share/man/man1", 0o755, 0, 0),
+                 ("var", 0o755, 0, 0), ("var/mail", 0o2775, 0, 8)]
+    elif flavour == 1:
+        dirs += [("var", 0o755, 0, 0), ("var/mail", 0o755, 0, 0),
+                 ("var/lib", 0o755, 0, 0),
+                 ("var/lib/%s" % name, 0o750, 100, 101)]
+    else:
+        # Names that would confuse parsing `ostree ls -R`
+        files.append("usr/share/doc/%s/odd\nname -> %s" % (name, name))
+
+    filename = os.path.join(tmpdir, "%s_%s.tar" % (name, version))
+    tar = tarfile.open(filename, "w", format=tarfile.GNU_FORMAT)
+    _add(tar, ".", tarfile.DIRTYPE, 0o755)
+    for path, mode, uid, gid in dirs:
+        _add(tar, path, tarfile.DIRTYPE, mode, uid, gid)
+    for path in files:
+        _add(tar, path, tarfile.REGTYPE, 0o644,
+             data=("%s %s %s\n" % (name, version, path)).encode("utf-8"))
+    _add(tar, "usr/bin/%s-link" % name, tarfile.SYMTYPE, 0o777,
+         linkname=name)
+    if flavour == 1:
+        _add(tar, "var/lib/%s/state" % name, tarfile.REGTYPE, 0o640, 100,
+             101, data=version.encode("utf-8"))
+    tar.close()
+
+    ref = "deb/pool/%s_%s/data" % (name, version)
+    subprocess.check_call(
+        ["ostree", "--repo=%s" % repo, "commit", "-b", ref,
+         "--tree=tar=%s" % filename, "--no-bindings", "--orphan",
+         "--timestamp=0"],
+        stdout=subprocess.PIPE)
+    os.unlink(filename)
+    return ref
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packages", type=int, default=200)
+    parser.add_argument("--changes", type=int, default=10)
+    args = parser.parse_args(argv[1:])
+
+    tmpdir = tempfile.mkdtemp(prefix="check_incremental.")
+    try:
+        repo = os.path.join(tmpdir, "repo")
+        subprocess.check_call(
+            ["ostree", "init", "--repo=%s" % repo, "--mode=bare-user"])
+        rng = random.Random(0)
+        versions = dict(("pkg%04i" % n, 1) for n in range(args.packages))
+
+        def refs():
+            return [make_package(repo, tmpdir, name, str(v), n % 3)
+                    for n, (name, v) in enumerate(sorted(versions.items()))]
+
+        lists = FileLists(repo, os.path.join(tmpdir, "file-lists"))
+        state = os.path.join(tmpdir, "state.json")
+        combine(repo, "image", refs(), state, lists)
+
+        names = sorted(versions)
+        for name in rng.sample(names, args.changes):
+            versions[name] += 1
+        for name in rng.sample(names, args.changes // 2):
+            del versions[name]
+        for n in range(args.changes // 2):
+            versions["new%04i" % n] = 1
+        new_refs = refs()
+
+        start = time.time()
+        incremental = combine(repo, "image", new_refs, state, lists)
+        print("Incremental:  %8.2f ms" % ((time.time() - start) * 1000))
+
+        start = time.time()
+        expected = combine_from_scratch(
+            repo, [open("%s/refs/heads/%s" % (repo, x)).read().strip()
+                   for x in new_refs])
+        print("From scratch: %8.2f ms" % ((time.time() - start) * 1000))
+
+        if incremental != expected:
+            subprocess.call(["ostree", "--repo=%s" % repo, "diff",
+                             expected, incremental])
+            sys.stderr.write("FAIL: incremental %s != from scratch %s\n" % (
+                incremental, expected))
+            return 1
+        print("Incremental and from scratch match: %s" % incremental)
+        return 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
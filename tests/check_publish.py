@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+"""
+End-to-end check of `apt2ostree.ostree.ostree_publish_images`: publishes an
+image from a real ostree repo with ninja and checks that:
+
+* Publishing again when the image hasn't changed is a no-op: the edge runs
+  but leaves the published branch alone, so ninja's restat skips updating the
+  summary, and the next ninja has nothing to do.
+* Publishing a changed image commits it on top of the previous published
+  commit, generates a static delta from that commit and lists the delta in
+  the summary.
+
+Usage:
+
+    ./check_publish.py
+
+Requires ostree and ninja.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + '/..'
+
+CONFIGURE = """\
+import sys
+sys.path.append(%(root)r)
+from apt2ostree import Ninja
+from apt2ostree.ostree import OstreeRef, ostree_publish_images
+
+with Ninja(sys.argv) as ninja:
+    ninja.variable("ostree_repo", "_build/ostree")
+    ninja.default(ostree_publish_images(
+        ninja, [OstreeRef("_build/ostree/refs/heads/image")],
+        "_build/publish"))
+"""
+
+REPO = "_build/ostree"
+PUBLISH_REPO = "_build/publish"
+
+
+def commit_image(tmpdir, version):
+    """Commits a tiny image to the image branch of the build repo"""
+    tree = os.path.join(tmpdir, "tree")
+    shutil.rmtree(tree, ignore_errors=True)
+    os.makedirs(os.path.join(tree, "usr/share/image"))
+    with open(os.path.join(tree, "usr/share/image/version"), "w") as f:
+        f.write("%i\n" % version)
+    with open(os.path.join(tree, "usr/share/image/data"), "wb") as f:
+        f.write(b"unchanged\n" * 10000)
+    subprocess.check_call(
+        ["ostree", "--repo=%s" % REPO, "commit", "-b", "image",
+         "--tree=dir=%s" % tree, "--no-bindings", "--timestamp=0"],
+        stdout=subprocess.PIPE)
+
+
+def ostree(*args):
+    return subprocess.check_output(
+        ("ostree", "--repo=%s" % PUBLISH_REPO) + args).decode("utf-8")
+
+
+def ninja(*args):
+    out = subprocess.check_output(("ninja",) + args).decode("utf-8")
+    sys.stdout.write(out)
+    return out
+
+
+def published():
+    return ostree("rev-parse", "image").strip()
+
+
+def main(_):
+    tmpdir = tempfile.mkdtemp(prefix="check_publish.")
+    old_cwd = os.getcwd()
+    try:
+        os.chdir(tmpdir)
+        subprocess.check_call(
+            ["ostree", "init", "--repo=%s" % REPO, "--mode=bare-user"])
+        commit_image(tmpdir, 1)
+        with open("configure.py", "w") as f:
+            f.write(CONFIGURE % {"root": ROOT})
+        subprocess.check_call([sys.executable, "configure.py"])
+
+        ninja()
+        first = published()
+        summary_mtime = os.stat(PUBLISH_REPO + "/summary").st_mtime
+
+        # The input is newer than what we published, but hasn't changed
+        time.sleep(1)
+        os.utime(REPO + "/refs/heads/image", None)
+        out = ninja()
+        assert "Publish image" in out, out
+        assert "Update summary" not in out, out
+        assert published() == first
+        assert os.stat(PUBLISH_REPO + "/summary").st_mtime == summary_mtime
+        assert "no work to do" in ninja("-n"), "restat didn't stick"
+        print("Publishing an unchanged image is a no-op: OK")
+
+        commit_image(tmpdir, 2)
+        out = ninja()
+        assert "Update summary" in out, out
+        second = published()
+        assert second != first
+        assert ostree("rev-parse", "image^").strip() == first
+        delta = "%s-%s" % (first, second)
+        assert delta in ostree("static-delta", "list"), \
+            "No static delta %s" % delta
+        assert delta in ostree("summary", "--view"), \
+            "Static delta %s not in the summary" % delta
+        print("Publishing a changed image adds a static delta: OK")
+        return 0
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))